@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# Benchmark challenge signing backends, with and without a precomputed nonce
+# pool. Each available backend signs the same random hashes, every signature is checked to be DER encoded, low S and valid
+# for the signer's public key, and the time per signature is reported.
+#
+# Usage: python3 contrib/scripts/bench_signer.py [iterations]
+import os
+import sys
+from time import perf_counter, sleep
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from guardnode.signer import NoncePool, OpenSSLSigner, PooledSigner, Secp256k1Signer, coincurve
+from guardnode.qa.tests.test_framework.key import CPubKey, SECP256K1_ORDER_HALF
+
+def check(signer, hash, sig):
+    assert sig[0] == 0x30 and sig[1] == len(sig) - 2, "not DER encoded"
+    r_size = sig[3]
+    s_size = sig[5 + r_size]
+    assert int.from_bytes(sig[6 + r_size:6 + r_size + s_size], "big") <= SECP256K1_ORDER_HALF, "high S"
+    assert CPubKey(signer.get_pubkey()).verify(hash, sig), "invalid signature"
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    secret = os.urandom(32)
+    hashes = [os.urandom(32) for _ in range(iterations)]
+    backends = [OpenSSLSigner]
+    if coincurve is not None:
+        backends.append(Secp256k1Signer)
+    else:
+        print("coincurve not installed - skipping secp256k1")
+    pubkeys = set()
+    for backend in backends:
+        for pooled in (False, True):
+            signer = backend(secret)
+            if pooled: # fill the pool before timing
+                pool = NoncePool(iterations, signer.name)
+                pool.start()
+                while len(pool.nonces) < iterations:
+                    sleep(0.1)
+                signer = PooledSigner(signer, secret, pool)
+            pubkeys.add(signer.get_pubkey())
+            start = perf_counter()
+            sigs = [signer.sign(hash) for hash in hashes]
+            elapsed = perf_counter() - start
+            if pooled:
+                pool.stop()
+            for hash, sig in zip(hashes, sigs):
+                check(signer, hash, sig)
+            print("{:20} {:8.1f} us/sig ({} signatures)".format(signer.name, elapsed / iterations * 1e6, iterations))
+    assert len(pubkeys) == 1, "backends derived different public keys"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+import asyncio
+import base64
+import decimal
+import json
+import logging
+import signal
+import ssl
+from collections import deque
+from time import perf_counter, time
+from urllib.parse import urlparse
+from .alerts import Alerts
+from .challenge import Challenge
+from .coordinator import Response, COORDINATOR_CONNECT_TIMEOUT, COORDINATOR_READ_TIMEOUT, \
+    COORDINATOR_PING_INTERVAL, RESPONSE_QUEUE_SIZE, RESPONSE_RETRY_MAX_DELAY, RESPONSE_RESULTS_SIZE
+from .metrics import RESPONSES, RESPONSE_LATENCY, serve_metrics
+from .response import response_signature
+from .qa.tests.test_framework.authproxy import JSONRPCException, EncodeDecimal, HTTP_TIMEOUT, USER_AGENT
+
+# Interval (seconds) at which the node log file is checked for new lines
+TAIL_POLL_INTERVAL = 0.1
+
+# Keep-alive HTTP/1.1 client connection on asyncio streams. Requests on a
+# connection are serialised; a request failing on a reused connection that
+# the server has closed is retried once on a fresh connection.
+class AsyncHTTPConnection():
+    def __init__(self, url, connect_timeout=COORDINATOR_CONNECT_TIMEOUT, read_timeout=HTTP_TIMEOUT):
+        self.url = urlparse(url)
+        https = self.url.scheme == "https"
+        self.host = self.url.hostname
+        self.port = self.url.port or (443 if https else 80)
+        self.ssl = ssl.create_default_context() if https else None
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl), self.connect_timeout)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    # return (status, headers, body) of the response to the request
+    async def request(self, method, path, body=b"", headers=None, read_timeout=None):
+        timeout = read_timeout or self.read_timeout
+        async with self.lock:
+            reused = self.writer is not None
+            if not reused:
+                await self.connect()
+            try:
+                return await asyncio.wait_for(self.exchange(method, path, body, headers or {}), timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if not reused:
+                    raise
+            except BaseException: # timed out or cancelled mid request
+                self.close()
+                raise
+            await self.connect()
+            try:
+                return await asyncio.wait_for(self.exchange(method, path, body, headers or {}), timeout)
+            except BaseException:
+                self.close()
+                raise
+
+    async def exchange(self, method, path, body, headers):
+        lines = ["{} {} HTTP/1.1".format(method, path), "Host: {}".format(self.host),
+            "Content-Length: {}".format(len(body))]
+        lines += ["{}: {}".format(k, v) for k, v in headers.items()]
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by server")
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            response_headers[key.strip().lower()] = value.strip()
+
+        if method == "HEAD" or status in (204, 304):
+            data = b""
+        elif response_headers.get("transfer-encoding", "").lower() == "chunked":
+            data = b""
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                data += chunk[:-2]
+        elif "content-length" in response_headers:
+            data = await self.reader.readexactly(int(response_headers["content-length"]))
+        else: # body delimited by connection close
+            data = await self.reader.read()
+            response_headers["connection"] = "close"
+        if response_headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, response_headers, data
+
+# JSON-RPC client for an ocean node on a single keep-alive connection.
+# Requests are recorded in stats, which may be shared with a sync proxy.
+class AsyncRPC():
+    id_count = 0
+
+    def __init__(self, url, timeout=HTTP_TIMEOUT, stats=None):
+        self.url = urlparse(url)
+        self.conn = AsyncHTTPConnection(url, read_timeout=timeout)
+        self.stats = stats
+        authpair = "{}:{}".format(self.url.username, self.url.password).encode("utf8")
+        self.headers = {"User-Agent": USER_AGENT, "Content-type": "application/json",
+            "Authorization": "Basic " + base64.b64encode(authpair).decode("ascii")}
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            raise AttributeError
+        return lambda *params: self.call(name, *params)
+
+    async def call(self, method, *params):
+        AsyncRPC.id_count += 1
+        body = json.dumps({"version": "1.1", "method": method, "params": params,
+            "id": AsyncRPC.id_count}, default=EncodeDecimal).encode("utf8")
+        start = perf_counter()
+        data = None
+        try:
+            status, headers, data = await self.conn.request("POST", self.url.path or "/", body, self.headers)
+        finally:
+            if self.stats is not None:
+                self.stats.record(method, perf_counter() - start, len(body),
+                    len(data) if data is not None else 0, data is None)
+        if headers.get("content-type") != "application/json":
+            raise JSONRPCException({'code': -342,
+                'message': "non-JSON HTTP response with '{}' from server".format(status)})
+        response = json.loads(data.decode("utf8"), parse_float=decimal.Decimal)
+        if response.get("error") is not None:
+            if self.stats is not None:
+                self.stats.record_error(method)
+            raise JSONRPCException(response["error"])
+        if "result" not in response:
+            raise JSONRPCException({'code': -343, 'message': 'missing JSON-RPC result'})
+        return response["result"]
+
+    def close(self):
+        self.conn.close()
+
+# Coordinator client sending challenge responses on a kept warm connection.
+# Has the submit/stop interface of ResponseDispatcher so it can replace the
+# dispatcher thread of a Challenge.
+class AsyncCoordinator():
+    def __init__(self, loop, host, url, deadline):
+        self.logger = logging.getLogger("Coordinator")
+        self.loop = loop
+        self.host = host
+        self.path = urlparse(url).path
+        self.deadline = deadline
+        self.conn = AsyncHTTPConnection(host, read_timeout=COORDINATOR_READ_TIMEOUT)
+        self.tasks = set()
+        self.results = deque(maxlen=RESPONSE_RESULTS_SIZE)
+        self.reachable = None
+
+    # thread safe - queue response to be sent from the event loop
+    def submit(self, challenge_txid, data, headers):
+        if len(self.tasks) >= RESPONSE_QUEUE_SIZE:
+            self.logger.error("Response queue full - dropping response to challenge {}".format(challenge_txid))
+            RESPONSES.inc(result="dropped")
+            return False
+        self.loop.call_soon_threadsafe(self.spawn, Response(challenge_txid, data, headers, self.deadline))
+        return True
+
+    def spawn(self, response):
+        task = self.loop.create_task(self.send(response))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def stop(self):
+        for task in list(self.tasks):
+            task.cancel()
+        self.conn.close()
+
+    # send response, retrying with backoff until its deadline
+    async def send(self, response):
+        while True:
+            response.attempts += 1
+            try:
+                status, _, content = await self.conn.request("POST", self.path, response.data, response.headers,
+                    read_timeout=min(COORDINATOR_READ_TIMEOUT, max(response.deadline - time(), 0.1)))
+                if status < 500 and status != 429:
+                    break
+                self.logger.warning("Coordinator returned {} for challenge {}".format(status, response.challenge_txid))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if response.attempts == 1:
+                    self.logger.error(e)
+                    self.logger.error("Could not connect to coordinator to send response data:\n{}".format(response.data.decode("utf-8")))
+                else:
+                    self.logger.warning("Response attempt {} for challenge {} failed: {}".format(
+                        response.attempts, response.challenge_txid, e))
+            if time() + response.delay >= response.deadline:
+                self.logger.error("Giving up on response to challenge {} after {} attempt(s)".format(
+                    response.challenge_txid, response.attempts))
+                RESPONSES.inc(result="failed")
+                self.results.append(response.result("failed"))
+                return
+            await asyncio.sleep(response.delay)
+            response.delay = min(response.delay * 2, RESPONSE_RETRY_MAX_DELAY)
+
+        result = response.result("ok" if status == 200 else "rejected")
+        RESPONSE_LATENCY.observe(result["latency"])
+        RESPONSES.inc(result=result["status"])
+        self.results.append(result)
+        self.logger.info("Response sent\nsignature:\n{}\ntxid:\n{}".format(
+            response_signature(response.data), response.challenge_txid))
+        if status != 200:
+            self.logger.error(content)
+
+    # periodically open or refresh the connection
+    async def keep_warm(self):
+        while True:
+            try:
+                await self.conn.request("HEAD", "/", read_timeout=COORDINATOR_READ_TIMEOUT)
+                if not self.reachable:
+                    self.logger.info("Connected to coordinator at {}".format(self.host))
+                self.reachable = True
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self.reachable is not False: # only log changes in reachability
+                    self.logger.warning("Coordinator at {} unreachable: {}".format(self.host, e))
+                self.reachable = False
+            await asyncio.sleep(COORDINATOR_PING_INTERVAL)
+
+# Liveness of an asyncio task in the form expected by Registry.watch_thread
+class TaskLiveness():
+    def __init__(self, task):
+        self.task = task
+
+    def is_alive(self):
+        return not self.task.done()
+
+    @property
+    def error(self):
+        if self.task.done() and not self.task.cancelled():
+            return self.task.exception()
+        return None
+
+# Thread safe adapter setting an asyncio.Event, for use by notifier threads
+class EventBridge():
+    def __init__(self, loop, event):
+        self.loop = loop
+        self.event = event
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+# Run the guardnode on an asyncio event loop. Watching chain tips, tailing the
+# node log and talking to the coordinator are coroutines; the first task to
+# fail cancels the rest. Everything else still uses the synchronous RPC
+# client in the default executor: challenge steps including bidding, client
+# block scans and wallet output updates. The optional notifier, mempool,
+# nonce pool and bid staging threads are started as in threaded mode.
+class AsyncRuntime():
+    def __init__(self, args):
+        self.args = args
+        self.logger = logging.getLogger("Runtime")
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        self.block_event = asyncio.Event()
+        self.challenge = await loop.run_in_executor(None, Challenge, self.args)
+        self.alerts = await loop.run_in_executor(None, Alerts, self.args)
+        self.rpc = AsyncRPC(self.rpc_url(self.args.rpchost, self.args.rpcuser, self.args.rpcpass),
+            stats=self.challenge.ocean.stats)
+        self.service_rpc = AsyncRPC(self.rpc_url(self.args.servicerpchost, self.args.servicerpcuser,
+            self.args.servicerpcpass), stats=self.challenge.service_ocean.stats)
+        self.coordinator = AsyncCoordinator(loop, self.args.challengehost, self.challenge.url,
+            self.args.responsedeadline)
+        self.challenge.dispatcher = self.coordinator
+        if self.challenge.mempool_watcher is not None:
+            self.challenge.mempool_watcher.start()
+        if self.challenge.stager is not None:
+            self.challenge.stager.start()
+
+        if hasattr(signal, "SIGUSR1"):
+            loop.add_signal_handler(signal.SIGUSR1, self.challenge.log_rpc_stats)
+        main_task = asyncio.current_task()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, main_task.cancel)
+
+        names = ("challenge", "client", "service", "alerts", "coordinator")
+        tasks = [loop.create_task(coro) for coro in (self.challenge_loop(),
+            self.watch(self.challenge.client_watcher, self.rpc, self.on_client_block),
+            self.watch(self.challenge.service_watcher, self.service_rpc, self.on_service_block),
+            self.alerts_loop(), self.coordinator.keep_warm())]
+        if self.args.metricsport is not None:
+            serve_metrics(self.args.metricsport, [self.challenge.ocean, self.challenge.service_ocean],
+                dict(zip(names, map(TaskLiveness, tasks))))
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            self.challenge.stop() # stop notifier threads and interrupt any waits in step
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.rpc.close()
+            self.service_rpc.close()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signum)
+
+    @staticmethod
+    def rpc_url(host, user, pw):
+        return "http://%s:%s@%s" % (user, pw, host)
+
+    async def challenge_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            timeout = await loop.run_in_executor(None, self.challenge.step)
+            if self.challenge.error:
+                raise self.challenge.error
+            try: # wait for a new service block
+                await asyncio.wait_for(self.block_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.block_event.clear()
+
+    # Poll the tip watched by watcher over the async rpc client, calling
+    # on_change(height) when it changes. Polls are triggered by the watcher's
+    # ZMQ notifier if it has one, or scheduled by its block cadence.
+    async def watch(self, watcher, rpc, on_change):
+        loop = asyncio.get_event_loop()
+        event = asyncio.Event()
+        if watcher.notifier is not None:
+            watcher.notifier.event = EventBridge(loop, event)
+            watcher.notifier.start()
+        while True:
+            height = await rpc.getblockcount()
+            if watcher.update(height):
+                detected_at = time()
+                await on_change(height)
+                try:
+                    header = await rpc.getblockheader(await rpc.getblockhash(height))
+                    watcher.observe_block(header["time"], detected_at)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.logger.warning("Could not get {} block {} time: {}".format(watcher.name, height, e))
+            try:
+                await asyncio.wait_for(event.wait(), watcher.wait_time())
+            except asyncio.TimeoutError:
+                pass
+            event.clear()
+
+    async def on_service_block(self, height):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.challenge.update_utxos, height)
+        self.block_event.set()
+
+    async def on_client_block(self, height):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.challenge.on_client_block, height)
+        if self.challenge.error:
+            raise self.challenge.error
+
+    async def alerts_loop(self):
+        file = self.alerts.file
+        file.seek(0, 2)
+        while True:
+            where = file.tell()
+            line = file.readline()
+            if not line:
+                await asyncio.sleep(TAIL_POLL_INTERVAL)
+                file.seek(where)
+            else:
+                self.alerts.check_line(line)
@@ -2,14 +2,19 @@
 import logging
 from time import sleep
 from .daemon import DaemonThread
+from .metrics import ALERT_LINES
 
-def tail_file(file, sleep_time):
+# Yield lines appended to file until stop_event (optional) is set
+def tail_file(file, sleep_time, stop_event=None):
     file.seek(0, 2)
-    while True:
+    while stop_event is None or not stop_event.is_set():
         where = file.tell()
         line = file.readline()
         if not line:
-            sleep(sleep_time)
+            if stop_event is None:
+                sleep(sleep_time)
+            else:
+                stop_event.wait(sleep_time)
             file.seek(where)
         else:
             yield line
@@ -29,9 +34,15 @@ class Alerts(DaemonThread):
     def run(self):
         while not self.stop_event.is_set():
             try:
-                for line in tail_file(self.file, sleep_time=0.1):
-                    if "ERROR" in line:
-                        self.logger.error(line.rstrip())
+                for line in tail_file(self.file, 0.1, self.stop_event):
+                    self.check_line(line)
             except Exception as e:
                 self.logger.error(e)
                 self.error = e
+
+    # alert on node log line
+    def check_line(self, line):
+        ALERT_LINES.inc(level="all")
+        if "ERROR" in line:
+            ALERT_LINES.inc(level="error")
+            self.logger.error(line.rstrip())
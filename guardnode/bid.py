@@ -1,21 +1,71 @@
 #!/usr/bin/env python3
 import logging
+import threading
 from decimal import *
+from .utxo import P2PKH, LOCKED_MULTISIG, classify_script
 from .qa.tests.test_framework.authproxy import JSONRPCException
+from .qa.tests.test_framework.util import bytes_to_hex_str, hex_str_to_bytes
+from .qa.tests.test_framework.mininode import CTransaction, CTxIn, CTxOut, CTxOutAsset, CTxOutValue
+from .qa.tests.test_framework.script import CScript, OP_0, OP_1, OP_3, OP_DROP, OP_CHECKLOCKTIMEVERIFY, \
+    OP_CHECKMULTISIG, OP_DUP, OP_HASH160, OP_EQUALVERIFY, OP_CHECKSIG
 
 DEFAULT_BID_FEE = Decimal("0.0001")
 
+# Largest DER encoded low S signature plus sighash type byte
+MAX_SIG_SIZE = 72
+
+# Locktime assumed for the bid output when the request end height is not known
+DEFAULT_LOCKTIME = 0xffff
+
+# scriptSig spending a scriptPubKey of the given type, with a maximum size
+# signature. Unknown types get a size safely above that of either.
+def dummy_script_sig(script_type):
+    if script_type == P2PKH:
+        return CScript([b"\x00" * MAX_SIG_SIZE, b"\x00" * 33])
+    if script_type == LOCKED_MULTISIG:
+        return CScript([OP_0, b"\x00" * MAX_SIG_SIZE])
+    return b"\x00" * 109
+
+# TX_LOCKED_MULTISIG bid output script: a 1 of 3 multisig of the guardnode
+# pubkey, the request txid and the fee pubkey, locked until locktime
+def bid_script(locktime, pubkey, request_key, fee_pubkey):
+    return CScript([locktime, OP_CHECKLOCKTIMEVERIFY, OP_DROP, OP_1, pubkey, request_key, fee_pubkey, OP_3,
+        OP_CHECKMULTISIG])
+
+# Serialized size in bytes of a signed bid transaction spending outputs with
+# the given scriptPubKeys (bytes), with or without a change output
+def bid_tx_size(scripts, change=True, locktime=DEFAULT_LOCKTIME):
+    tx = CTransaction()
+    tx.vin = [CTxIn(scriptSig=dummy_script_sig(classify_script(script)[0])) for script in scripts]
+    outputs = [bid_script(locktime, b"\x00" * 33, b"\x00" * 33, b"\x00" * 33), b""] # bid and fee
+    if change:
+        outputs.append(CScript([OP_DUP, OP_HASH160, b"\x00" * 20, OP_EQUALVERIFY, OP_CHECKSIG]))
+    tx.vout = [CTxOut(CTxOutValue(0), script, CTxOutAsset(b"\x01" + bytes(32))) for script in outputs]
+    return len(tx.serialize())
+
 class BidHandler():
-    def __init__(self, ocean, bid_limit):
+    # utxos: optional UtxoTracker to select coins from instead of the wallet rpc
+    # builder: optional BidBuilder to build and sign bids without the wallet
+    def __init__(self, ocean, bid_limit, utxos=None, builder=None):
         self.bid_limit = bid_limit
         self.bid_fee = DEFAULT_BID_FEE
         self.service_ocean = ocean
+        self.utxos = utxos
+        self.builder = builder
+        self.input_scripts = {} # (txid, vout) -> scriptPubKey hex of outputs seen by coin selection
+        self.staged = {} # (request txid, auction price, fee pubkey) -> (signed bid tx, inputs, bid keys)
+        # held while selecting coins for, building and sending a bid, so bids
+        # staged in the background and live bids are made one at a time
+        self.lock = threading.RLock()
 
         logging.getLogger("BitcoinRPC")
         self.logger = logging.getLogger("Bid")
 
     def check_locktime(self,txid,blockcount):
-        tx = self.service_ocean.getrawtransaction(txid, True)
+        return self.check_tx_locktime(self.service_ocean.getrawtransaction(txid, True),blockcount)
+
+    # Return False if any output of decoded tx is locked beyond blockcount
+    def check_tx_locktime(self,tx,blockcount):
         for outp in tx["vout"]: # check OP_CHECKLOCKTIMEVERIFY in script
             if "OP_CHECKLOCKTIMEVERIFY" in outp["scriptPubKey"]["asm"] \
             and int(outp["scriptPubKey"]["asm"].split(" ")[0]) > blockcount:
@@ -28,14 +78,30 @@ class BidHandler():
     # Coin select for slightly larger fee than previous to account for a potential
     # rise in fee value after coin selection
     def coin_selection(self, auction_price):
-        list_unspent = self.service_ocean.listunspent(1, 9999999, [], True, "CBT")
+        if self.utxos is not None and self.utxos.ready:
+            selection = self.utxos.select(auction_price + self.bid_fee*Decimal("1.2"))
+            if selection is None:
+                self.logger.warn("Not enough CBT in wallet to match the auction price {}".format(auction_price))
+                return False, False
+            return selection
+
+        with self.service_ocean.batch() as batch:
+            list_unspent = batch.listunspent(1, 9999999, [], True, "CBT")
+            blockcount = batch.getblockcount()
+        list_unspent = list_unspent.result()
+        blockcount = blockcount.result()
+        self.input_scripts = {(unspent["txid"], unspent["vout"]): unspent["scriptPubKey"] for unspent in list_unspent}
         input_sum = Decimal(0.0)
         locked_inputs = []
-        blockcount = self.service_ocean.getblockcount()
+
+        # Fetch txs of all TX_LOCKED_MULTISIG outputs in one request
+        with self.service_ocean.batch() as batch:
+            locked_txs = {unspent["txid"]: batch.getrawtransaction(unspent["txid"], True) \
+                for unspent in list_unspent if not unspent["solvable"]}
 
         # First try to use previous TX_LOCKED_MULTISIG outputs with valid locktime.
         for unspent in list_unspent:
-            if not unspent["solvable"] and self.check_locktime(unspent["txid"],blockcount):
+            if not unspent["solvable"] and self.check_tx_locktime(locked_txs[unspent["txid"]].result(),blockcount):
                 locked_inputs.append({"txid":unspent["txid"],"vout":unspent["vout"]})
                 input_sum += unspent["amount"]
                 if input_sum >= auction_price + self.bid_fee*Decimal("1.2"):
@@ -62,52 +128,163 @@ class BidHandler():
 
         return locked_inputs + bid_inputs, input_sum
 
-    # Take signed_raw_bid_tx and return fee value or False if failure to get estimate fee
-    def estimate_fee(self,inputs,change=True):
+    # scriptPubKey hex of a wallet output, or None if not seen locally
+    def input_script(self, txid, vout):
+        script = self.input_scripts.get((txid, vout))
+        if script is None and self.utxos is not None:
+            script = self.utxos.script(txid, vout)
+        return script
+
+    # Return fee value for a bid spending inputs, or False if failure to get
+    # estimate fee. Input scripts are looked up from coin selection and only
+    # fetched for inputs not seen there, in the same request as the fee rate.
+    def estimate_fee(self,inputs,change=True,locktime=DEFAULT_LOCKTIME):
+        scripts = [self.input_script(input["txid"], input["vout"]) for input in inputs]
+        with self.service_ocean.batch() as batch:
+            if not hasattr(self,"testing"): # if in testing mode ignore estimatesmartfee call
+                estimate = batch.estimatesmartfee(2)
+            input_txs = {input["txid"]: batch.getrawtransaction(input["txid"],True) \
+                for input, script in zip(inputs, scripts) if script is None}
         # get fee-per-1000-bytes expected for inclusion in next 2 blocks
-        if not hasattr(self,"testing"): # if in testing mode ignore estimatesmartfee call
-            feeperkb = self.service_ocean.estimatesmartfee(2)["feerate"]
+        if not hasattr(self,"testing"):
+            feeperkb = estimate.result()["feerate"]
             if feeperkb == -1: # failed to produce estimate
                 return False
         else:
-            feeperkb = float(DEFAULT_BID_FEE) # use default bid value as feeperkb value when testing
-        # estimate bid tx size
-        size = 10
-        # add inputs
-        for input in inputs:
-            # get script size
-            script_size = int(len(self.service_ocean.getrawtransaction(input["txid"],True)["vout"][input["vout"]]["scriptPubKey"]["hex"])/2)
-            if script_size == 25: # p2phk scriptPubKey
-                size+=(41+108) # scirptSig is 107 +- 1 bytes => max 108 bytes
-            elif script_size == 109: # TX_LOCKED_MULTISIG scriptPubKey
-                size+=(41+74)  # scriptSig can be 72,73 or 74 => max 74
-            else:
-                size += 150 # safe over-payment for unknown sig size
-        # add outputs
-        size += (44 + 109) + (44 + 0) # add locked output and fee output
-        if change: # if change output exists
-            size += (44 + 25) # add change output
-        return Decimal(format(feeperkb * (size / 1000), ".8g"))
+            feeperkb = DEFAULT_BID_FEE # use default bid value as feeperkb value when testing
+        for input, script in zip(inputs, scripts):
+            if script is None:
+                self.input_scripts[(input["txid"], input["vout"])] = \
+                    input_txs[input["txid"]].result()["vout"][input["vout"]]["scriptPubKey"]["hex"]
+        scripts = [bytes.fromhex(self.input_script(input["txid"], input["vout"])) for input in inputs]
+        size = bid_tx_size(scripts, change, locktime)
+        return Decimal(format(Decimal(feeperkb) * size / 1000, ".8g"))
+
+    # Select inputs for a bid on request and estimate the fee for them, the
+    # previous estimate being kept if that fails. Returns (inputs, input sum,
+    # fee), or (False, False, False) if funds are insufficient
+    def fund_bid(self, request):
+        bid_inputs, input_sum = self.coin_selection(request["auctionPrice"])
+        if not bid_inputs:
+            return False, False, False
+
+        # Calculate fee
+        change = True
+        if input_sum == request["auctionPrice"]: # if no change output
+            change = False
+        fee = self.estimate_fee(bid_inputs,change,request["endBlockHeight"])
+        if fee:
+            self.bid_fee = fee
+        return bid_inputs, input_sum, self.bid_fee
+
+    # Build and sign bid transaction without the wallet. Returns the
+    # transaction and the bid keys used, to be released if it is not sent
+    def build_local_bid(self, request, client_fee_pubkey, bid_inputs, input_sum, fee):
+        scripts = [hex_str_to_bytes(self.input_script(input["txid"], input["vout"])) for input in bid_inputs]
+        keys = self.builder.take_keys()
+        try:
+            return self.builder.build(request, bid_inputs, scripts, input_sum, client_fee_pubkey, fee, keys), keys
+        except Exception:
+            self.builder.release_keys(keys)
+            raise
+
+    # Send a locally built bid transaction signed with keys. Returns None, for
+    # the wallet to be used instead, if that fails and the keys are released.
+    def send_local_bid(self, bid_tx, bid_inputs, keys):
+        try:
+            bid_txid = self.service_ocean.sendrawtransaction(bytes_to_hex_str(bid_tx.serialize()))
+        except Exception as e:
+            self.logger.warn("Could not send locally built bid ({}). Using the wallet".format(e))
+            self.builder.release_keys(keys)
+            return None
+
+        # Import address so TX_LOCKED_MULTISIG output can be spent from
+        address = next(bytes_to_hex_str(vout.scriptPubKey) for vout in bid_tx.vout \
+            if classify_script(vout.scriptPubKey)[0] == LOCKED_MULTISIG)
+        self.service_ocean.importaddress(address,"",False)
+        if self.utxos is not None: # inputs are spent, outputs tracked once confirmed
+            self.utxos.spend([(input["txid"], input["vout"]) for input in bid_inputs],
+                [bytes_to_hex_str(vout.scriptPubKey) for vout in bid_tx.vout])
+        self.builder.prepare_keys() # replace the keys used
+
+        self.logger.info("Bid {} submitted".format(bid_txid))
+        return bid_txid
+
+    # Build and sign bids on request at each of prices within the bid limit
+    # ahead of time. Bids staged for other requests, prices or fee pubkeys
+    # and bids whose inputs have since been spent are dropped, and their keys
+    # reused.
+    def stage_bids(self, request, client_fee_pubkey, prices):
+        keys = {(request["txid"], price, client_fee_pubkey) for price in prices if price <= self.bid_limit}
+        with self.lock:
+            staged = self.staged
+            self.staged = {key: bid for key, bid in staged.items() if key in keys and self.utxos.unspent(bid[1])}
+            self.drop_staged(staged)
+            for key in keys - set(self.staged):
+                staged_request = dict(request, auctionPrice=key[1])
+                bid_inputs, input_sum, fee = self.fund_bid(staged_request)
+                if not bid_inputs:
+                    continue
+                bid_tx, bid_keys = self.build_local_bid(staged_request, client_fee_pubkey, bid_inputs, input_sum, fee)
+                self.staged[key] = (bid_tx, bid_inputs, bid_keys)
+                self.logger.info("Staged bid at price {} for request {}".format(key[1], request["txid"]))
+            self.builder.prepare_keys()
+
+    # Release the keys of bids in staged that are no longer staged
+    def drop_staged(self, staged):
+        for key, bid in staged.items():
+            if self.staged.get(key) is not bid:
+                self.builder.release_keys(bid[2])
+
+    def clear_staged(self):
+        with self.lock:
+            staged = self.staged
+            self.staged = {}
+            self.drop_staged(staged)
+
+    # Send the bid staged for request and its current auction price, if any
+    # and its inputs are unspent. Returns the bid txid or None.
+    def send_staged_bid(self, request, client_fee_pubkey):
+        with self.lock:
+            bid = self.staged.pop((request["txid"], request["auctionPrice"], client_fee_pubkey), None)
+            self.clear_staged()
+            if bid is None:
+                return None
+            if not self.utxos.unspent(bid[1]):
+                self.builder.release_keys(bid[2])
+                return None
+            return self.send_local_bid(bid[0], bid[1], bid[2])
 
     # construct, sign and send bid transaction
     def do_request_bid(self, request, client_fee_pubkey):
+        with self.lock:
+            return self.request_bid(request, client_fee_pubkey)
+
+    def request_bid(self, request, client_fee_pubkey):
         if request["startBlockHeight"] <= self.service_ocean.getblockcount():
             self.logger.warn("Too late to bid for request. Service already started")
         elif request["auctionPrice"] > self.bid_limit:
             self.logger.warn("Auction price {} too high for guardnode bid limit {}".format(request["auctionPrice"], self.bid_limit))
         else:
-            # find inputs
-            bid_inputs, input_sum = self.coin_selection(request["auctionPrice"])
+            if self.staged: # broadcast a bid signed ahead of time
+                bid_txid = self.send_staged_bid(request, client_fee_pubkey)
+                if bid_txid is not None:
+                    return bid_txid
+
+            # find inputs and fee
+            bid_inputs, input_sum, fee = self.fund_bid(request)
             if not bid_inputs:
                 return
 
-            # Calculate fee
-            change = True
-            if input_sum == request["auctionPrice"]: # if no change output
-                change = False
-            fee = self.estimate_fee(bid_inputs,change)
-            if fee:
-                self.bid_fee = fee
+            if self.builder is not None and self.builder.ready:
+                try:
+                    bid_tx, bid_keys = self.build_local_bid(request, client_fee_pubkey, bid_inputs, input_sum, fee)
+                except Exception as e:
+                    self.logger.warn("Could not build bid locally ({}). Using the wallet".format(e))
+                else:
+                    bid_txid = self.send_local_bid(bid_tx, bid_inputs, bid_keys)
+                    if bid_txid is not None:
+                        return bid_txid
 
             # find outputs
             bid_outputs = {}
@@ -116,9 +293,9 @@ class BidHandler():
             bid_outputs["pubkey"] = self.service_ocean.validateaddress(self.service_ocean.getnewaddress())["pubkey"]
             bid_outputs["feePubkey"] = client_fee_pubkey
             bid_outputs["value"] = request["auctionPrice"]
-            bid_outputs["change"] = Decimal(input_sum - request["auctionPrice"] - self.bid_fee)
+            bid_outputs["change"] = Decimal(input_sum - request["auctionPrice"] - fee)
             bid_outputs["changeAddress"] = self.service_ocean.getnewaddress()
-            bid_outputs["fee"] = self.bid_fee
+            bid_outputs["fee"] = fee
 
             # Make and sign transaction
             raw_bid_tx = self.service_ocean.createrawbidtx(bid_inputs, bid_outputs)
@@ -128,8 +305,11 @@ class BidHandler():
             bid_txid = self.service_ocean.sendrawtransaction(signed_raw_bid_tx["hex"])
 
             # Import address so TX_LOCKED_MULTISIG output can be spent from
-            address = self.service_ocean.decoderawtransaction(signed_raw_bid_tx['hex'])["vout"][0]["scriptPubKey"]["hex"]
+            bid_tx = self.service_ocean.decoderawtransaction(signed_raw_bid_tx['hex'])
+            address = bid_tx["vout"][0]["scriptPubKey"]["hex"]
             self.service_ocean.importaddress(address,"",False)
+            if self.utxos is not None: # inputs are spent, outputs tracked once confirmed
+                self.utxos.add_tx(bid_tx)
 
             self.logger.info("Bid {} submitted".format(bid_txid))
             return bid_txid
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+import base58
+import hashlib
+import logging
+import threading
+from collections import deque
+from decimal import Decimal, ROUND_UP
+from io import BytesIO
+from .signer import make_signer
+from .utxo import P2PKH, LOCKED_MULTISIG, classify_script, decode_script_num
+from .qa.tests.test_framework.util import bytes_to_hex_str, hex_str_to_bytes
+from .qa.tests.test_framework.address import byte_to_base58
+from .qa.tests.test_framework.mininode import COutPoint, CTransaction, CTxIn, CTxOut, CTxOutAsset, CTxOutValue
+from .qa.tests.test_framework.script import CScript, OP_0, SIGHASH_ALL, SignatureHash, hash160
+
+# Placeholders of the bid output script template
+LOCKTIME = "locktime"
+PUBKEY = "pubkey"
+FEE_PUBKEY = "feepubkey"
+REQUEST = "request"
+
+# Roles of bid transaction outputs
+BID_OUTPUT = "bid"
+CHANGE_OUTPUT = "change"
+FEE_OUTPUT = "fee"
+
+# Parameters of the bid built by createrawbidtx to learn the layout from.
+# The fee pubkey is the secp256k1 generator, a valid key nobody bids with.
+CALIBRATION_TXID = hashlib.sha256(b"guardnode bid calibration").hexdigest()
+CALIBRATION_LOCKTIME = 1000
+CALIBRATION_FEE_PUBKEY = "0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798"
+
+# Number of bid and change keys kept ready in the key cache
+BID_KEYS = 2
+
+# satoshi value of a CBT amount, rounded up to a whole satoshi
+def to_satoshis(amount):
+    return int(Decimal(amount).scaleb(8).quantize(Decimal(1), ROUND_UP))
+
+# Builds and signs bid transactions without the wallet. The layout of a bid -
+# output order, the TX_LOCKED_MULTISIG script, version, locktime and input
+# sequence - is learned once from a createrawbidtx call and checked by
+# rebuilding that transaction byte for byte, so bids built here are exactly
+# those the wallet would build. Signatures made here are checked by the node
+# at the same time. Bid and change keys are generated ahead of
+# time and private keys of spent outputs are cached after first use, so a bid
+# normally needs no rpc call but sendrawtransaction. Keys of bids that are
+# never sent can be put back for reuse with release_keys.
+class BidBuilder():
+    def __init__(self, ocean, backend="auto"):
+        self.logger = logging.getLogger("BidBuilder")
+        self.ocean = ocean
+        self.backend = backend
+        self.template = None
+        self.keys = {} # pubkey hash -> signer
+        self.next_keys = deque() # (bid pubkey, change script) pairs ready for use
+        self.keys_lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.template is not None
+
+    # Learn the bid transaction layout from createrawbidtx. Raises ValueError
+    # if a locally built transaction does not match or the node does not
+    # accept its signatures.
+    def calibrate(self):
+        self.prefix = self.ocean.getsidechaininfo()["addr_prefixes"]["PUBKEY_ADDRESS"]
+        self.prepare_keys()
+        pubkey, change_script = self.next_keys[0]
+        raw = self.ocean.createrawbidtx([{"txid": CALIBRATION_TXID, "vout": 0}],
+            {"endBlockHeight": CALIBRATION_LOCKTIME, "requestTxid": CALIBRATION_TXID,
+            "pubkey": bytes_to_hex_str(pubkey), "feePubkey": CALIBRATION_FEE_PUBKEY, "value": 1, "change": 2,
+            "changeAddress": byte_to_base58(change_script[3:23], self.prefix), "fee": Decimal("0.0001")})
+        tx = CTransaction()
+        tx.deserialize(BytesIO(hex_str_to_bytes(raw)))
+
+        request_key = hex_str_to_bytes(CALIBRATION_TXID)[::-1]
+        outputs = []
+        for txout in tx.vout:
+            if not txout.scriptPubKey:
+                outputs.append(FEE_OUTPUT)
+            elif txout.scriptPubKey == change_script:
+                outputs.append(CHANGE_OUTPUT)
+            else:
+                outputs.append(BID_OUTPUT)
+                script = []
+                for op in CScript(txout.scriptPubKey):
+                    number = decode_script_num(op) if isinstance(op, bytes) else op
+                    if not script and number == CALIBRATION_LOCKTIME:
+                        script.append(LOCKTIME)
+                    elif op == pubkey:
+                        script.append(PUBKEY)
+                    elif op == hex_str_to_bytes(CALIBRATION_FEE_PUBKEY):
+                        script.append(FEE_PUBKEY)
+                    elif isinstance(op, bytes) and request_key in op:
+                        start = op.index(request_key)
+                        script.append((REQUEST, op[:start], op[start + 32:]))
+                    else:
+                        script.append(op)
+        if outputs.count(BID_OUTPUT) != 1 or len(tx.vin) != 1:
+            raise ValueError("unexpected createrawbidtx outputs {}".format(outputs))
+        template = {"version": tx.nVersion, "locktime": tx.nLockTime, "sequence": tx.vin[0].nSequence,
+            "asset": tx.vout[0].nAsset.vchCommitment, "outputs": outputs, "script": script}
+
+        rebuilt = self.assemble(template, [(CALIBRATION_TXID, 0)], CALIBRATION_TXID, CALIBRATION_LOCKTIME, pubkey,
+            hex_str_to_bytes(CALIBRATION_FEE_PUBKEY), change_script, to_satoshis(1), to_satoshis(2), to_satoshis("0.0001"))
+        if rebuilt.serialize() != tx.serialize():
+            raise ValueError("locally built bid does not match createrawbidtx")
+        self.template = template
+        try:
+            self.check_signatures(pubkey, change_script)
+        except Exception:
+            self.template = None
+            raise
+        self.logger.info("Bid transactions will be built locally")
+
+    # Sign a bid spending a P2PKH and a TX_LOCKED_MULTISIG output of wallet
+    # keys and have the node verify it with signrawtransaction. Given no
+    # private keys, signrawtransaction only checks the signatures present.
+    # Raises ValueError if any is invalid.
+    def check_signatures(self, pubkey, change_script):
+        fee_pubkey = hex_str_to_bytes(CALIBRATION_FEE_PUBKEY)
+        locked_script = self.assemble(self.template, [], CALIBRATION_TXID, self.template["locktime"], pubkey,
+            fee_pubkey, change_script, 1, 0, 0).vout[self.template["outputs"].index(BID_OUTPUT)].scriptPubKey
+        scripts = [change_script, locked_script]
+        self.load_keys(scripts)
+        tx = self.assemble(self.template, [(CALIBRATION_TXID, 0), (CALIBRATION_TXID, 1)], CALIBRATION_TXID,
+            CALIBRATION_LOCKTIME, pubkey, fee_pubkey, change_script, to_satoshis(1), to_satoshis(2), to_satoshis("0.0001"))
+        self.sign(tx, scripts)
+        prevtxs = [{"txid": CALIBRATION_TXID, "vout": vout, "scriptPubKey": bytes_to_hex_str(script), "amount": 2}
+            for vout, script in enumerate(scripts)]
+        result = self.ocean.signrawtransaction(bytes_to_hex_str(tx.serialize()), prevtxs, [])
+        if not result["complete"]:
+            raise ValueError("node rejected locally signed bid: {}".format(
+                "; ".join(error["error"] for error in result.get("errors", []))))
+
+    # Generate bid and change keys ahead of use
+    def prepare_keys(self):
+        with self.keys_lock:
+            self.add_keys(BID_KEYS - len(self.next_keys))
+
+    # Generate the given number of key pairs. Called with keys_lock held
+    def add_keys(self, missing):
+        if missing <= 0:
+            return
+        with self.ocean.batch() as batch:
+            addresses = [(batch.getnewaddress(), batch.getnewaddress()) for _ in range(missing)]
+        with self.ocean.batch() as batch:
+            info = [(batch.validateaddress(bid.result()), batch.validateaddress(change.result()))
+                for bid, change in addresses]
+        for bid, change in info:
+            self.next_keys.append((hex_str_to_bytes(bid.result()["pubkey"]),
+                hex_str_to_bytes(change.result()["scriptPubKey"])))
+
+    # Pubkey hash of the key signing for an output script, or None if the
+    # script is not spendable by a single wallet key
+    def signing_key_hash(self, script):
+        script_type, _ = classify_script(script)
+        if script_type == P2PKH:
+            return script[3:23]
+        if script_type == LOCKED_MULTISIG and self.template is not None:
+            return hash160(list(CScript(script))[self.template["script"].index(PUBKEY)])
+        return None
+
+    # Fetch private keys of output scripts not already cached, in one request
+    def load_keys(self, scripts):
+        missing = {self.signing_key_hash(script) for script in scripts} - set(self.keys)
+        if None in missing:
+            raise ValueError("input not spendable with a single wallet key")
+        with self.ocean.batch() as batch:
+            privs = {key_hash: batch.dumpprivkey(byte_to_base58(key_hash, self.prefix)) for key_hash in missing}
+        for key_hash, priv in privs.items():
+            signer = make_signer(base58.b58decode(priv.result())[1:-5], self.backend)
+            if hash160(signer.get_pubkey()) != key_hash:
+                raise ValueError("wallet key does not match {}".format(bytes_to_hex_str(key_hash)))
+            self.keys[key_hash] = signer
+
+    # Unsigned bid transaction from a template. Amounts are in satoshis and a
+    # change output is only included for non zero change.
+    def assemble(self, template, inputs, request_txid, locktime, pubkey, fee_pubkey, change_script, value, change, fee):
+        request_key = hex_str_to_bytes(request_txid)[::-1]
+        bid_script = []
+        for op in template["script"]:
+            if op == LOCKTIME:
+                op = locktime
+            elif op == PUBKEY:
+                op = pubkey
+            elif op == FEE_PUBKEY:
+                op = fee_pubkey
+            elif isinstance(op, tuple):
+                op = op[1] + request_key + op[2]
+            bid_script.append(op)
+        outputs = {BID_OUTPUT: (value, CScript(bid_script)), CHANGE_OUTPUT: (change, change_script),
+            FEE_OUTPUT: (fee, b"")}
+
+        tx = CTransaction()
+        tx.nVersion = template["version"]
+        tx.nLockTime = template["locktime"]
+        tx.vin = [CTxIn(COutPoint(int(txid, 16), vout), b"", template["sequence"]) for txid, vout in inputs]
+        tx.vout = [CTxOut(CTxOutValue(outputs[role][0]), outputs[role][1], CTxOutAsset(template["asset"]))
+            for role in template["outputs"] if role != CHANGE_OUTPUT or change > 0]
+        return tx
+
+    # Take a (bid pubkey, change script) pair for a bid, generating more if
+    # none are ready
+    def take_keys(self):
+        with self.keys_lock:
+            if not self.next_keys:
+                self.add_keys(1)
+            return self.next_keys.popleft()
+
+    # Put back keys taken for a bid that was never sent
+    def release_keys(self, keys):
+        with self.keys_lock:
+            self.next_keys.appendleft(keys)
+
+    # Build and sign a bid for request spending inputs, which have the given
+    # scriptPubKeys (bytes) and sum to input_sum, with keys from take_keys.
+    # Returns the transaction.
+    def build(self, request, inputs, scripts, input_sum, fee_pubkey, fee, keys):
+        self.load_keys(scripts)
+        pubkey, change_script = keys
+        value = to_satoshis(request["auctionPrice"])
+        fee = to_satoshis(fee)
+        change = to_satoshis(input_sum) - value - fee
+        if change < 0:
+            raise ValueError("inputs do not cover bid value and fee")
+        tx = self.assemble(self.template, [(i["txid"], i["vout"]) for i in inputs], request["txid"],
+            request["endBlockHeight"], pubkey, hex_str_to_bytes(fee_pubkey), change_script, value, change, fee)
+        self.sign(tx, scripts)
+        return tx
+
+    # Sign each input of tx, spending an output with the scriptPubKey (bytes)
+    # given in scripts, with the cached wallet keys
+    def sign(self, tx, scripts):
+        for index, script in enumerate(scripts):
+            signer = self.keys[self.signing_key_hash(script)]
+            sighash, _ = SignatureHash(CScript(script), tx, index, SIGHASH_ALL)
+            sig = signer.sign(sighash) + bytes([SIGHASH_ALL])
+            if classify_script(script)[0] == P2PKH:
+                tx.vin[index].scriptSig = CScript([sig, signer.get_pubkey()])
+            else:
+                tx.vin[index].scriptSig = CScript([OP_0, sig])
@@ -1,21 +1,50 @@
 #!/usr/bin/env python3
 import logging
 import json
-import requests
 import sys
 import base58
 import math
-from time import sleep
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import accumulate
+from io import BytesIO
+from time import sleep, time
 from .daemon import DaemonThread
 from .bid import BidHandler
-from .qa.tests.test_framework.util import hex_str_rev_hex_str, bytes_to_hex_str, hex_str_to_rev_bytes
+from .builder import BidBuilder
+from .coordinator import CoordinatorClient, ResponseDispatcher
+from .notify import LongPollNotifier, ZmqNotifier, zmq
+from .mempool import MempoolWatcher
+from .response import ResponseTemplate
+from .signer import NoncePool, coincurve, make_signer
+from .stage import BidStager
+from .p2p import P2PListener, calc_txid
+from .scanner import BlockScanner
+from .utxo import UtxoTracker
+from .watcher import BlockCadence, TipWatcher
+from .metrics import BIDS, BLOCKS_SCANNED, CHALLENGES, CHALLENGE_DETECTION, PRESIGNED
+from .qa.tests.test_framework.util import hex_str_rev_hex_str, bytes_to_hex_str, hex_str_to_bytes, hex_str_to_rev_bytes
 from .qa.tests.test_framework.address import key_to_p2pkh_version, byte_to_base58
-from .qa.tests.test_framework.key import CECKey
-from .qa.tests.test_framework.authproxy import AuthServiceProxy
+from .qa.tests.test_framework.authproxy import AuthServiceProxy, RPCCache, RPCStats
+from .qa.tests.test_framework.mininode import CBlock, CTransaction
 
+# Block scanning modes: "rpc" fetches each transaction of a block separately,
+# "raw" fetches the serialized block and decodes it locally
+SCAN_MODES = ["rpc", "raw"]
 
-def connect(host, user, pw, logger):
-    conn = AuthServiceProxy("http://%s:%s@%s"% (user, pw, host))
+# Number of responded challenge txids remembered to avoid responding twice
+# when a challenge is detected both over p2p and by the block scanner
+RESPONDED_HISTORY = 100
+
+# Maximum number of responses signed ahead for challenges seen in the mempool
+PRESIGNED_SIZE = 16
+
+# cache_size: MB of immutable rpc results to cache, 0 to disable
+def connect(host, user, pw, logger, pool_size=1, cache_size=0, name=None):
+    cache = RPCCache(cache_size * 1024 * 1024) if cache_size > 0 else None
+    conn = AuthServiceProxy("http://%s:%s@%s"% (user, pw, host), pool_size=pool_size, cache=cache,
+        stats=RPCStats(name or host))
     try: # Check connection
         _ = conn.getinfo()
     except Exception as e:
@@ -30,9 +59,10 @@ def connect(host, user, pw, logger):
 # return assetid of challenge asset in given chain
 def get_challenge_asset(ocean):
     genesis_block = ocean.getblock(ocean.getblockhash(0))
-    for txid in genesis_block["tx"]:
-        tx = ocean.getrawtransaction(txid, True)
-        for vout in tx["vout"]:
+    with ocean.batch() as batch:
+        txs = [batch.getrawtransaction(txid, True) for txid in genesis_block["tx"]]
+    for tx in txs:
+        for vout in tx.result()["vout"]:
             if "assetlabel" in vout and vout["assetlabel"] == "CHALLENGE":
                 return vout["asset"]
     return False
@@ -43,10 +73,66 @@ def asset_in_block(ocean, asset, block_height):
         return None
     block = ocean.getblock(ocean.getblockhash(block_height), True)
     if "tx" in block:
-        for txid in block['tx']:
-            tx = ocean.getrawtransaction(txid, False)
-            if asset in tx:
-                return txid
+        with ocean.batch() as batch:
+            txs = [batch.getrawtransaction(txid, False) for txid in block['tx']]
+        return TxBuffer(block['tx'], [tx.result() for tx in txs]).find(asset)
+    return None
+
+# Raw transactions of a block joined into one buffer, so a block is searched
+# with a single find rather than one per transaction. Matches are mapped back
+# to their transaction by bisection of a table of where each ends, which is
+# only built once something is found. The buffer is hex, so a match is only
+# a byte match if it starts at an even offset.
+class TxBuffer():
+    def __init__(self, txids, raw_txs):
+        self.txids = txids
+        self.raw_txs = raw_txs
+        self.buffer = "".join(raw_txs)
+        self.ends = None
+
+    # txid of the first transaction containing pattern, None if not found.
+    # Matches spanning two transactions or starting mid byte are skipped.
+    def find(self, pattern):
+        pos = self.buffer.find(pattern)
+        if pos >= 0 and self.ends is None:
+            self.ends = list(accumulate(len(tx) for tx in self.raw_txs))
+        while pos >= 0:
+            index = bisect_right(self.ends, pos)
+            if pos % 2 == 0 and pos + len(pattern) <= self.ends[index]:
+                return self.txids[index]
+            pos = self.buffer.find(pattern, pos + 1)
+        return None
+
+# Find if assetid in given block. The block is fetched serialized and decoded
+# locally so that no per transaction rpc calls are required. Outputs are matched
+# on their explicit asset field. Raises ValueError if the decoded block does
+# not match its merkle root.
+def asset_in_raw_block(ocean, asset, block_height):
+    if asset == None or len(str(asset)) < 64:    # method may return true for non-assetid values (such as None or 0)
+        return None
+    raw_block = ocean.getblock(ocean.getblockhash(block_height), False)
+    block = CBlock()
+    try:
+        block.deserialize(BytesIO(hex_str_to_bytes(raw_block)))
+    except Exception as e:
+        raise ValueError("Could not decode block at height {}: {}".format(block_height, e))
+    return asset_in_decoded_block(block, asset, block_height)
+
+# Whether decoded transaction has an output of the given explicit asset
+def has_asset_output(tx, asset_commitment):
+    return any(vout.nAsset.vchCommitment == asset_commitment for vout in tx.vout)
+
+# Find if assetid in given decoded CBlock. Raises ValueError if the block does
+# not match its merkle root.
+def asset_in_decoded_block(block, asset, block_height):
+    asset_commitment = b"\x01" + hex_str_to_bytes(asset)
+    for index, tx in enumerate(block.vtx):
+        if has_asset_output(tx, asset_commitment):
+            # only pay for hashing the whole block when a match is found
+            txids = [calc_txid(tx) for tx in block.vtx]
+            if block.get_merkle_root(txids) != block.hashMerkleRoot:
+                raise ValueError("Decoded block at height {} does not match its merkle root".format(block_height))
+            return bytes_to_hex_str(txids[index][::-1])
     return None
 
 class Challenge(DaemonThread):
@@ -54,9 +140,7 @@ class Challenge(DaemonThread):
     def set_key(self, addr):
         priv = self.ocean.dumpprivkey(addr)
         decoded = base58.b58decode(priv)[1:-5] # check for compressed or not
-        self.key = CECKey()
-        self.key.set_secretbytes(decoded)
-        self.key.set_compressed(True)
+        self.key = make_signer(decoded, self.args.signer, self.nonce_pool)
 
     # given fee pubkey set corresponding challenge signing key
     def set_key_from_feepubkey(self, feepubkey):
@@ -100,16 +184,23 @@ class Challenge(DaemonThread):
     def check_for_bid_from_wallet(self):
         try:
             # check for bids in currently active request
-            bids = self.service_ocean.getrequestbids(self.request["txid"])["bids"]
+            with self.service_ocean.batch() as batch:
+                bids = batch.getrequestbids(self.request["txid"])
+                blockcount = batch.getblockcount()
+            bids = bids.result()["bids"]
 
             # Get transactions made since request tx was confirmed
-            request_age = self.service_ocean.getblockcount() - self.request["confirmedBlockHeight"] + 1 # in blocks
+            request_age = blockcount.result() - self.request["confirmedBlockHeight"] + 1 # in blocks
             txs = self.service_ocean.listunspent(0,request_age,[],True)
 
+            # Fetch all unconfirmed txs in one request
+            with self.service_ocean.batch() as batch:
+                unconfirmed = {tx["txid"]: batch.getrawtransaction(tx["txid"],True) for tx in txs if tx["confirmations"] == 0}
+
             # Search for bid tx in all txs made since request confirmed
             for tx in txs:
                 if tx["confirmations"] == 0: # check if unconfirmed tx is bid
-                    tx = self.service_ocean.getrawtransaction(tx["txid"],True)
+                    tx = unconfirmed[tx["txid"]].result()
                     # check if request txid in any tx output scriptPubKey
                     for vout in tx["vout"]:
                         if hex_str_rev_hex_str(self.request["txid"]) in vout["scriptPubKey"]["hex"]:
@@ -132,9 +223,21 @@ class Challenge(DaemonThread):
         self.args = args
         logging.getLogger("BitcoinRPC")
         self.logger = logging.getLogger("Challenge")
-        self.ocean = connect(self.args.rpchost, self.args.rpcuser, self.args.rpcpass,self.logger)
-        self.service_ocean = connect(self.args.servicerpchost, self.args.servicerpcuser, self.args.servicerpcpass,self.logger)
+        if self.args.signer == "secp256k1" and coincurve is None:
+            self.logger.error("coincurve not installed - required for libsecp256k1 signing")
+            sys.exit(1)
+        # precompute signing nonces in the background if enabled
+        self.nonce_pool = None
+        if self.args.noncepool > 0:
+            self.logger.warning("Signing with precomputed nonces is not constant time")
+            self.nonce_pool = NoncePool(self.args.noncepool, self.args.signer)
+            self.nonce_pool.start()
+        self.ocean = connect(self.args.rpchost, self.args.rpcuser, self.args.rpcpass,self.logger,self.args.rpcpoolsize,self.args.rpccachesize,"client")
+        self.service_ocean = connect(self.args.servicerpchost, self.args.servicerpcuser, self.args.servicerpcpass,self.logger,self.args.rpcpoolsize,self.args.rpccachesize,"service")
         self.no_request_msg_count = 0
+        self.last_block_height = 0
+        self.awaiting_challenge = False
+        self.in_service = False
         # if new node started give time for it to catch up
         while not hasattr(self,'genesis'):
             try:
@@ -145,6 +248,8 @@ class Challenge(DaemonThread):
                     self.logger.error("Waiting for node to sync...")
                 else: raise(e)
         self.url = "{}/challengeproof".format(self.args.challengehost)
+        self.coordinator = CoordinatorClient(self.args.challengehost)
+        self.dispatcher = ResponseDispatcher(self.coordinator, self.url, self.args.responsedeadline)
         # get challenge asset hash
         self.args.challengeasset = get_challenge_asset(self.ocean)
         try:
@@ -153,6 +258,17 @@ class Challenge(DaemonThread):
             self.logger.error("No Challenge asset found in client chain")
             sys.exit(1)
 
+        # check raw block decoding finds the challenge asset issuance in genesis
+        self.scanmode = self.args.scanmode
+        if self.scanmode == "raw":
+            try:
+                if asset_in_raw_block(self.ocean, self.rev_challengeasset, 0) != \
+                    asset_in_block(self.ocean, self.rev_challengeasset, 0):
+                    raise ValueError("Challenge asset issuance not found in decoded genesis block")
+            except Exception as e:
+                self.logger.error("Raw block scanning unavailable ({}). Falling back to rpc scanning".format(e))
+                self.scanmode = "rpc"
+
         # get address prefix
         self.nodeaddrprefix = self.ocean.getsidechaininfo()["addr_prefixes"]["PUBKEY_ADDRESS"]
         if not hasattr(self, 'nodeaddrprefix'):
@@ -186,33 +302,242 @@ class Challenge(DaemonThread):
         self.check_for_request()
         self.bid_txid = self.check_for_bid_from_wallet()
 
-        # Init bid handler
-        self.bidhandler = BidHandler(self.service_ocean, args.bidlimit)
+        # Scan client blocks concurrently with up to one worker per RPC connection
+        self.scanner = BlockScanner(self.ocean, self.scan_block, self.args.rpcpoolsize)
 
+        # Init bid handler, optionally with a local index of the wallet's
+        # CBT outputs kept current from service blocks
+        self.utxos = None
+        if self.args.utxotracker:
+            self.utxos = UtxoTracker(self.service_ocean)
+            try:
+                self.utxos.load()
+            except Exception as e:
+                self.logger.error("Could not load wallet outputs ({}). Coin selection will use the wallet".format(e))
+        self.bidbuilder = None
+        if self.args.localbids:
+            self.bidbuilder = BidBuilder(self.service_ocean, self.args.signer)
+            try:
+                self.bidbuilder.calibrate()
+            except Exception as e:
+                self.logger.error("Local bid construction unavailable ({}). Bids will be built by the wallet".format(e))
+        self.bidhandler = BidHandler(self.service_ocean, args.bidlimit, self.utxos, self.bidbuilder)
 
-    # Main loop: await request. Sub loop: run search for challenge
+        # Optionally sign bids on live requests ahead of time, to broadcast
+        # as soon as the guardnode bids
+        self.stager = None
+        if self.args.prestagebids:
+            if self.utxos is None or self.bidbuilder is None or not self.bidbuilder.ready:
+                self.logger.error("Bid staging requires --utxotracker and local bid construction. Not staging bids")
+            elif self.args.uniquebidpubkeys:
+                self.logger.error("Bid staging is not supported with --uniquebidpubkeys. Not staging bids")
+            else:
+                self.stager = BidStager(self.service_ocean, self.genesis, self.bidhandler,
+                    lambda: self.client_fee_pubkey, lambda: self.bid_txid is None)
+
+        # Independent tip watchers for each chain, driven by adaptive polling
+        # or optional ZMQ notifications. New client blocks are scanned for
+        # challenges; new service blocks wake up the main loop.
+        self.block_event = threading.Event()
+        self.scan_lock = threading.Lock()
+        self.responded = OrderedDict() # challenge txid -> block height
+        self.responded_lock = threading.Lock()
+        self.client_watcher = TipWatcher("client", self.ocean, self.on_client_block,
+            BlockCadence(self.args.clientblocktime, self.args.minpollinterval, self.args.maxpollinterval),
+            self.args.clientblocktime)
+        if self.args.p2phost is not None: # blocks pushed over p2p are checked for challenges on arrival
+            self.challenge_commitment = b"\x01" + hex_str_to_bytes(self.rev_challengeasset)
+            self.client_watcher.notifier = P2PListener(self.args.p2phost, self.args.p2pmagic,
+                self.client_watcher.event, self.on_p2p_block, self.args.compactblocks,
+                self.is_challenge_tx, self.on_p2p_challenge)
+        else:
+            self.client_watcher.notifier = self.block_notifier(self.args.zmqhashblock, self.args.longpoll,
+                self.args.rpchost, self.args.rpcuser, self.args.rpcpass, self.client_watcher.event)
+        self.service_watcher = TipWatcher("service", self.service_ocean, self.on_service_block,
+            BlockCadence(self.args.serviceblocktime, self.args.minpollinterval, self.args.maxpollinterval),
+            self.args.serviceblocktime)
+        self.service_watcher.notifier = self.block_notifier(self.args.servicezmqhashblock, self.args.servicelongpoll,
+            self.args.servicerpchost, self.args.servicerpcuser, self.args.servicerpcpass, self.service_watcher.event)
+        self.watchers = [self.client_watcher, self.service_watcher]
+
+        # Optionally watch the client mempool for challenges and sign their
+        # responses before they are mined
+        self.template = None
+        self.presigned = OrderedDict() # challenge txid -> ((bid txid, fee pubkey), response)
+        self.presign_lock = threading.Lock()
+        self.mempool_watcher = None
+        if self.args.mempoolwatch:
+            if self.args.zmqrawtx is not None and zmq is not None:
+                self.mempool_watcher = ZmqNotifier(self.args.zmqrawtx, threading.Event(), ["rawtx"])
+                self.mempool_watcher.subscribe("rawtx", self.on_raw_tx)
+            else:
+                if self.args.zmqrawtx is not None:
+                    self.logger.error("pyzmq not installed - polling the mempool instead of {}".format(self.args.zmqrawtx))
+                self.mempool_watcher = MempoolWatcher(self.ocean, self.rev_challengeasset, self.presign,
+                    self.args.minpollinterval, lambda: self.bid_txid is not None)
+
+    # Return a notifier setting event on new blocks of a chain: ZMQ if an
+    # endpoint is given, otherwise a long poll if enabled, otherwise None
+    def block_notifier(self, endpoint, longpoll, host, user, pw, event):
+        if endpoint is not None:
+            if zmq is not None:
+                return ZmqNotifier(endpoint, event)
+            self.logger.error("pyzmq not installed - ignoring ZMQ endpoint {}".format(endpoint))
+        if longpoll:
+            return LongPollNotifier("http://%s:%s@%s" % (user, pw, host), event)
+        return None
+
+    def stop(self):
+        for watcher in self.watchers:
+            watcher.stop()
+        if self.mempool_watcher is not None:
+            self.mempool_watcher.stop()
+        if self.stager is not None:
+            self.stager.stop()
+        if self.nonce_pool is not None:
+            self.nonce_pool.stop()
+        self.dispatcher.stop()
+        self.coordinator.stop()
+        self.scanner.stop()
+        super().stop()
+
+    # Log per method RPC counters and latencies for both node connections
+    def log_rpc_stats(self):
+        for conn in (self.ocean, self.service_ocean):
+            self.logger.info("RPC stats for {}:".format(conn.stats.name))
+            for line in conn.stats.summary():
+                self.logger.info("  "+line)
+            if conn.cache is not None:
+                self.logger.info("  cache: {}".format(conn.cache.stats()))
+
+    # Block until a new service block is seen or timeout seconds have passed
+    def wait_for_block(self, timeout):
+        self.block_event.wait(timeout)
+        self.block_event.clear()
+        for watcher in self.watchers:
+            if watcher.error:
+                self.error = watcher.error
+
+    # Called by the service watcher on a new service chain tip
+    def on_service_block(self, height):
+        self.update_utxos(height)
+        self.block_event.set()
+
+    # Apply new service blocks to the wallet output index, then restage bids
+    # on top of it. Coin selection falls back to the wallet until the index
+    # is reloaded if this fails.
+    def update_utxos(self, height):
+        if self.utxos is None:
+            return
+        try:
+            self.utxos.update(height)
+        except Exception as e:
+            self.logger.warning("Could not update wallet outputs: {}".format(e))
+            self.utxos.height = None
+        if self.stager is not None:
+            self.stager.event.set()
+
+    # Called by the client watcher on a new client chain tip. Blocks are only
+    # scanned while the service period of a bid is running.
+    def on_client_block(self, height):
+        if not self.in_service:
+            return
+        try:
+            self.scan_client(height)
+        except Exception as e:
+            self.logger.error(e)
+            self.error = e
+
+    # Called by the p2p listener with each client block relayed by the node.
+    # The block is checked for a challenge straight away and recorded as
+    # scanned, so the scanner the listener wakes up afterwards only fetches
+    # blocks that did not arrive over p2p.
+    def on_p2p_block(self, block):
+        if not self.in_service:
+            return
+        detected_at = time()
+        try:
+            challenge_txid = asset_in_decoded_block(block, self.rev_challengeasset, block.nHeight)
+        except ValueError as e:
+            self.logger.error(e)
+            return
+        BLOCKS_SCANNED.inc(mode="p2p")
+        if challenge_txid is not None:
+            self.on_challenge(block.nHeight, challenge_txid, detected_at, block.nTime, "p2p block")
+        with self.scan_lock:
+            self.scanner.add_scanned(block.nHeight, block.hash, "%064x" % block.hashPrevBlock)
+
+    # Whether a relayed client transaction is a challenge
+    def is_challenge_tx(self, tx):
+        return has_asset_output(tx, self.challenge_commitment)
+
+    # Called by the p2p listener when a compact block contains a challenge
+    # transaction seen in the mempool, before the block is reconstructed
+    def on_p2p_challenge(self, header, tx):
+        if not self.in_service:
+            return
+        challenge_txid = bytes_to_hex_str(calc_txid(tx)[::-1])
+        self.on_challenge(header.nHeight, challenge_txid, time(), header.nTime, "compact block")
+
+    # Scan client blocks up to height for challenges and respond to any found
+    def scan_client(self, height):
+        with self.scan_lock:
+            for block_height, challenge_txid in self.scanner.scan_to(height):
+                self.on_challenge(block_height, challenge_txid, time())
+
+    # Respond to a challenge found at block_height unless already responded to.
+    # source describes where the challenge was found, for logging.
+    def on_challenge(self, block_height, challenge_txid, detected_at, block_time=None, source="block scan"):
+        with self.responded_lock:
+            if challenge_txid in self.responded:
+                return
+            self.responded[challenge_txid] = block_height
+            while len(self.responded) > RESPONDED_HISTORY:
+                self.responded.popitem(last=False)
+        self.logger.info("Challenge found at height: {} ({})".format(block_height, source))
+        CHALLENGES.inc()
+        self.respond(challenge_txid)
+        self.observe_detection(block_height, detected_at, block_time)
+
+    # Main loop: await request and bid. Challenges are scanned for by the
+    # client watcher while the bid's service period is running.
     def run(self):
-        self.last_block_height = 0
-        # Wait for request
+        for watcher in self.watchers:
+            watcher.start()
+        if self.mempool_watcher is not None:
+            self.mempool_watcher.start()
+        if self.stager is not None:
+            self.stager.start()
+        self.coordinator.start()
+        self.dispatcher.start()
         while not self.stop_event.is_set():
-            if self.check_for_request():
-                self.no_request_msg_count = 0
-                if hasattr(self,"uniquebidpubkeys"):
-                    self.gen_feepubkey() # Gen new pubkey if required
-                if self.check_ready_for_bid():
-                    self.bid_txid = self.bidhandler.do_request_bid(self.request, self.client_fee_pubkey)
-                if self.bid_txid is not None: # bid tx sent
-                    while not self.stop_event.is_set(): # Wait for challenge on bid
-                        if not self.await_challenge():
-                            break   # request ended
-                        sleep(1) # seconds
-                else:
-                    sleep(self.args.serviceblocktime)
-            else:
-                self.no_request_msg_count += 1
-                if math.sqrt(self.no_request_msg_count).is_integer() : # gradually get more quiet
-                    self.logger.info("No active requests for genesis: {}.".format(self.genesis))
-                sleep(self.args.serviceblocktime)
+            self.wait_for_block(self.step())
+
+    # Run one iteration of the main loop and return the time to wait before
+    # the next. Awaits a challenge while a bid is active, otherwise waits for
+    # a request and bids on it.
+    def step(self):
+        if self.awaiting_challenge:
+            if self.await_challenge():
+                return self.args.serviceblocktime
+            self.awaiting_challenge = False # request ended
+        if self.check_for_request():
+            self.no_request_msg_count = 0
+            if hasattr(self,"uniquebidpubkeys"):
+                self.gen_feepubkey() # Gen new pubkey if required
+            if self.check_ready_for_bid():
+                self.bid_txid = self.bidhandler.do_request_bid(self.request, self.client_fee_pubkey)
+                if self.bid_txid is not None:
+                    BIDS.inc()
+                    self.response_template() # encode the static part of responses ahead of challenges
+            if self.bid_txid is not None: # bid tx sent - wait for challenge on bid
+                self.awaiting_challenge = True
+                return self.step()
+            return self.args.serviceblocktime
+        self.no_request_msg_count += 1
+        if math.sqrt(self.no_request_msg_count).is_integer() : # gradually get more quiet
+            self.logger.info("No active requests for genesis: {}.".format(self.genesis))
+        return self.args.serviceblocktime
 
     # look for and return active request in service chain
     def check_for_request(self):
@@ -258,43 +583,94 @@ class Challenge(DaemonThread):
                 self.logger.info("Request {} ended".format(self.request["txid"]))
                 self.request = None
                 self.bid_txid = None
+                self.in_service = False
+                with self.scan_lock:
+                    self.scanner.reset()
                 return False
             elif block_height < self.request["startBlockHeight"]:
                 self.logger.info("Request {} not started yet".format(self.request["txid"]))
-                sleep(self.args.serviceblocktime)
             elif block_height > self.last_block_height:
                 self.logger.info("Current block height: {}".format(block_height))
-                # assumes client and service chains have same block time for now
-                client_block_height = self.ocean.getblockcount()
-                challenge_txid = asset_in_block(self.ocean, self.rev_challengeasset, client_block_height)
-                if challenge_txid != None:
-                    self.logger.info("Challenge found at height: {}".format(block_height))
-                    self.respond(challenge_txid)
+                if not self.in_service: # service period started - scan current client tip
+                    self.in_service = True
+                    self.scan_client(self.ocean.getblockcount())
                 self.last_block_height = block_height
             return True
         except Exception as e:
             self.logger.error(e)
             self.error = e
 
-    # respond to challenge
-    def respond(self, challenge_txid):
-        data, headers = self.generate_response(challenge_txid)
+    # Return challenge txid if challenge asset found in client block, None otherwise
+    def scan_block(self, block_height):
+        if self.scanmode == "raw":
+            try:
+                challenge_txid = asset_in_raw_block(self.ocean, self.rev_challengeasset, block_height)
+                BLOCKS_SCANNED.inc(mode="raw")
+                return challenge_txid
+            except ValueError as e:
+                self.logger.error("{}. Falling back to rpc scanning".format(e))
+                self.scanmode = "rpc"
+        challenge_txid = asset_in_block(self.ocean, self.rev_challengeasset, block_height)
+        BLOCKS_SCANNED.inc(mode="rpc")
+        return challenge_txid
+
+    # Record time from client block timestamp to challenge detection. Called
+    # after responding to keep the extra RPC calls off the critical path.
+    def observe_detection(self, block_height, detected_at, block_time=None):
         try:
-            r = requests.post(self.url, data=data, headers=headers)
+            if block_time is None:
+                block_time = self.ocean.getblockheader(self.ocean.getblockhash(block_height))["time"]
+            CHALLENGE_DETECTION.observe(max(detected_at - block_time, 0))
         except Exception as e:
-            self.logger.error(e)
-            self.logger.error("Could not connect to coordinator to send response data:\n{}".format(data))
+            self.logger.warning("Could not get challenge block time: {}".format(e))
+
+    # Called with each raw transaction published on the ZMQ rawtx topic
+    def on_raw_tx(self, body):
+        tx = CTransaction()
+        try:
+            tx.deserialize(BytesIO(body))
+        except Exception as e:
+            self.logger.warning("Could not decode mempool transaction: {}".format(e))
             return
+        if has_asset_output(tx, b"\x01" + hex_str_to_bytes(self.rev_challengeasset)):
+            self.presign(bytes_to_hex_str(calc_txid(tx)[::-1]))
 
-        self.logger.info("Response sent\nsignature:\n{}\ntxid:\n{}".format(data[data.find("sig")+7:-2], challenge_txid))
-        if r.status_code != 200:
-            self.logger.error(r.content)
+    # Sign the response to a challenge seen in the client mempool, so that
+    # no signing is left to do once it is mined
+    def presign(self, challenge_txid):
+        bid = (self.bid_txid, self.client_fee_pubkey)
+        if bid[0] is None:
+            return
+        response = self.generate_response(challenge_txid)
+        with self.presign_lock:
+            self.presigned[challenge_txid] = (bid, response)
+            while len(self.presigned) > PRESIGNED_SIZE:
+                self.presigned.popitem(last=False)
+        self.logger.info("Challenge {} seen in mempool. Response presigned".format(challenge_txid))
 
-    def generate_response(self, challenge_txid):
-        sig_hex = bytes_to_hex_str(self.key.sign(hex_str_to_rev_bytes(challenge_txid)))
+    # respond to challenge, with the presigned response if made for the
+    # current bid
+    def respond(self, challenge_txid):
+        with self.presign_lock:
+            presigned = self.presigned.pop(challenge_txid, None)
+        if presigned is not None and presigned[0] == (self.bid_txid, self.client_fee_pubkey):
+            data, headers = presigned[1]
+            PRESIGNED.inc()
+        else:
+            data, headers = self.generate_response(challenge_txid)
+        self.dispatcher.submit(challenge_txid, data, headers)
 
-        data = '{{"txid": "{}", "pubkey": "{}", "hash": "{}", "sig": "{}"}}'.\
-        format(self.bid_txid, self.client_fee_pubkey, challenge_txid, sig_hex)
-        headers = {'content-type': 'application/json', 'Accept-Charset': 'UTF-8'}
+    # Response template for the current bid, rebuilt when the bid or fee
+    # pubkey changes
+    def response_template(self):
+        template = self.template
+        if template is None or template.key != (self.bid_txid, self.client_fee_pubkey):
+            template = ResponseTemplate(self.bid_txid, self.client_fee_pubkey)
+            self.template = template
+        return template
 
-        return data, headers
+    # Return response body bytes and headers for challenge_txid
+    def generate_response(self, challenge_txid):
+        sig = self.key.sign(hex_str_to_rev_bytes(challenge_txid))
+        template = self.response_template()
+        return template.build(challenge_txid, sig), template.headers
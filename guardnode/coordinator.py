@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+import heapq
+import logging
+import queue
+import requests
+from collections import deque
+from time import time
+from requests.adapters import HTTPAdapter
+from .daemon import DaemonThread
+from .metrics import RESPONSES, RESPONSE_LATENCY
+from .response import response_signature
+
+# Seconds allowed to open a connection to the coordinator
+COORDINATOR_CONNECT_TIMEOUT = 3.05
+
+# Seconds allowed between bytes of the coordinator response
+COORDINATOR_READ_TIMEOUT = 10
+
+# Interval (seconds) between keep-alive pings. Should be shorter than the
+# coordinator's idle connection timeout so the pooled socket stays open.
+COORDINATOR_PING_INTERVAL = 15
+
+# Maximum number of responses waiting to be dispatched
+RESPONSE_QUEUE_SIZE = 16
+
+# Initial and maximum delay (seconds) between response attempts
+RESPONSE_RETRY_DELAY = 0.5
+RESPONSE_RETRY_MAX_DELAY = 8
+
+# Number of dispatched response results kept for inspection
+RESPONSE_RESULTS_SIZE = 100
+
+# Interval (seconds) at which the dispatcher checks for stop requests
+DISPATCH_POLL_INTERVAL = 0.5
+
+# Long-lived HTTP session to the coordinator. A background thread keeps a
+# pooled connection open with periodic HEAD requests, so that DNS, TCP and TLS
+# setup are done by the ping that opens it rather than on the critical path
+# when a challenge response has to be sent.
+class CoordinatorClient(DaemonThread):
+    def __init__(self, host, connect_timeout=COORDINATOR_CONNECT_TIMEOUT,
+        read_timeout=COORDINATOR_READ_TIMEOUT, ping_interval=COORDINATOR_PING_INTERVAL):
+        super().__init__()
+        self.logger = logging.getLogger("Coordinator")
+        self.host = host
+        self.timeout = (connect_timeout, read_timeout)
+        self.ping_interval = ping_interval
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.reachable = None
+
+    def stop(self):
+        super().stop()
+        self.session.close()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.ping()
+            self.stop_event.wait(self.ping_interval)
+
+    # post data to the coordinator url over the pooled connection, optionally
+    # with a shorter read timeout
+    def post(self, url, data, headers, read_timeout=None):
+        timeout = self.timeout
+        if read_timeout is not None:
+            timeout = (timeout[0], min(timeout[1], read_timeout))
+        return self.session.post(url, data=data, headers=headers, timeout=timeout)
+
+    # open or refresh the pooled connection
+    def ping(self):
+        try:
+            self.session.head(self.host, timeout=self.timeout)
+            if not self.reachable:
+                self.logger.info("Connected to coordinator at {}".format(self.host))
+            self.reachable = True
+        except Exception as e:
+            if self.reachable is not False: # only log changes in reachability
+                self.logger.warning("Coordinator at {} unreachable: {}".format(self.host, e))
+            self.reachable = False
+
+# A challenge response waiting to be sent
+class Response():
+    def __init__(self, challenge_txid, data, headers, deadline):
+        self.challenge_txid = challenge_txid
+        self.data = data
+        self.headers = headers
+        self.created = time()
+        self.deadline = self.created + deadline
+        self.attempts = 0
+        self.delay = RESPONSE_RETRY_DELAY
+
+    def result(self, status):
+        return {"txid": self.challenge_txid, "status": status, "attempts": self.attempts,
+            "latency": time() - self.created}
+
+# Send challenge responses to the coordinator off the block scanning thread.
+# Responses are taken from a bounded queue and retried with exponential
+# backoff until sent or their deadline passes. Retries are scheduled rather
+# than slept on so a failing response does not hold up newer ones.
+class ResponseDispatcher(DaemonThread):
+    def __init__(self, coordinator, url, deadline, queue_size=RESPONSE_QUEUE_SIZE):
+        super().__init__()
+        self.logger = logging.getLogger("Dispatcher")
+        self.coordinator = coordinator
+        self.url = url
+        self.deadline = deadline
+        self.queue = queue.Queue(queue_size)
+        self.retries = [] # heap of (next attempt time, sequence, Response)
+        self.sequence = 0
+        self.results = deque(maxlen=RESPONSE_RESULTS_SIZE)
+
+    # queue response for sending. Returns False if the queue is full
+    def submit(self, challenge_txid, data, headers):
+        try:
+            self.queue.put_nowait(Response(challenge_txid, data, headers, self.deadline))
+            return True
+        except queue.Full:
+            self.logger.error("Response queue full - dropping response to challenge {}".format(challenge_txid))
+            RESPONSES.inc(result="dropped")
+            return False
+
+    def schedule(self, response, when):
+        self.sequence += 1
+        heapq.heappush(self.retries, (when, self.sequence, response))
+
+    def run(self):
+        while not self.stop_event.is_set():
+            timeout = DISPATCH_POLL_INTERVAL
+            if self.retries:
+                timeout = max(min(timeout, self.retries[0][0] - time()), 0)
+            try:
+                self.schedule(self.queue.get(timeout=timeout), 0)
+            except queue.Empty:
+                pass
+            while self.retries and self.retries[0][0] <= time() and not self.stop_event.is_set():
+                self.dispatch(heapq.heappop(self.retries)[2])
+
+    # make an attempt at sending response, rescheduling it on failure
+    def dispatch(self, response):
+        response.attempts += 1
+        try:
+            r = self.coordinator.post(self.url, response.data, response.headers,
+                read_timeout=max(response.deadline - time(), 0.1))
+        except Exception as e:
+            if response.attempts == 1:
+                self.logger.error(e)
+                self.logger.error("Could not connect to coordinator to send response data:\n{}".format(response.data.decode("utf-8")))
+            else:
+                self.logger.warning("Response attempt {} for challenge {} failed: {}".format(
+                    response.attempts, response.challenge_txid, e))
+            self.retry(response)
+            return
+
+        if r.status_code >= 500 or r.status_code == 429: # coordinator temporarily unable to accept
+            self.logger.warning("Coordinator returned {} for challenge {}".format(r.status_code, response.challenge_txid))
+            self.retry(response)
+            return
+
+        result = response.result("ok" if r.status_code == 200 else "rejected")
+        RESPONSE_LATENCY.observe(result["latency"])
+        RESPONSES.inc(result=result["status"])
+        self.results.append(result)
+        self.logger.info("Response sent\nsignature:\n{}\ntxid:\n{}".format(response_signature(response.data), response.challenge_txid))
+        if r.status_code != 200:
+            self.logger.error(r.content)
+
+    def retry(self, response):
+        when = time() + response.delay
+        if when >= response.deadline:
+            self.logger.error("Giving up on response to challenge {} after {} attempt(s)".format(
+                response.challenge_txid, response.attempts))
+            RESPONSES.inc(result="failed")
+            self.results.append(response.result("failed"))
+            return
+        response.delay = min(response.delay * 2, RESPONSE_RETRY_MAX_DELAY)
+        self.schedule(response, when)
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
+import asyncio
 import logging
+import signal
 import traceback
 from time import sleep
 from argparse import ArgumentParser
-from .challenge import Challenge
+from .challenge import Challenge, SCAN_MODES
+from .signer import SIGNERS
 from .alerts import Alerts
+from .metrics import serve_metrics
+from .aio import AsyncRuntime
 from .bid import *
 
 # Default debug log file location for ocean nodes in linux machines
@@ -16,24 +21,67 @@ CHALLENGE_HOST_DEFAULT = "http://coordinator:9999"
 # Default service block time - can be overriden for testing
 SERVICE_BLOCK_TIME_DEFAULT = 60
 
+# Default client block time
+CLIENT_BLOCK_TIME_DEFAULT = 60
+
+# Default p2p network message start bytes of the client node (regtest)
+P2P_MAGIC_DEFAULT = "fabfb5da"
+
+# Default bounds (seconds) of the adaptive chain tip polling interval
+MIN_POLL_INTERVAL_DEFAULT = 0.5
+MAX_POLL_INTERVAL_DEFAULT = 5
+
+# Default time (seconds) to keep retrying a challenge response
+RESPONSE_DEADLINE_DEFAULT = 60
+
+# Default maximum number of concurrent connections to each node's RPC server
+RPC_POOL_SIZE_DEFAULT = 4
+
+# Default size in MB of the cache of immutable RPC results for each node
+RPC_CACHE_SIZE_DEFAULT = 32
+
 def parse_args():
     parser = ArgumentParser()
     parser.add_argument('--rpchost', required=False, default="127.0.0.1:5555",type=str, help="Client RPC host")
     parser.add_argument('--rpcuser', required=False, default="", type=str, help="Client RPC username")
     parser.add_argument('--rpcpass', required=False, default="", type=str, help="Client RPC password")
+    parser.add_argument('--zmqhashblock', required=False, type=str, help="Client ZMQ hashblock endpoint, e.g. tcp://127.0.0.1:28332")
+    parser.add_argument('--longpoll', required=False, action='store_true', default=False, help="Flag to long poll the client node for new blocks instead of polling")
+    parser.add_argument('--p2phost', required=False, type=str, help="Client node p2p host to receive blocks from as a peer, e.g. 127.0.0.1:7042")
+    parser.add_argument('--p2pmagic', required=False, default=P2P_MAGIC_DEFAULT, type=str, help="Client chain p2p network magic bytes in hex")
+    parser.add_argument('--compactblocks', required=False, action='store_true', default=False, help="Flag to receive p2p blocks as compact blocks rebuilt from the relayed mempool")
+    parser.add_argument('--mempoolwatch', required=False, action='store_true', default=False, help="Flag to watch the client mempool for challenges and presign responses")
+    parser.add_argument('--zmqrawtx', required=False, type=str, help="Client ZMQ rawtx endpoint used to watch the mempool instead of polling")
+    parser.add_argument('--clientblocktime', required=False, default=CLIENT_BLOCK_TIME_DEFAULT, type=int, help="Client block time")
 
     parser.add_argument('--servicerpchost', required=False, default="127.0.0.1:6666",type=str, help="Service RPC host")
     parser.add_argument('--servicerpcuser', required=False, default="", type=str, help="Service RPC username")
     parser.add_argument('--servicerpcpass', required=False, default="", type=str, help="Service RPC password")
+    parser.add_argument('--servicezmqhashblock', required=False, type=str, help="Service ZMQ hashblock endpoint")
+    parser.add_argument('--servicelongpoll', required=False, action='store_true', default=False, help="Flag to long poll the service node for new blocks instead of polling")
     parser.add_argument('--serviceblocktime', required=False, default=SERVICE_BLOCK_TIME_DEFAULT, type=int, help="Service block time")
+    parser.add_argument('--minpollinterval', required=False, default=MIN_POLL_INTERVAL_DEFAULT, type=float, help="Minimum seconds between chain tip polls")
+    parser.add_argument('--maxpollinterval', required=False, default=MAX_POLL_INTERVAL_DEFAULT, type=float, help="Maximum seconds between chain tip polls")
+
+    parser.add_argument('--rpcpoolsize', required=False, default=RPC_POOL_SIZE_DEFAULT, type=int, help="Maximum concurrent RPC connections per node")
+    parser.add_argument('--rpccachesize', required=False, default=RPC_CACHE_SIZE_DEFAULT, type=int, help="MB of immutable RPC results cached per node, 0 to disable")
 
     parser.add_argument('--nodelogfile', required=False, type=str, default=NODE_LOG_FILE_DEFAULT, help="Node log file destination")
 
     parser.add_argument('--bidpubkey', required=False, type=str, help="Public key for Gaurdnodes fee payments")
     parser.add_argument('--bidlimit', required=False, type=float, default="0.0", help="Guardnode upper bid limit")
     parser.add_argument('--uniquebidpubkeys', required=False, action='store_true', default=False, help="Flag to indicate new bid pubkey generation for each bid")
+    parser.add_argument('--utxotracker', required=False, action='store_true', default=False, help="Flag to select bid inputs from a local index of wallet outputs kept current from service blocks")
+    parser.add_argument('--localbids', required=False, action='store_true', default=False, help="Flag to build and sign bid transactions locally rather than through the wallet")
+    parser.add_argument('--prestagebids', required=False, action='store_true', default=False, help="Flag to sign bids on live requests ahead of time, requires --utxotracker and --localbids")
 
     parser.add_argument('--challengehost', required=False, type=str, default=CHALLENGE_HOST_DEFAULT, help="Challenger host address")
+    parser.add_argument('--responsedeadline', required=False, type=float, default=RESPONSE_DEADLINE_DEFAULT, help="Seconds to keep retrying a challenge response")
+    parser.add_argument('--signer', required=False, type=str, default="auto", choices=SIGNERS, help="Challenge signing backend: libsecp256k1 (requires coincurve), OpenSSL or auto")
+    parser.add_argument('--noncepool', required=False, type=int, default=0, help="Number of signing nonces to precompute in the background, 0 to disable. Signing with them is not constant time")
+    parser.add_argument('--scanmode', required=False, type=str, default="rpc", choices=SCAN_MODES, help="Block scanning mode: per transaction rpc calls or single raw block fetch")
+    parser.add_argument('--asyncio', required=False, action='store_true', default=False, help="Run on a single asyncio event loop instead of daemon threads")
+    parser.add_argument('--metricsport', required=False, type=int, default=None, help="Port to serve Prometheus metrics on")
 
     return parser.parse_args()
 
@@ -46,6 +94,12 @@ def run_guardnode(args):
     alerts = Alerts(args)
     alerts.start()
 
+    # optionally export metrics for Prometheus scraping
+    if args.metricsport is not None:
+        serve_metrics(args.metricsport, [challenge.ocean, challenge.service_ocean],
+            {"challenge": challenge, "alerts": alerts, "dispatcher": challenge.dispatcher,
+            "client": challenge.client_watcher, "service": challenge.service_watcher})
+
     return (challenge, alerts)
 
 def main():
@@ -56,10 +110,21 @@ def main():
     )
     logger = logging.getLogger("Guardnode")
 
+    if args.asyncio:
+        try:
+            asyncio.run(AsyncRuntime(args).run())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            logger.error("KeyboardInterrupt")
+        except Exception as e:
+            logger.error(traceback.format_exc())
+        return
+
     challenge_handler = None
     alerts_handler = None
     try:
         (challenge_handler, alerts_handler) = run_guardnode(args)
+        if hasattr(signal, "SIGUSR1"): # dump RPC stats on kill -USR1
+            signal.signal(signal.SIGUSR1, lambda signum, frame: challenge_handler.log_rpc_stats())
         while True:
             if challenge_handler.error:
                 raise challenge_handler.error
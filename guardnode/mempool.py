@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import logging
+from io import BytesIO
+from .daemon import DaemonThread
+from .qa.tests.test_framework.authproxy import JSONRPCException
+from .qa.tests.test_framework.mininode import CTransaction
+from .qa.tests.test_framework.util import hex_str_to_bytes
+
+# Poll the client mempool with getrawmempool and call callback(txid) for each
+# new transaction with an output of asset, given as in serialized outputs.
+# Only the difference to the previous poll is fetched, in a single batch. Polls are skipped while active() is false.
+# Failures are logged and retried on the next poll - mempool watching only
+# gets responses ready early, blocks are still scanned for challenges.
+class MempoolWatcher(DaemonThread):
+    def __init__(self, conn, asset, callback, interval, active=None):
+        super().__init__()
+        self.logger = logging.getLogger("Mempool")
+        self.endpoint = "getrawmempool"
+        self.conn = conn
+        self.asset = asset
+        self.commitment = b"\x01" + hex_str_to_bytes(asset)
+        self.callback = callback
+        self.interval = interval
+        self.active = active
+        self.known = set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            if self.active is None or self.active():
+                try:
+                    self.poll()
+                except Exception as e:
+                    self.logger.warning("Could not poll mempool: {}".format(e))
+            else:
+                self.known = set()
+            self.stop_event.wait(self.interval)
+
+    def poll(self):
+        txids = set(self.conn.getrawmempool())
+        new = txids - self.known
+        self.known = txids
+        if not new:
+            return
+        with self.conn.batch() as batch:
+            txs = {txid: batch.getrawtransaction(txid, False) for txid in new}
+        for txid, tx in txs.items():
+            try:
+                raw = tx.result()
+            except JSONRPCException: # left the mempool since listed
+                continue
+            # only decode transactions that may pay to asset
+            if self.asset in raw and self.has_asset_output(txid, raw):
+                self.callback(txid)
+
+    def has_asset_output(self, txid, raw):
+        tx = CTransaction()
+        try:
+            tx.deserialize(BytesIO(hex_str_to_bytes(raw)))
+        except Exception as e:
+            self.logger.warning("Could not decode mempool transaction {}: {}".format(txid, e))
+            return False
+        return any(vout.nAsset.vchCommitment == self.commitment for vout in tx.vout)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from .daemon import DaemonThread
+
+# Histogram buckets (seconds) for block to challenge detection latency
+DETECTION_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+# Histogram buckets (seconds) for new chain tip detection lag
+BLOCK_LAG_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 10, 30, 60)
+
+# Histogram buckets (seconds) for coordinator response latency
+RESPONSE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Interval (seconds) at which the metrics server checks for stop requests
+METRICS_POLL_INTERVAL = 0.5
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, escape_label(v)) for k, v in labels) + "}"
+
+def format_bound(bound):
+    return "+Inf" if bound is None else repr(float(bound))
+
+# Base class of metric families. Values are kept per label set, given as
+# keyword arguments to the recording methods.
+class Metric():
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def header(self):
+        return ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+
+    def expose(self):
+        with self.lock:
+            return self.header() + ["{}{} {}".format(self.name, format_labels(labels), repr(float(value)))
+                for labels, value in sorted(self.values.items())]
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, buckets):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = ([0] * (len(self.buckets) + 1), 0.0)
+            counts, total = self.values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def expose(self):
+        with self.lock:
+            lines = self.header()
+            for labels, (counts, total) in sorted(self.values.items()):
+                lines += histogram_lines(self.name, labels, self.buckets, counts, total)
+            return lines
+
+# Exposition lines of a histogram from per bucket (non cumulative) counts with
+# an overflow bucket at the end
+def histogram_lines(name, labels, buckets, counts, total):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(list(buckets) + [None], counts):
+        cumulative += count
+        lines.append("{}_bucket{} {}".format(name,
+            format_labels(tuple(labels) + (("le", format_bound(bound)),)), cumulative))
+    lines.append("{}_sum{} {}".format(name, format_labels(labels), repr(float(total))))
+    lines.append("{}_count{} {}".format(name, format_labels(labels), cumulative))
+    return lines
+
+# Set of metrics exported together. Collectors are callables returning extra
+# exposition lines computed at scrape time.
+class Registry():
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def gauge(self, name, help):
+        return self.register(Gauge(name, help))
+
+    def histogram(self, name, help, buckets):
+        return self.register(Histogram(name, help, buckets))
+
+    def add_collector(self, collector):
+        with self.lock:
+            self.collectors.append(collector)
+
+    # report liveness of thread under name in guardnode_thread_up. Any object
+    # with is_alive() and an error attribute can be watched.
+    def watch_thread(self, name, thread):
+        with self.lock:
+            self.threads[name] = thread
+
+    def expose(self):
+        with self.lock:
+            metrics = list(self.metrics)
+            collectors = list(self.collectors)
+            threads = dict(self.threads)
+        lines = []
+        for metric in metrics:
+            lines += metric.expose()
+        lines += ["# HELP guardnode_thread_up Whether a guardnode worker thread is alive without error",
+            "# TYPE guardnode_thread_up gauge"]
+        for name, thread in sorted(threads.items()):
+            up = thread.is_alive() and not getattr(thread, "error", None)
+            lines.append("guardnode_thread_up{} {}".format(format_labels((("thread", name),)), int(up)))
+        for collector in collectors:
+            lines += collector()
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+CHALLENGE_DETECTION = REGISTRY.histogram("guardnode_challenge_detection_seconds",
+    "Time from client block timestamp to challenge detection", DETECTION_BUCKETS)
+RESPONSE_LATENCY = REGISTRY.histogram("guardnode_response_seconds",
+    "Time from challenge detection to the coordinator accepting the response", RESPONSE_BUCKETS)
+RESPONSES = REGISTRY.counter("guardnode_responses_total",
+    "Challenge responses by result (ok, rejected, failed, dropped)")
+CHALLENGES = REGISTRY.counter("guardnode_challenges_total", "Challenges detected")
+BLOCKS_SCANNED = REGISTRY.counter("guardnode_blocks_scanned_total",
+    "Client blocks scanned for challenges by scan mode")
+BLOCKS_BACKFILLED = REGISTRY.counter("guardnode_blocks_backfilled_total",
+    "Client blocks behind the tip that were scanned to fill gaps between polls")
+BLOCKS_UNSCANNED = REGISTRY.counter("guardnode_blocks_unscanned_total",
+    "Client blocks skipped because they were too far behind the tip")
+BLOCK_DETECTION_LAG = REGISTRY.histogram("guardnode_block_detection_lag_seconds",
+    "Time from block timestamp to the new tip being seen, by chain", BLOCK_LAG_BUCKETS)
+BLOCK_INTERVAL = REGISTRY.gauge("guardnode_block_interval_seconds",
+    "Moving average time between blocks used to schedule polling, by chain")
+PRESIGNED = REGISTRY.counter("guardnode_presigned_responses_total",
+    "Challenge responses signed ahead of time from the client mempool")
+REORGS = REGISTRY.counter("guardnode_reorgs_total", "Client chain reorgs detected while scanning")
+BIDS = REGISTRY.counter("guardnode_bids_total", "Bids submitted to the service chain")
+ALERT_LINES = REGISTRY.counter("guardnode_alert_lines_total",
+    "Node log lines read by the alerts thread by level (all, error)")
+
+# Collector exporting RPCStats of the given proxies, labelled by stats name
+def rpc_stats_collector(proxies):
+    def collect():
+        counters = [("calls", "guardnode_rpc_requests_total", "RPC HTTP requests by node and method"),
+            ("batched", "guardnode_rpc_batched_calls_total", "RPC calls sent within batch requests"),
+            ("errors", "guardnode_rpc_errors_total", "RPC requests and calls that failed"),
+            ("sent", "guardnode_rpc_sent_bytes_total", "RPC request bytes sent"),
+            ("received", "guardnode_rpc_received_bytes_total", "RPC response bytes received")]
+        snapshots = [(proxy.stats, proxy.stats.snapshot()) for proxy in proxies]
+        lines = []
+        for field, name, help in counters:
+            lines += ["# HELP {} {}".format(name, help), "# TYPE {} counter".format(name)]
+            for stats, snapshot in snapshots:
+                for method, entry in sorted(snapshot.items()):
+                    labels = (("method", method), ("node", stats.name))
+                    lines.append("{}{} {}".format(name, format_labels(labels), entry[field]))
+        name = "guardnode_rpc_duration_seconds"
+        lines += ["# HELP {} RPC HTTP request latency by node and method".format(name),
+            "# TYPE {} histogram".format(name)]
+        for stats, snapshot in snapshots:
+            for method, entry in sorted(snapshot.items()):
+                if entry["calls"]:
+                    lines += histogram_lines(name, (("method", method), ("node", stats.name)),
+                        stats.buckets, entry["buckets"], entry["seconds"])
+        return lines
+    return collect
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.expose().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # scrapes are not worth logging
+        pass
+
+class ThreadingMetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+# Serve registry in Prometheus text format on /metrics
+class MetricsServer(DaemonThread):
+    def __init__(self, port, host="", registry=REGISTRY):
+        super().__init__()
+        self.logger = logging.getLogger("Metrics")
+        handler = type("Handler", (MetricsHandler,), {"registry": registry})
+        self.server = ThreadingMetricsServer((host, port), handler)
+        self.logger.info("Serving metrics on port {}".format(self.server.server_address[1]))
+
+    def stop(self):
+        super().stop()
+        if self.is_alive(): # shutdown blocks until serve_forever returns
+            self.server.shutdown()
+
+    def run(self):
+        try:
+            self.server.serve_forever(poll_interval=METRICS_POLL_INTERVAL)
+        except Exception as e:
+            self.logger.error(e)
+            self.error = e
+        finally:
+            self.server.server_close()
+
+# Start a metrics server on port exporting the RPC stats of proxies and the
+# liveness of workers, a dict of name to thread (or object with is_alive())
+def serve_metrics(port, proxies, workers, registry=REGISTRY):
+    for name, worker in workers.items():
+        registry.watch_thread(name, worker)
+    registry.add_collector(rpc_stats_collector(proxies))
+    server = MetricsServer(port, registry=registry)
+    server.start()
+    return server
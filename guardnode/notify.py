@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+import logging
+import struct
+from .daemon import DaemonThread
+from .qa.tests.test_framework.authproxy import AuthServiceProxy, HTTP_TIMEOUT
+
+# pyzmq is optional - guardnode falls back to polling if it is missing
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+# Receive timeout (ms) so that the subscriber notices stop requests
+ZMQ_POLL_TIMEOUT = 100
+
+# Seconds each long poll RPC waits for a new block before returning
+LONGPOLL_TIMEOUT = 10
+
+# Seconds to wait before retrying after a notifier error, doubled on each
+# consecutive failure up to NOTIFY_MAX_RETRY_DELAY
+NOTIFY_RETRY_DELAY = 1
+NOTIFY_MAX_RETRY_DELAY = 30
+
+# Delay before the next retry after a failure, given the previous one
+def next_retry_delay(delay):
+    return min(delay * 2, NOTIFY_MAX_RETRY_DELAY) if delay else NOTIFY_RETRY_DELAY
+
+# Subscribe to ZMQ notifications published by an ocean node and set the given
+# event whenever a message arrives. Optional per topic callbacks receive the
+# message body, e.g. the block hash for "hashblock".
+class ZmqNotifier(DaemonThread):
+    def __init__(self, endpoint, event, topics=None):
+        super().__init__()
+        self.logger = logging.getLogger("Notify")
+        if zmq is None:
+            raise ImportError("pyzmq is required for ZMQ notifications")
+        self.endpoint = endpoint
+        self.event = event
+        self.topics = list(topics) if topics else ["hashblock"]
+        self.callbacks = {}
+        self.sequence = {}
+
+    # register callback(body) to be called for each message of topic
+    def subscribe(self, topic, callback):
+        if topic not in self.topics:
+            self.topics.append(topic)
+        self.callbacks[topic] = callback
+
+    # Errors are retried with backoff on a fresh socket - the polling fallback
+    # picks up blocks missed meanwhile
+    def run(self):
+        delay = 0
+        while not self.stop_event.is_set():
+            context = zmq.Context()
+            socket = context.socket(zmq.SUB)
+            try:
+                socket.setsockopt(zmq.RCVTIMEO, ZMQ_POLL_TIMEOUT)
+                for topic in self.topics:
+                    socket.setsockopt(zmq.SUBSCRIBE, topic.encode("ascii"))
+                socket.connect(self.endpoint)
+                self.logger.info("Subscribed to {} on {}".format(", ".join(self.topics), self.endpoint))
+                while not self.stop_event.is_set():
+                    try:
+                        msg = socket.recv_multipart()
+                    except zmq.Again:
+                        continue
+                    delay = 0
+                    topic = msg[0].decode("ascii")
+                    body = msg[1]
+                    if len(msg) > 2:
+                        self.check_sequence(topic, struct.unpack("<I", msg[-1])[0])
+                    if topic in self.callbacks:
+                        self.callbacks[topic](body)
+                    self.event.set()
+            except Exception as e:
+                delay = next_retry_delay(delay)
+                self.logger.warning("ZMQ notifications from {} failed: {}. Retrying in {}s".format(
+                    self.endpoint, e, delay))
+            finally:
+                socket.close()
+                context.term()
+            self.stop_event.wait(delay)
+
+    # warn on gaps in the publisher sequence number - the polling fallback will
+    # pick up anything missed
+    def check_sequence(self, topic, seq):
+        if topic in self.sequence and seq != (self.sequence[topic] + 1) & 0xffffffff:
+            self.logger.warning("Missed {} {} notification(s) from {}".format(
+                (seq - self.sequence[topic] - 1) & 0xffffffff, topic, self.endpoint))
+        self.sequence[topic] = seq
+
+# Long poll an ocean node for new blocks with waitforblockheight on a
+# dedicated RPC connection and set the given event whenever the tip advances.
+# Needs no node configuration, unlike ZMQ. Waiting on the next height rather
+# than on waitfornewblock means blocks arriving between calls are not missed.
+class LongPollNotifier(DaemonThread):
+    def __init__(self, url, event, timeout=LONGPOLL_TIMEOUT):
+        super().__init__()
+        self.logger = logging.getLogger("Notify")
+        self.endpoint = url.split("@")[-1] # host for logging, without credentials
+        self.event = event
+        self.timeout = timeout
+        # not shared - a parked long poll would block other callers
+        self.conn = AuthServiceProxy(url, timeout=timeout + HTTP_TIMEOUT)
+
+    # Errors are retried with backoff, waking the caller if the tip advanced
+    # while the connection was down
+    def run(self):
+        height = None
+        delay = 0
+        while not self.stop_event.is_set():
+            try:
+                tip = self.conn.getblockcount()
+                if height is None:
+                    self.logger.info("Long polling for blocks on {}".format(self.endpoint))
+                elif tip > height:
+                    self.event.set()
+                height = tip
+                while not self.stop_event.is_set():
+                    tip = self.conn.waitforblockheight(height + 1, self.timeout * 1000)
+                    delay = 0
+                    if tip["height"] > height:
+                        height = tip["height"]
+                        self.event.set()
+            except Exception as e:
+                delay = next_retry_delay(delay)
+                self.logger.warning("Long poll on {} failed: {}. Retrying in {}s".format(self.endpoint, e, delay))
+                self.stop_event.wait(delay)
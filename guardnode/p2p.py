@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+import asyncore
+import logging
+import socket
+import struct
+from collections import OrderedDict
+from .daemon import DaemonThread
+from .qa.tests.test_framework.util import hex_str_to_bytes
+from .qa.tests.test_framework.mininode import NodeConn, NodeConnCB, CBlock, CInv, CTransaction, HeaderAndShortIDs, \
+    BlockTransactionsRequest, msg_getdata, msg_getblocktxn, msg_sendcmpct, msg_sendheaders, msg_version, \
+    NODE_NETWORK, calculate_shortid, hash256, mininode_lock, mininode_socket_map, ser_vector, uint256_from_str
+
+# Seconds between checks of the p2p socket for stop requests
+P2P_POLL_INTERVAL = 0.1
+
+# Seconds to wait before reconnecting after the p2p connection closes
+P2P_RECONNECT_DELAY = 5
+
+# Maximum number of relayed transactions mirrored for compact block
+# reconstruction
+P2P_MEMPOOL_SIZE = 5000
+
+# Maximum number of compact blocks awaiting missing transactions
+P2P_PARTIAL_BLOCKS = 8
+
+# inv types of a transaction and a block
+MSG_TX = 1
+MSG_BLOCK = 2
+
+# Compact block versions understood: 1 has short ids of txids, 2 of wtxids
+COMPACT_VERSIONS = (1, 2)
+
+# Ocean txids are the hash of the transaction serialized without witness data
+# but, unlike bitcoin, including the (zeroed) flags byte
+def calc_txid(tx):
+    r = struct.pack("<i", tx.nVersion)
+    r += b"\x00"
+    r += ser_vector(tx.vin)
+    r += ser_vector(tx.vout)
+    r += struct.pack("<I", tx.nLockTime)
+    return hash256(r)
+
+# Hash of a transaction serialized with its witness, which short ids of
+# version 2 compact blocks are made from. The txid if there is no witness.
+def calc_wtxid(tx):
+    return hash256(tx.serialize_with_witness())
+
+# Peer connection with a configurable network magic. Set up as by NodeConn,
+# which prints to stdout on connecting, but logging to logger instead.
+class MagicNodeConn(NodeConn):
+    def __init__(self, host, port, magic, callback, logger):
+        asyncore.dispatcher.__init__(self, map=mininode_socket_map)
+        self.MAGIC_BYTES = {"guardnode": magic}
+        self.network = "guardnode"
+        self.log = logger
+        self.dstaddr = host
+        self.dstport = port
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sendbuf = b""
+        self.recvbuf = b""
+        self.ver_send = 209
+        self.ver_recv = 209
+        self.last_sent = 0
+        self.state = "connecting"
+        self.cb = callback
+        self.disconnect = False
+        self.nServices = 0
+        self.rpc = None
+
+        version = msg_version()
+        version.nServices = NODE_NETWORK
+        version.addrTo.ip = host
+        version.addrTo.port = port
+        version.addrFrom.ip = "0.0.0.0"
+        version.addrFrom.port = 0
+        self.send_message(version, True)
+        self.log.debug("Connecting to {}:{}".format(host, port))
+        try:
+            self.connect((host, port))
+        except Exception:
+            self.handle_close()
+
+# Message handlers of the p2p listener. Asks the node to announce new blocks
+# with headers and requests every announced block in full. In compact mode,
+# asks for compact blocks at the first version the node offers, which is the
+# one it prefers.
+class BlockCallback(NodeConnCB):
+    def __init__(self, listener):
+        super().__init__()
+        self.listener = listener
+
+    # as NodeConnCB.deliver, logging handler errors rather than printing them
+    def deliver(self, conn, message):
+        with mininode_lock:
+            try:
+                getattr(self, "on_" + message.command.decode("ascii"))(conn, message)
+            except Exception as e:
+                self.listener.logger.error("Error handling p2p {} message: {}".format(
+                    message.command.decode("ascii"), e))
+
+    def on_verack(self, conn, message):
+        super().on_verack(conn, message)
+        conn.send_message(msg_sendheaders())
+        self.listener.on_connected()
+
+    def on_sendcmpct(self, conn, message):
+        if self.listener.compact and self.listener.compact_version is None and message.version in COMPACT_VERSIONS:
+            request = msg_sendcmpct() # ask for new blocks to be pushed as compact blocks
+            request.announce = True
+            request.version = message.version
+            conn.send_message(request)
+            self.listener.compact_version = message.version
+            self.listener.logger.info("Receiving version {} compact blocks".format(message.version))
+
+    def on_inv(self, conn, message):
+        self.request_blocks(conn, [inv.hash for inv in message.inv if inv.type == MSG_BLOCK])
+        if self.listener.compact: # mirror the node's mempool
+            txs = [inv for inv in message.inv if inv.type == MSG_TX and inv.hash not in self.listener.mempool]
+            if txs:
+                want = msg_getdata()
+                want.inv = txs
+                conn.send_message(want)
+
+    def on_headers(self, conn, message):
+        hashes = []
+        for header in message.headers:
+            header.calc_sha256()
+            hashes.append(header.sha256)
+        self.request_blocks(conn, hashes)
+
+    def request_blocks(self, conn, hashes):
+        if hashes:
+            want = msg_getdata()
+            want.inv = [CInv(MSG_BLOCK, h) for h in hashes]
+            conn.send_message(want)
+
+    def on_block(self, conn, message):
+        self.listener.on_block(message.block)
+
+    def on_tx(self, conn, message):
+        # copied as msg_tx deserializes into a CTransaction shared by all messages
+        self.listener.on_tx(CTransaction(message.tx))
+
+    def on_cmpctblock(self, conn, message):
+        self.listener.on_compact_block(conn, HeaderAndShortIDs(message.header_and_shortids))
+
+    def on_blocktxn(self, conn, message):
+        self.listener.on_block_txn(conn, message.block_transactions)
+
+# Short ids of a compact block matched against the mempool mirror. Short ids
+# are computed lazily, walking the mirror only until every id of the block
+# has been matched, and each at most once per block.
+class ShortIdMatcher():
+    def __init__(self, k0, k1, shortids, witness, mempool):
+        self.k0 = k0
+        self.k1 = k1
+        self.witness = witness
+        self.mempool = mempool
+        self.wanted = set(shortids)
+        self.matched = {} # short id -> mirrored transaction
+        self.computed = {} # txid -> short id
+        self.remaining = iter(list(mempool.items()))
+
+    def shortid(self, txid, wtxid):
+        if txid not in self.computed:
+            self.computed[txid] = calculate_shortid(self.k0, self.k1, wtxid if self.witness else txid)
+        return self.computed[txid]
+
+    # mirrored transaction with the given short id, or None
+    def get(self, shortid):
+        while shortid not in self.matched and len(self.matched) < len(self.wanted):
+            entry = next(self.remaining, None)
+            if entry is None:
+                break
+            txid, (tx, wtxid) = entry
+            match = self.shortid(txid, wtxid)
+            if match in self.wanted:
+                self.matched[match] = tx
+        return self.matched.get(shortid)
+
+    # mirrored transaction with the given txid if its short id is in the block
+    def match_txid(self, txid):
+        entry = self.mempool.get(txid)
+        if entry is None:
+            return None
+        tx, wtxid = entry
+        match = self.shortid(txid, wtxid)
+        if match not in self.wanted:
+            return None
+        self.matched.setdefault(match, tx)
+        return tx
+
+# Connect to an ocean node as a p2p peer and receive new blocks as they are
+# relayed, without going through the RPC interface. Each decoded block is
+# passed to callback(block) and the given event is set, so that the listener
+# can stand in for a ZMQ or long poll notifier of a TipWatcher. Reconnects if
+# the connection drops.
+#
+# In compact mode (BIP152, high bandwidth) the node pushes new blocks as
+# short transaction ids, which are rebuilt from a mirror of the relayed
+# mempool. Mirrored transactions for which watch(tx) is true are matched
+# against the short ids first and passed to on_watched(header, tx), before
+# the block is reconstructed or any missing transactions fetched. Short ids
+# are only computed for mirrored transactions until every id is matched.
+class P2PListener(DaemonThread):
+    def __init__(self, host, magic, event, callback, compact=False, watch=None, on_watched=None):
+        super().__init__()
+        self.logger = logging.getLogger("P2P")
+        self.endpoint = host
+        address, _, port = host.rpartition(":")
+        self.address = address
+        self.port = int(port)
+        self.magic = hex_str_to_bytes(magic)
+        self.event = event
+        self.callback = callback
+        self.compact = compact
+        self.watch = watch
+        self.on_watched = on_watched
+        self.mempool = OrderedDict() # txid -> (relayed transaction, wtxid)
+        self.watched = {} # txid -> mirrored transaction matching watch
+        self.partial = OrderedDict() # block hash -> (block, txs, missing indexes)
+        self.compact_version = None # compact block version agreed with the node
+        self.conn = None
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.compact_version = None
+            try:
+                self.conn = MagicNodeConn(self.address, self.port, self.magic, BlockCallback(self), self.logger)
+                while self.conn.state != "closed" and not self.stop_event.is_set():
+                    asyncore.loop(P2P_POLL_INTERVAL, use_poll=True, map=mininode_socket_map, count=1)
+                if self.conn.state != "closed":
+                    self.conn.handle_close()
+            except Exception as e:
+                self.logger.error(e)
+                self.error = e
+                return
+            if not self.stop_event.is_set():
+                self.logger.warning("P2P connection to {} closed. Reconnecting in {}s".format(
+                    self.endpoint, P2P_RECONNECT_DELAY))
+                self.stop_event.wait(P2P_RECONNECT_DELAY)
+
+    def on_connected(self):
+        self.logger.info("Listening for blocks from {} over p2p".format(self.endpoint))
+
+    def on_block(self, block):
+        block.calc_sha256()
+        try:
+            self.callback(block)
+        except Exception as e:
+            self.logger.error("Error handling p2p block {}: {}".format(block.hash, e))
+        self.event.set()
+        if self.mempool: # drop mined transactions from the mirror
+            for tx in block.vtx:
+                txid = uint256_from_str(calc_txid(tx))
+                self.mempool.pop(txid, None)
+                self.watched.pop(txid, None)
+
+    def on_tx(self, tx):
+        txid = uint256_from_str(calc_txid(tx))
+        self.mempool[txid] = (tx, uint256_from_str(calc_wtxid(tx)))
+        if self.watch is not None and self.watch(tx):
+            self.watched[txid] = tx
+        while len(self.mempool) > P2P_MEMPOOL_SIZE:
+            evicted, _ = self.mempool.popitem(last=False)
+            self.watched.pop(evicted, None)
+
+    # Look for watched transactions in a compact block, then rebuild the block
+    # from the mempool mirror, requesting any transactions not in it
+    def on_compact_block(self, conn, compact):
+        header = compact.header
+        header.calc_sha256()
+        k0, k1 = compact.get_siphash_keys()
+        known = ShortIdMatcher(k0, k1, compact.shortids, self.compact_version == 2, self.mempool)
+        watched = [prefilled.tx for prefilled in compact.prefilled_txn
+            if self.watch is not None and self.watch(prefilled.tx)]
+        watched += [tx for tx in map(known.match_txid, self.watched) if tx is not None]
+        for tx in watched:
+            try:
+                self.on_watched(header, tx)
+            except Exception as e:
+                self.logger.error("Error handling watched transaction in block {}: {}".format(header.hash, e))
+
+        txs = [None] * (len(compact.shortids) + len(compact.prefilled_txn))
+        for prefilled in compact.prefilled_txn:
+            txs[prefilled.index] = prefilled.tx
+        shortid_iter = iter(compact.shortids)
+        missing = []
+        for index in range(len(txs)):
+            if txs[index] is None:
+                txs[index] = known.get(next(shortid_iter))
+                if txs[index] is None:
+                    missing.append(index)
+        block = CBlock(header)
+        self.logger.debug("Compact block {} with {} of {} transactions in the mempool mirror".format(
+            header.hash, len(txs) - len(missing), len(txs)))
+        if not missing:
+            self.complete_block(conn, block, txs)
+            return
+        self.partial[header.sha256] = (block, txs, missing)
+        while len(self.partial) > P2P_PARTIAL_BLOCKS:
+            self.partial.popitem(last=False)
+        request = msg_getblocktxn()
+        request.block_txn_request = BlockTransactionsRequest(header.sha256)
+        request.block_txn_request.from_absolute(missing)
+        conn.send_message(request)
+
+    def on_block_txn(self, conn, block_txs):
+        entry = self.partial.pop(block_txs.blockhash, None)
+        if entry is None:
+            return
+        block, txs, missing = entry
+        if len(block_txs.transactions) != len(missing):
+            self.request_block(conn, block)
+            return
+        for index, tx in zip(missing, block_txs.transactions):
+            txs[index] = tx
+        self.complete_block(conn, block, txs)
+
+    # Pass on a reconstructed block, or fetch it in full if a short id
+    # collision gave the wrong transactions
+    def complete_block(self, conn, block, txs):
+        block.vtx = txs
+        if block.get_merkle_root([calc_txid(tx) for tx in txs]) != block.hashMerkleRoot:
+            self.logger.warning("Compact block {} reconstruction failed. Fetching full block".format(block.hash))
+            self.request_block(conn, block)
+            return
+        self.logger.info("Rebuilt compact block {}".format(block.hash))
+        self.on_block(block)
+
+    def request_block(self, conn, block):
+        want = msg_getdata()
+        want.inv = [CInv(MSG_BLOCK, block.sha256)]
+        conn.send_message(want)
@@ -112,7 +112,14 @@ testScripts = [
     'initialise.py',
     'challenge.py',
     'integration.py',
-    'feepubkeymove.py'
+    'feepubkeymove.py',
+    'longpoll.py',
+    'p2p_test.py',
+    'authproxy_test.py',
+    'coordinator_test.py',
+    'asyncio_test.py',
+    'cadence_test.py',
+    'signer_test.py'
 ]
 if ENABLE_ZMQ:
     testScripts.append('zmq_test.py')
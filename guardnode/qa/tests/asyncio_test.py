@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""Test the asyncio runtime
+
+    The async RPC and coordinator clients are tested directly, then a
+    guardnode started with --asyncio bids on a request and responds to a
+    challenge. Responses go to a local stand-in coordinator which replies to
+    the first attempt with a server error.
+"""
+import asyncio
+import json
+
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import *
+from test_framework.coordinator import FakeCoordinator
+from test_framework.key import CPubKey
+from guardnode.aio import AsyncCoordinator, AsyncRPC
+from guardnode.response import ResponseTemplate
+
+
+class AsyncioTest(BitcoinTestFramework):
+
+    def __init__(self):
+        super().__init__()
+        self.setup_clean_chain = True
+        self.num_nodes = 1
+        self.extra_args = [["-txindex=1 -initialfreecoins=50000000000000", "-policycoins=50000000000000",
+    "-permissioncoinsdestination=76a914bc835aff853179fa88f2900f9003bb674e17ed4288ac",
+    "-initialfreecoinsdestination=76a914bc835aff853179fa88f2900f9003bb674e17ed4288ac",
+    "-challengecoinsdestination=76a914bc835aff853179fa88f2900f9003bb674e17ed4288ac",
+    "-debug=1"]]
+
+    def setup_network(self, split=False):
+        self.nodes = start_nodes(self.num_nodes, self.options.tmpdir, self.extra_args)
+        self.is_network_split=False
+
+    def run_test(self):
+        # init node
+        self.nodes[0].importprivkey("cTnxkovLhGbp7VRhMhGThYt8WDwviXgaVAD8DjaVa5G5DApwC6tF")
+        self.nodes[0].generate(101)
+
+        # Test AsyncRPC requests on one keep-alive connection
+        async def rpc_calls():
+            rpc = AsyncRPC(rpc_url(0))
+            try:
+                count = await rpc.getblockcount()
+                genesis = await rpc.call("getblockhash", 0)
+                try:
+                    await rpc.getblockhash(count + 1)
+                    error = None
+                except Exception as e: # JSONRPCException of the guardnode package
+                    error = e.error
+                return count, genesis, error, rpc.conn.writer is not None
+            finally:
+                rpc.close()
+        count, genesis, error, connected = asyncio.run(rpc_calls())
+        assert_equal(count, self.nodes[0].getblockcount())
+        assert_equal(genesis, self.nodes[0].getblockhash(0))
+        assert_equal(error["code"], -8) # block height out of range
+        assert(connected) # not closed by the error reply
+
+        # Test AsyncCoordinator retries server errors until accepted
+        coordinator = FakeCoordinator(statuses=[503, 500])
+        template = ResponseTemplate("11" * 32, "02" + "22" * 32)
+        data = template.build("33" * 32, b"sig")
+        async def respond(deadline):
+            client = AsyncCoordinator(asyncio.get_event_loop(), coordinator.url,
+                coordinator.url + "/challengeproof", deadline)
+            try:
+                client.submit("33" * 32, data, template.headers)
+                while not client.results:
+                    await asyncio.sleep(0.1)
+                return client.results[0]
+            finally:
+                client.stop()
+        result = asyncio.run(asyncio.wait_for(respond(10), 10))
+        assert_equal((result["status"], result["attempts"]), ("ok", 3))
+        assert_equal(len(coordinator.responses(503)), 1)
+        assert_equal(len(coordinator.responses(500)), 1)
+        assert_equal(coordinator.responses(), [json.loads(data.decode("utf-8"))])
+        assert_equal(coordinator.connections, 1) # error replies keep the connection open
+        assert_equal(coordinator.requests[0][1], "/challengeproof")
+        # and gives up at the response deadline
+        coordinator.statuses.extend([500] * 10)
+        result = asyncio.run(asyncio.wait_for(respond(1), 10))
+        assert_equal(result["status"], "failed")
+        assert_equal(len(coordinator.responses(500)), 1 + result["attempts"])
+        coordinator.stop()
+
+
+        # Test guardnode on the asyncio runtime responds to a challenge
+        coordinator = FakeCoordinator(statuses=[500])
+        guardnode = start_guardnode(self.options.tmpdir,0,["--asyncio","--challengehost",coordinator.url])
+        time.sleep(WAIT_FOR_WORK)
+        assert(GN_log_contains(self.options.tmpdir,"Connected to coordinator at "+coordinator.url))
+        assert_greater_than(coordinator.count("HEAD"), 0)
+
+        # request picked up and bid made
+        requesttxid = make_request(self.nodes[0])
+        self.nodes[0].generate(1)
+        time.sleep(WAIT_FOR_WORK)
+        assert(GN_log_contains(self.options.tmpdir,'Found request: '))
+        self.nodes[0].generate(1)
+        time.sleep(WAIT_FOR_WORK)
+        bid = self.nodes[0].getrequestbids(requesttxid)["bids"][0]
+        assert(GN_log_contains(self.options.tmpdir,"Bid "+bid["txid"]+" submitted"))
+
+        # challenge found and response retried after the server error
+        self.nodes[0].generate(10) # bring into service period
+        challengetxid = self.nodes[0].sendtoaddress(self.nodes[0].getnewaddress(),1,"","",True,"CHALLENGE")
+        self.nodes[0].generate(1)
+        time.sleep(WAIT_FOR_WORK)
+        assert(GN_log_contains(self.options.tmpdir,'Challenge found at height: '+str(self.nodes[0].getblockcount())))
+        time.sleep(WAIT_FOR_WORK)
+        assert(GN_log_contains(self.options.tmpdir,"Coordinator returned 500 for challenge "+challengetxid))
+        assert(GN_log_contains(self.options.tmpdir,"Response sent"))
+        responses = coordinator.responses()
+        assert_equal(len(responses), 1)
+        assert_equal(coordinator.responses(500), responses) # the same response was retried
+        response = responses[0]
+        assert_equal(response["hash"], challengetxid)
+        assert_equal(response["txid"], bid["txid"])
+        assert_equal(response["pubkey"], bid["feePubKey"])
+        pubkey = CPubKey(hex_str_to_bytes(response["pubkey"]))
+        assert(pubkey.verify(hex_str_to_rev_bytes(challengetxid), hex_str_to_bytes(response["sig"])))
+
+        stop_guardnode(guardnode)
+        coordinator.stop()
+
+if __name__ == '__main__':
+    AsyncioTest().main()
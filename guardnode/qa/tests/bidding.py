@@ -7,6 +7,9 @@
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import *
 from guardnode.bid import *
+from guardnode.builder import BidBuilder
+from guardnode.signer import make_signer
+from guardnode.utxo import UtxoTracker, UTXO_MAX_BLOCKS
 
 class BiddingTest(BitcoinTestFramework):
 
@@ -120,7 +123,7 @@ class BiddingTest(BitcoinTestFramework):
         outputs["value"] = 0.0001
 
         # check failure to estimate fee when not enough txs to base estimate on
-        newfee = bid_handler.estimate_fee(inputs,True)
+        newfee = bid_handler.estimate_fee(inputs,True,request["endBlockHeight"])
         assert(not newfee)
 
         # Test tx from single standard tx as input
@@ -129,7 +132,7 @@ class BiddingTest(BitcoinTestFramework):
         outputs["change"] = Decimal(format(tx["amount"] - Decimal(outputs["value"] - outputs["fee"]),".8g"))
         inputs.append({"txid":tx["txid"],"vout":tx["vout"]})
         bid_handler.testing = True
-        fee = bid_handler.estimate_fee(inputs,True) 
+        fee = bid_handler.estimate_fee(inputs,True,request["endBlockHeight"])
         rawbidtx = self.nodes[0].createrawbidtx(inputs,outputs)
         signedrawbidtx = self.nodes[0].signrawtransaction(rawbidtx)
         signedrawbidtx_size = int(len(signedrawbidtx["hex"])/2)+1
@@ -145,7 +148,7 @@ class BiddingTest(BitcoinTestFramework):
         amount = tx["amount"]
         outputs["change"] = Decimal(format(amount - Decimal(outputs["value"] - outputs["fee"]),".8g"))
         inputs.append({"txid":tx["txid"],"vout":tx["vout"]})
-        fee = bid_handler.estimate_fee(inputs,True)
+        fee = bid_handler.estimate_fee(inputs,True,request["endBlockHeight"])
         rawbidtx = self.nodes[0].createrawbidtx(inputs,outputs)
         signedrawbidtx = self.nodes[0].signrawtransaction(rawbidtx)
         signedrawbidtx_size = int(len(signedrawbidtx["hex"])/2)+1
@@ -160,7 +163,7 @@ class BiddingTest(BitcoinTestFramework):
         amount += tx["amount"]
         inputs.append({"txid":tx["txid"],"vout":tx["vout"]})
         outputs["change"] = Decimal(format(amount - Decimal(outputs["value"] - outputs["fee"]),".8g"))
-        fee = bid_handler.estimate_fee(inputs,True)
+        fee = bid_handler.estimate_fee(inputs,True,request["endBlockHeight"])
         rawbidtx = self.nodes[0].createrawbidtx(inputs,outputs)
         signedrawbidtx = self.nodes[0].signrawtransaction(rawbidtx)
         signedrawbidtx_size = int(len(signedrawbidtx["hex"])/2)+1
@@ -176,7 +179,7 @@ class BiddingTest(BitcoinTestFramework):
             amount += tx["amount"]
             inputs.append({"txid":tx["txid"],"vout":tx["vout"]})
         outputs["change"] = Decimal(format(amount - Decimal(outputs["value"] - outputs["fee"]),".8g"))
-        fee = bid_handler.estimate_fee(inputs,True)
+        fee = bid_handler.estimate_fee(inputs,True,request["endBlockHeight"])
         rawbidtx = self.nodes[0].createrawbidtx(inputs,outputs)
         signedrawbidtx = self.nodes[0].signrawtransaction(rawbidtx)
         signedrawbidtx_size = int(len(signedrawbidtx["hex"])/2)+1
@@ -186,5 +189,152 @@ class BiddingTest(BitcoinTestFramework):
         assert_greater_than(signedrawbidtx_size,fee-11) # fee in  correct range
         assert_greater_than(fee+11,signedrawbidtx_size) # fee in  correct range
 
+        # Test with end heights either side of script number length boundaries
+        inputs = [{"txid":tx["txid"],"vout":tx["vout"]} for tx in unspent if tx["solvable"]][:1]
+        amount = next(tx["amount"] for tx in unspent if tx["solvable"])
+        outputs["change"] = Decimal(format(amount - Decimal(outputs["value"] - outputs["fee"]),".8g"))
+        sizes = {}
+        for locktime in [16, 17, 127, 128, 32767, 32768, 8388607, 8388608]:
+            outputs["endBlockHeight"] = locktime
+            fee = bid_handler.estimate_fee(inputs,True,locktime)
+            rawbidtx = self.nodes[0].createrawbidtx(inputs,outputs)
+            signedrawbidtx = self.nodes[0].signrawtransaction(rawbidtx)
+            signedrawbidtx_size = int(len(signedrawbidtx["hex"])/2)+1
+            fee = float(fee)*1/float(DEFAULT_BID_FEE)*1000 # fee * 1/feeperbyte value * num. bytes in kb
+            assert_greater_than(signedrawbidtx_size,fee-3) # fee in  correct range
+            assert_greater_than(fee+3,signedrawbidtx_size) # fee in  correct range
+            sizes[locktime] = (round(fee), len(rawbidtx)//2)
+        # estimates grow with the locktime encoding exactly as unsigned bids do
+        for below, above in [(16, 17), (127, 128), (32767, 32768), (8388607, 8388608)]:
+            assert_equal(sizes[above][0] - sizes[below][0], sizes[above][1] - sizes[below][1])
+            assert_greater_than(sizes[above][0], sizes[below][0])
+        outputs["endBlockHeight"] = request["endBlockHeight"]
+
+
+        # Test UtxoTracker
+        wallet_utxos = lambda: {(u["txid"], u["vout"]) for u in self.nodes[0].listunspent(1, 9999999, [], True, "CBT")}
+        tracker = UtxoTracker(self.nodes[0])
+        tracker.load()
+        assert_equal(tracker.height, self.nodes[0].getblockcount())
+        assert_equal(set(tracker.utxos), wallet_utxos())
+        # check new confirmed outputs picked up and spent inputs removed from blocks
+        address = next(u["address"] for u in self.nodes[0].listunspent(1, 9999999, [], True, "CBT") if u["solvable"])
+        txid = self.nodes[0].sendtoaddress(address,3,"","",True,"CBT")
+        tx = self.nodes[0].getrawtransaction(txid, True)
+        tracker.add_tx(tx) # as after a wallet bid - records the change script
+        spent = [(txin["txid"], txin["vout"]) for txin in tx["vin"]]
+        self.nodes[0].generate(1)
+        tracker.update(self.nodes[0].getblockcount())
+        assert_equal(tracker.height, self.nodes[0].getblockcount())
+        assert_greater_than(tracker.height, tracker.loaded_height) # applied without reloading
+        assert((txid, next(vout["n"] for vout in tx["vout"] if vout["value"] == 3)) in tracker.utxos)
+        assert(not any(outpoint in tracker.utxos for outpoint in spent))
+        assert_equal(set(tracker.utxos), wallet_utxos())
+        # check a reorg triggers a reload
+        self.nodes[0].invalidateblock(self.nodes[0].getbestblockhash())
+        self.nodes[0].generate(2)
+        tracker.update(self.nodes[0].getblockcount())
+        assert_equal(tracker.loaded_height, self.nodes[0].getblockcount())
+        assert_equal(set(tracker.utxos), wallet_utxos())
+        # check a gap of more than UTXO_MAX_BLOCKS triggers a reload
+        self.nodes[0].generate(1)
+        tracker.update(self.nodes[0].getblockcount())
+        assert_greater_than(tracker.height, tracker.loaded_height)
+        self.nodes[0].generate(UTXO_MAX_BLOCKS + 1)
+        tracker.update(self.nodes[0].getblockcount())
+        assert_equal(tracker.loaded_height, self.nodes[0].getblockcount())
+        assert_equal(set(tracker.utxos), wallet_utxos())
+
+        # Test coin selection from the tracker matches the wallet path
+        # unlock the TX_LOCKED_MULTISIG outputs of previous bids
+        self.nodes[0].generate(max([locktime for locktime, _, _ in tracker.locked] + [self.nodes[0].getblockcount()])
+            - self.nodes[0].getblockcount() + 1)
+        tracker.update(self.nodes[0].getblockcount())
+        locked = [{"txid":txid,"vout":vout} for _, txid, vout in tracker.locked]
+        assert(locked)
+        tracker_handler = BidHandler(self.nodes[0],15,tracker)
+        wallet_handler = BidHandler(self.nodes[0],15)
+        # check TX_LOCKED_MULTISIG outputs are used first by both
+        tracker_inputs, tracker_sum = tracker_handler.coin_selection(Decimal("0.1"))
+        wallet_inputs, _ = wallet_handler.coin_selection(Decimal("0.1"))
+        assert_equal(tracker_inputs, wallet_inputs)
+        assert_equal(len(tracker_inputs), 1)
+        # check both add standard outputs covering the remainder
+        target = sum(tracker.utxos[(input["txid"], input["vout"])].amount for input in locked) + 10
+        tracker_inputs, tracker_sum = tracker_handler.coin_selection(target)
+        wallet_inputs, wallet_sum = wallet_handler.coin_selection(target)
+        assert_equal(sorted(map(str, tracker_inputs[:len(locked)])), sorted(map(str, locked)))
+        assert_equal(sorted(map(str, wallet_inputs[:len(locked)])), sorted(map(str, locked)))
+        assert_greater_than(len(tracker_inputs), len(locked))
+        assert_equal(tracker_sum, sum(tracker.utxos[(input["txid"], input["vout"])].amount for input in tracker_inputs))
+        assert_greater_than(tracker_sum, target)
+        assert_greater_than(wallet_sum, target)
+        assert({(input["txid"], input["vout"]) for input in tracker_inputs} <= wallet_utxos())
+
+
+        # Test BidBuilder bids are accepted by the node
+        builder = BidBuilder(self.nodes[0])
+        builder.calibrate()
+        assert(builder.ready)
+        requesttxid = make_request(self.nodes[0])
+        self.nodes[0].generate(1)
+        tracker.update(self.nodes[0].getblockcount())
+        request = next(request for request in self.nodes[0].getrequests() if request["txid"] == requesttxid)
+        # spend an unlocked TX_LOCKED_MULTISIG and a P2PKH output
+        _, locked_txid, locked_vout = tracker.locked[0]
+        _, txid, vout = tracker.standard[-1]
+        inputs = [{"txid":locked_txid,"vout":locked_vout}, {"txid":txid,"vout":vout}]
+        scripts = [hex_str_to_bytes(tracker.script(input["txid"], input["vout"])) for input in inputs]
+        assert_equal([classify_script(script)[0] for script in scripts], [LOCKED_MULTISIG, P2PKH])
+        input_sum = sum(tracker.utxos[(input["txid"], input["vout"])].amount for input in inputs)
+        bid_tx = builder.build(request, inputs, scripts, input_sum, pubkey, DEFAULT_BID_FEE, builder.take_keys())
+        bidtxid = self.nodes[0].sendrawtransaction(bytes_to_hex_str(bid_tx.serialize()))
+        self.nodes[0].generate(1)
+        assert(bidtxid in [bid["txid"] for bid in self.nodes[0].getrequestbids(requesttxid)["bids"]])
+        tracker.update(self.nodes[0].getblockcount())
+
+        # Test staged bids
+        handler = BidHandler(self.nodes[0],15,tracker,builder)
+        handler.testing = True
+        requesttxid = make_request(self.nodes[0])
+        self.nodes[0].generate(1)
+        tracker.update(self.nodes[0].getblockcount())
+        request = next(request for request in self.nodes[0].getrequests() if request["txid"] == requesttxid)
+        price = request["auctionPrice"]
+        handler.stage_bids(request, pubkey, [price])
+        _, staged_inputs, staged_keys = handler.staged[(requesttxid, price, pubkey)]
+        # check a price change drops the staged bid and reuses its keys
+        handler.stage_bids(request, pubkey, [price + 1])
+        assert_equal(list(handler.staged), [(requesttxid, price + 1, pubkey)])
+        assert_equal(handler.staged[(requesttxid, price + 1, pubkey)][2], staged_keys)
+        assert_equal(handler.send_staged_bid(request, pubkey), None)
+        assert_equal(handler.staged, {})
+        # check a staged bid is not sent once an input is spent
+        handler.stage_bids(request, pubkey, [price])
+        _, staged_inputs, staged_keys = handler.staged[(requesttxid, price, pubkey)]
+        spent = staged_inputs[0]
+        tracker.spend([(spent["txid"], spent["vout"])], [])
+        assert_equal(handler.send_staged_bid(request, pubkey), None)
+        # check the bid is restaged without the spent input and sent
+        handler.stage_bids(request, pubkey, [price])
+        _, staged_inputs, bid_keys = handler.staged[(requesttxid, price, pubkey)]
+        assert(spent not in staged_inputs)
+        assert_equal(bid_keys, staged_keys)
+        bidtxid = handler.send_staged_bid(request, pubkey)
+        self.nodes[0].generate(1)
+        assert(bidtxid in [bid["txid"] for bid in self.nodes[0].getrequestbids(requesttxid)["bids"]])
+        # check the keys of a staged bid the node rejects are released
+        handler.stage_bids(request, pubkey, [price])
+        staged_tx, _, staged_keys = handler.staged[(requesttxid, price, pubkey)]
+        self.nodes[0].sendrawtransaction(bytes_to_hex_str(staged_tx.serialize()))
+        self.nodes[0].generate(1) # sending it again is rejected
+        assert_equal(handler.send_staged_bid(request, pubkey), None)
+        assert_equal(builder.next_keys[0], staged_keys)
+        # check calibration fails if the node does not accept local signatures
+        bid_key, change_script = builder.next_keys[0]
+        wrong_key = make_signer(hex_str_to_bytes("11" * 32))
+        builder.keys = {key_hash: wrong_key for key_hash in builder.keys}
+        assert_raises(ValueError, builder.check_signatures, bid_key, change_script)
+
 if __name__ == '__main__':
     BiddingTest().main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""Test the block cadence model scheduling tip polls
+
+    Synthetic block timestamps are fed to BlockCadence to check that the
+    expected block time converges and that poll intervals stay within the
+    configured bounds. No node is needed.
+"""
+import random
+
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import *
+from guardnode.metrics import BLOCK_INTERVAL
+from guardnode.watcher import BlockCadence, TipWatcher, CADENCE_WINDOW_START, CADENCE_OVERDUE_LIMIT
+
+
+class CadenceTest(BitcoinTestFramework):
+
+    def __init__(self):
+        super().__init__()
+        self.setup_clean_chain = True
+        self.num_nodes = 0
+
+    def setup_network(self, split=False):
+        self.nodes = []
+        self.is_network_split=False
+
+    # assert every interval until well after the next block is due is bounded
+    def check_bounds(self, cadence):
+        for step in range(200):
+            now = cadence.last_block_time + step * cadence.expected / 40
+            interval = cadence.next_interval(now)
+            assert(cadence.min_interval <= interval <= cadence.max_interval)
+
+    def run_test(self):
+        random.seed(1)
+
+        # Test polling at the minimum interval before any block is seen
+        cadence = BlockCadence(60, 0.5, 5)
+        assert_equal(cadence.next_interval(1000), 0.5)
+
+        # Test the expected block time converges to the observed block time
+        block_time = 1000000
+        cadence.observe(block_time)
+        assert_equal(cadence.expected, 60)
+        for i in range(50):
+            block_time += 10 + random.uniform(-2, 2)
+            cadence.observe(block_time)
+            self.check_bounds(cadence)
+        assert(abs(cadence.expected - 10) < 1)
+        # and follows a change in block time
+        for i in range(50):
+            block_time += 30 + random.uniform(-2, 2)
+            cadence.observe(block_time)
+            self.check_bounds(cadence)
+        assert(abs(cadence.expected - 30) < 2)
+        # out of order timestamps are ignored
+        expected = cadence.expected
+        cadence.observe(block_time - 5)
+        cadence.observe(block_time)
+        assert_equal(cadence.expected, expected)
+        assert_equal(cadence.last_block_time, block_time)
+
+        # Test polling backs off after a block and is tight around the next
+        assert_equal(cadence.next_interval(block_time), 5)
+        window = block_time + CADENCE_WINDOW_START * cadence.expected
+        assert(abs(cadence.next_interval(window - 2) - 2) < 1e-6)
+        assert_equal(cadence.next_interval(window), 0.5)
+        assert_equal(cadence.next_interval(block_time + cadence.expected), 0.5)
+        # and backs off again once the chain looks stalled
+        stalled = block_time + (1 + CADENCE_OVERDUE_LIMIT) * cadence.expected
+        assert_equal(cadence.next_interval(stalled - 1), 0.5)
+        assert_equal(cadence.next_interval(stalled + 1), 5)
+
+        # Test intervals stay within --maxpollinterval for fast and slow chains
+        for block_time_default, mean in ((1, 1), (60, 600), (600, 5), (60, 0.2)):
+            cadence = BlockCadence(block_time_default, 0.5, 5)
+            block_time = 1000000
+            for i in range(100):
+                block_time += random.expovariate(1 / mean)
+                cadence.observe(block_time)
+                self.check_bounds(cadence)
+            assert_greater_than(cadence.expected, 0)
+
+        # Test a tip watcher updates its chain's cadence and interval metric
+        class Chain:
+            height = 10
+            times = {10: 1000000}
+            def getblockcount(self):
+                return self.height
+            def getblockhash(self, height):
+                return height
+            def getblockheader(self, height):
+                return {"time": self.times[height]}
+        chain = Chain()
+        heights = []
+        watcher = TipWatcher("test", chain, heights.append, BlockCadence(60, 0.5, 5))
+        watcher.poll()
+        watcher.poll()
+        assert_equal(heights, [10])
+        for height in range(11, 31):
+            chain.height = height
+            chain.times[height] = chain.times[height - 1] + 20
+            watcher.poll()
+        assert_equal(heights, list(range(10, 31)))
+        assert(abs(watcher.cadence.expected - 20) < 1)
+        assert_equal(BLOCK_INTERVAL.values[(("chain", "test"),)], watcher.cadence.expected)
+        assert(0.5 <= watcher.wait_time() <= 5)
+
+if __name__ == '__main__':
+    CadenceTest().main()
@@ -3,12 +3,17 @@
 """test methods of Challenge class
 
 """
+import json
 import logging
 
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import *
 from test_framework.key import CPubKey
-from guardnode.challenge import Challenge, asset_in_block
+from guardnode.challenge import Challenge, TxBuffer, asset_in_block, asset_in_raw_block
+from guardnode.mempool import MempoolWatcher
+from guardnode.metrics import BLOCKS_UNSCANNED, PRESIGNED
+from guardnode.scanner import BlockScanner
+from guardnode.response import response_signature
 
 # args object to pass into Challenge instance for testing
 class Args:
@@ -23,10 +28,31 @@ class Args:
         self.servicerpcpass = rpc_p
 
         self.challengehost = ""
+        self.responsedeadline = 60
         self.uniquebidpubkeys = False
+        self.utxotracker = False
+        self.localbids = False
+        self.prestagebids = False
         self.bidpubkey = None
         self.bidlimit = 15
         self.serviceblocktime = 1
+        self.zmqhashblock = None
+        self.longpoll = False
+        self.p2phost = None
+        self.p2pmagic = "fabfb5da"
+        self.compactblocks = False
+        self.mempoolwatch = False
+        self.zmqrawtx = None
+        self.clientblocktime = 60
+        self.minpollinterval = 0.5
+        self.maxpollinterval = 5
+        self.servicezmqhashblock = None
+        self.servicelongpoll = False
+        self.scanmode = "rpc"
+        self.signer = "auto"
+        self.noncepool = 0
+        self.rpcpoolsize = 4
+        self.rpccachesize = 32
 
 
 class ChallengeTest(BitcoinTestFramework):
@@ -181,6 +207,71 @@ class ChallengeTest(BitcoinTestFramework):
         assert_equal(asset_in_block(self.nodes[0], None, 0), None)
         assert_equal(asset_in_block(self.nodes[0], 1234, 0), None)
         assert_equal(asset_in_block(self.nodes[0], 0, 0), None)
+        # test TxBuffer matches only whole bytes within one transaction
+        buffer = TxBuffer(["a", "b", "c"], ["0011aabb", "ccdd", "ab1122"])
+        assert_equal(buffer.find("aabb"), "a")
+        assert_equal(buffer.find("ab11"), "c")
+        assert_equal(buffer.find("bbcc"), None) # crosses transactions a and b
+        assert_equal(buffer.find("11aa"), "a")
+        assert_equal(buffer.find("1aab"), None) # starts mid byte
+        buffer = TxBuffer(["a", "b"], ["0abc", "abcd"]) # odd offset match before a whole byte one
+        assert_equal(buffer.find("abcd"), "b")
+        assert_equal(buffer.find("ff"), None)
+
+
+        # Test asset_in_raw_block() matches asset_in_block()
+        for asset in assets:
+            assert_equal(asset_in_raw_block(self.nodes[0], hex_str_rev_hex_str(asset), 0),
+                asset_in_block(self.nodes[0], hex_str_rev_hex_str(asset), 0))
+            assert_equal(asset_in_raw_block(self.nodes[0], hex_str_rev_hex_str(asset), self.nodes[0].getblockcount()), None)
+        # test challenge tx found in non-genesis block
+        challengetxid = self.nodes[0].sendtoaddress(self.nodes[0].getnewaddress(),1,"","",True,"CHALLENGE")
+        self.nodes[0].generate(1)
+        assert_equal(asset_in_raw_block(self.nodes[0], challenge.rev_challengeasset, self.nodes[0].getblockcount()), challengetxid)
+        # test invalid asset argument
+        assert_equal(asset_in_raw_block(self.nodes[0], None, 0), None)
+        assert_equal(asset_in_raw_block(self.nodes[0], 1234, 0), None)
+        # test scan_block() in raw mode
+        challenge.scanmode = "raw"
+        assert_equal(challenge.scan_block(self.nodes[0].getblockcount()), challengetxid)
+        challenge.scanmode = "rpc"
+
+
+        # Test BlockScanner backfills blocks missed between scans
+        scanner = BlockScanner(self.nodes[0], challenge.scan_block, 2, max_backfill=5)
+        assert_equal(scanner.scan_to(self.nodes[0].getblockcount()), []) # first scan starts at the tip
+        self.nodes[0].generate(1)
+        challengetxid = self.nodes[0].sendtoaddress(self.nodes[0].getnewaddress(),1,"","",True,"CHALLENGE")
+        self.nodes[0].generate(1)
+        challenge_height = self.nodes[0].getblockcount()
+        self.nodes[0].generate(2)
+        assert_equal(scanner.scan_to(self.nodes[0].getblockcount()), [(challenge_height, challengetxid)])
+        assert_equal(scanner.last_height, self.nodes[0].getblockcount())
+        # a failed scan leaves the whole batch, including found challenges, to be rescanned
+        challengetxid = self.nodes[0].sendtoaddress(self.nodes[0].getnewaddress(),1,"","",True,"CHALLENGE")
+        self.nodes[0].generate(1)
+        challenge_height = self.nodes[0].getblockcount()
+        self.nodes[0].generate(1)
+        failing_height = self.nodes[0].getblockcount()
+        def failing_scan(height):
+            if height == failing_height:
+                raise ValueError("scan failed")
+            return challenge.scan_block(height)
+        scanner.scan = failing_scan
+        assert_raises(ValueError, scanner.scan_to, failing_height)
+        assert_equal(scanner.last_height, challenge_height - 1)
+        scanner.scan = challenge.scan_block
+        assert_equal(scanner.scan_to(failing_height), [(challenge_height, challengetxid)])
+        # blocks more than max_backfill behind the tip are skipped and counted
+        unscanned = BLOCKS_UNSCANNED.values.get((), 0)
+        challengetxid = self.nodes[0].sendtoaddress(self.nodes[0].getnewaddress(),1,"","",True,"CHALLENGE")
+        self.nodes[0].generate(1)
+        skipped_height = self.nodes[0].getblockcount()
+        self.nodes[0].generate(6)
+        assert_equal(scanner.scan_to(self.nodes[0].getblockcount()), [])
+        assert_equal(BLOCKS_UNSCANNED.values.get((), 0), unscanned + 2)
+        assert_equal(scanner.last_height, skipped_height + 6)
+        scanner.stop()
 
 
         # Test await_challenge()
@@ -204,9 +295,35 @@ class ChallengeTest(BitcoinTestFramework):
         assert(headers)
         # Check sig against public key
         pubkey = CPubKey(hex_str_to_bytes(challenge.client_fee_pubkey))
-        sig = data[data.find("sig")+7:-2]
+        sig = response_signature(data)
+        assert_equal(json.loads(data.decode("utf-8"))["sig"], sig)
         assert(pubkey.verify(hex_str_to_rev_bytes(requesttxid2),hex_str_to_bytes(sig)))
 
 
+        # Test challenge seen in the mempool presigned and responded to once mined
+        watcher = MempoolWatcher(challenge.ocean, challenge.rev_challengeasset, challenge.presign, args.minpollinterval)
+        watcher.poll()
+        self.nodes[0].sendtoaddress(self.nodes[0].getnewaddress(),1) # not a challenge
+        challengetxid = self.nodes[0].sendtoaddress(self.nodes[0].getnewaddress(),1,"","",True,"CHALLENGE")
+        watcher.poll()
+        assert_equal(list(challenge.presigned), [challengetxid]) # presigned response held
+        presigned_data = challenge.presigned[challengetxid][1][0]
+        assert(challenge.dispatcher.queue.empty()) # and not sent before mined
+        presigned = PRESIGNED.values.get((), 0)
+        self.nodes[0].generate(1)
+        challenge.scanner.reset()
+        challenge.scan_client(self.nodes[0].getblockcount())
+        response = challenge.dispatcher.queue.get_nowait()
+        assert_equal(response.challenge_txid, challengetxid)
+        assert_equal(response.data, presigned_data) # presigned response sent
+        assert_equal(PRESIGNED.values.get((), 0), presigned + 1)
+        assert_equal(len(challenge.presigned), 0)
+        # Check challenge not responded to twice
+        challenge.on_challenge(self.nodes[0].getblockcount(), challengetxid, time.time())
+        assert(challenge.dispatcher.queue.empty())
+        watcher.poll()
+        assert_equal(len(challenge.presigned), 0)
+
+
 if __name__ == '__main__':
     ChallengeTest().main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+"""Test the coordinator session
+
+    Responses are posted to a local stand-in coordinator to check that they
+    reuse the connection opened by pings, that timeouts apply and that
+    pings track the coordinator's reachability. No node is needed.
+"""
+import logging
+import requests
+
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import *
+from test_framework.coordinator import FakeCoordinator
+from guardnode.coordinator import CoordinatorClient, COORDINATOR_CONNECT_TIMEOUT
+from guardnode.response import RESPONSE_HEADERS
+
+
+# log handler keeping the messages logged
+class LogRecorder(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class CoordinatorTest(BitcoinTestFramework):
+
+    def __init__(self):
+        super().__init__()
+        self.setup_clean_chain = True
+        self.num_nodes = 0
+
+    def setup_network(self, split=False):
+        self.nodes = []
+        self.is_network_split=False
+
+    def run_test(self):
+        coordinator = FakeCoordinator()
+        url = coordinator.url + "/challengeproof"
+        client = CoordinatorClient(coordinator.url, read_timeout=1)
+        log = LogRecorder()
+        client.logger.addHandler(log)
+        client.logger.setLevel(logging.INFO)
+
+        # Test responses are sent on the connection opened by a ping
+        client.ping()
+        assert(client.reachable)
+        assert_equal(coordinator.count("HEAD"), 1)
+        for i in range(3):
+            assert_equal(client.post(url, '{{"n": {}}}'.format(i), RESPONSE_HEADERS).status_code, 200)
+            client.ping()
+        assert_equal([response["n"] for response in coordinator.responses()], [0, 1, 2])
+        assert_equal(coordinator.count("HEAD"), 4)
+        assert_equal(coordinator.connections, 1)
+        assert_equal(coordinator.requests[1][1], "/challengeproof")
+
+        # Test the connect and read timeouts
+        assert_equal(client.timeout, (COORDINATOR_CONNECT_TIMEOUT, 1))
+        coordinator.delay = 2
+        start = time.time()
+        assert_raises(requests.exceptions.ReadTimeout, client.post, url, "{}", RESPONSE_HEADERS)
+        assert(time.time() - start < 1.9)
+        # a shorter read timeout applies to a single response
+        start = time.time()
+        assert_raises(requests.exceptions.ReadTimeout, client.post, url, "{}", RESPONSE_HEADERS, read_timeout=0.2)
+        assert(time.time() - start < 0.9)
+        # and a longer one does not extend the session's
+        start = time.time()
+        assert_raises(requests.exceptions.ReadTimeout, client.post, url, "{}", RESPONSE_HEADERS, read_timeout=10)
+        assert(time.time() - start < 1.9)
+        coordinator.delay = 0
+        # the timed out connections are replaced
+        assert_equal(client.post(url, "{}", RESPONSE_HEADERS).status_code, 200)
+
+        # Test pings log changes in reachability once
+        port = coordinator.server_address[1]
+        coordinator.stop()
+        client.ping()
+        assert_equal(client.reachable, False)
+        client.ping()
+        assert_equal(len([message for message in log.messages if "unreachable" in message]), 1)
+        coordinator = FakeCoordinator(port=port)
+        client.ping()
+        assert(client.reachable)
+        assert_equal(len([message for message in log.messages if message.startswith("Connected")]), 2)
+        assert_equal(coordinator.connections, 1)
+
+        # Test the client thread pings every ping interval until stopped
+        client.ping_interval = 0.2
+        client.start()
+        time.sleep(1)
+        client.stop()
+        client.join(1)
+        assert(not client.is_alive())
+        pings = coordinator.count("HEAD")
+        assert_greater_than(pings, 3)
+        assert_equal(coordinator.connections, 1)
+        time.sleep(0.5)
+        assert_equal(coordinator.count("HEAD"), pings)
+
+        coordinator.stop()
+
+if __name__ == '__main__':
+    CoordinatorTest().main()
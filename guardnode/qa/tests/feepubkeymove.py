@@ -20,10 +20,31 @@ class Args:
         self.servicerpcpass = rpc_p
 
         self.challengehost = ""
+        self.responsedeadline = 60
         self.uniquebidpubkeys = False
+        self.utxotracker = False
+        self.localbids = False
+        self.prestagebids = False
         self.bidpubkey = None
         self.bidlimit = 15
         self.serviceblocktime = 1
+        self.zmqhashblock = None
+        self.longpoll = False
+        self.p2phost = None
+        self.p2pmagic = "fabfb5da"
+        self.compactblocks = False
+        self.mempoolwatch = False
+        self.zmqrawtx = None
+        self.clientblocktime = 60
+        self.minpollinterval = 0.5
+        self.maxpollinterval = 5
+        self.servicezmqhashblock = None
+        self.servicelongpoll = False
+        self.scanmode = "rpc"
+        self.signer = "auto"
+        self.noncepool = 0
+        self.rpcpoolsize = 4
+        self.rpccachesize = 32
 
 class feepubkeyMoveTest(BitcoinTestFramework):
 
@@ -7,6 +7,7 @@
 
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import *
+import urllib.request
 
 
 class IntegrationTest(BitcoinTestFramework):
@@ -89,7 +90,8 @@ class IntegrationTest(BitcoinTestFramework):
 
         # Test fresh bidpubkeys used each bid when uniquebidpubkeys flag provided
         stop_guardnode(guardnode)
-        guardnode = start_guardnode(self.options.tmpdir,0,["--uniquebidpubkeys"])
+        metricsport = p2p_port(MAX_NODES)
+        guardnode = start_guardnode(self.options.tmpdir,0,["--uniquebidpubkeys","--metricsport",str(metricsport)])
         time.sleep(WAIT_FOR_WORK) # allow set up time
         # make 3 bids on seperate requests and store
         bids = []
@@ -115,6 +117,14 @@ class IntegrationTest(BitcoinTestFramework):
         time.sleep(WAIT_FOR_WORK)
         assert(GN_log_contains(self.options.tmpdir,'Could not connect to coordinator to send response data:'))
 
+        # Check metrics exported
+        metrics = urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(metricsport)).read().decode()
+        assert('guardnode_challenges_total 1.0' in metrics)
+        assert('guardnode_thread_up{thread="dispatcher"} 1' in metrics)
+        assert('guardnode_bids_total 3.0' in metrics)
+        assert('guardnode_thread_up{thread="challenge"} 1' in metrics)
+        assert('guardnode_rpc_requests_total{method="getblockcount",node="service"}' in metrics)
+
         # Check GN continues to watch request after challenge response
         self.nodes[0].generate(1)
         time.sleep(WAIT_FOR_WORK)
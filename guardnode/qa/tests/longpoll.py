@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+"""Test guardnode driven by long poll block notifications
+
+    Client and service block times and the maximum poll interval are set far
+    above the test duration so that any progress made by the guardnode must be
+    triggered by waitforblockheight long polls returning.
+"""
+
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import *
+
+
+class LongPollTest(BitcoinTestFramework):
+
+    def __init__(self):
+        super().__init__()
+        self.setup_clean_chain = True
+        self.num_nodes = 1
+        self.extra_args = [["-txindex=1 -initialfreecoins=50000000000000", "-policycoins=50000000000000",
+    "-permissioncoinsdestination=76a914bc835aff853179fa88f2900f9003bb674e17ed4288ac",
+    "-initialfreecoinsdestination=76a914bc835aff853179fa88f2900f9003bb674e17ed4288ac",
+    "-challengecoinsdestination=76a914bc835aff853179fa88f2900f9003bb674e17ed4288ac",
+    "-debug=1"]]
+
+    def setup_network(self, split=False):
+        self.nodes = start_nodes(self.num_nodes, self.options.tmpdir, self.extra_args)
+        self.is_network_split=False
+
+    def run_test(self):
+        # init node
+        self.nodes[0].importprivkey("cTnxkovLhGbp7VRhMhGThYt8WDwviXgaVAD8DjaVa5G5DApwC6tF")
+        self.nodes[0].generate(101)
+
+        # start guardnode with block times longer than the test
+        guardnode = start_guardnode(self.options.tmpdir,0,["--serviceblocktime","600","--clientblocktime","600",
+            "--maxpollinterval","600","--longpoll","--servicelongpoll"])
+        time.sleep(WAIT_FOR_WORK)
+        assert(GN_log_contains(self.options.tmpdir,"Long polling for blocks on 127.0.0.1:"+str(rpc_port(0))))
+
+        # Test request picked up and bid made on long poll
+        requesttxid = make_request(self.nodes[0])
+        self.nodes[0].generate(1)
+        time.sleep(WAIT_FOR_WORK)
+        assert(GN_log_contains(self.options.tmpdir,'Found request: '))
+        self.nodes[0].generate(1)
+        time.sleep(WAIT_FOR_WORK)
+        bid = self.nodes[0].getrequestbids(requesttxid)["bids"][0]
+        assert(GN_log_contains(self.options.tmpdir,"Bid "+bid["txid"]+" submitted"))
+
+        # Test challenge found on long poll
+        self.nodes[0].generate(10) # bring into service period
+        self.nodes[0].sendtoaddress(self.nodes[0].getnewaddress(),1,"","",True,"CHALLENGE")
+        self.nodes[0].generate(1)
+        time.sleep(WAIT_FOR_WORK)
+        assert(GN_log_contains(self.options.tmpdir,'Challenge found at height: '+str(self.nodes[0].getblockcount())))
+
+        stop_guardnode(guardnode)
+
+if __name__ == '__main__':
+    LongPollTest().main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""Test guardnode receiving client blocks over p2p
+
+    The client block time and the maximum poll interval are set far above the
+    test duration so that challenges must be found in blocks relayed to the
+    guardnode's p2p connection, first as full blocks and then as compact
+    blocks. Service blocks are picked up by long polling.
+"""
+
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import *
+
+RELAY_WAIT = 15 # sleep to allow a transaction to be relayed to the guardnode as an inbound peer
+
+
+class P2PTest(BitcoinTestFramework):
+
+    def __init__(self):
+        super().__init__()
+        self.setup_clean_chain = True
+        self.num_nodes = 1
+        self.extra_args = [["-txindex=1 -initialfreecoins=50000000000000", "-policycoins=50000000000000",
+    "-permissioncoinsdestination=76a914bc835aff853179fa88f2900f9003bb674e17ed4288ac",
+    "-initialfreecoinsdestination=76a914bc835aff853179fa88f2900f9003bb674e17ed4288ac",
+    "-challengecoinsdestination=76a914bc835aff853179fa88f2900f9003bb674e17ed4288ac",
+    "-debug=1"]]
+
+    def setup_network(self, split=False):
+        self.nodes = start_nodes(self.num_nodes, self.options.tmpdir, self.extra_args)
+        self.is_network_split=False
+
+    # make a request, wait for the guardnode to bid on it and bring it into
+    # its service period
+    def bid_into_service(self):
+        requesttxid = make_request(self.nodes[0])
+        self.nodes[0].generate(1)
+        time.sleep(WAIT_FOR_WORK)
+        self.nodes[0].generate(1)
+        time.sleep(WAIT_FOR_WORK)
+        bid = self.nodes[0].getrequestbids(requesttxid)["bids"][0]
+        assert(GN_log_contains(self.options.tmpdir,"Bid "+bid["txid"]+" submitted"))
+        self.nodes[0].generate(10)
+        time.sleep(WAIT_FOR_WORK)
+        return requesttxid
+
+    def run_test(self):
+        # init node
+        self.nodes[0].importprivkey("cTnxkovLhGbp7VRhMhGThYt8WDwviXgaVAD8DjaVa5G5DApwC6tF")
+        self.nodes[0].generate(101)
+        p2phost = "127.0.0.1:"+str(p2p_port(0))
+        args = ["--serviceblocktime","600","--clientblocktime","600","--maxpollinterval","600",
+            "--servicelongpoll","--p2phost",p2phost]
+
+        # start guardnode connected to the node as a p2p peer
+        guardnode = start_guardnode(self.options.tmpdir,0,args)
+        time.sleep(WAIT_FOR_WORK)
+        assert(GN_log_contains(self.options.tmpdir,"Listening for blocks from "+p2phost+" over p2p"))
+        requesttxid = self.bid_into_service()
+
+        # Test challenge found in and answered from a block relayed over p2p
+        self.nodes[0].sendtoaddress(self.nodes[0].getnewaddress(),1,"","",True,"CHALLENGE")
+        self.nodes[0].generate(1)
+        time.sleep(WAIT_FOR_WORK)
+        assert(GN_log_contains(self.options.tmpdir,
+            'Challenge found at height: '+str(self.nodes[0].getblockcount())+' (p2p block)'))
+        assert(not GN_log_contains(self.options.tmpdir,'Error handling p2p'))
+
+        # end the request and restart guardnode receiving compact blocks
+        self.nodes[0].generate(10)
+        time.sleep(WAIT_FOR_WORK)
+        assert(GN_log_contains(self.options.tmpdir,"Request "+requesttxid+" ended"))
+        stop_guardnode(guardnode)
+        guardnode = start_guardnode(self.options.tmpdir,0,args+["--compactblocks"])
+        time.sleep(WAIT_FOR_WORK)
+        assert(GN_log_contains(self.options.tmpdir,"Listening for blocks from "+p2phost+" over p2p"))
+        assert(GN_log_contains(self.options.tmpdir,"Receiving version"))
+        self.bid_into_service()
+
+        # Test compact blocks received and rebuilt from the mirrored mempool
+        self.nodes[0].sendtoaddress(self.nodes[0].getnewaddress(),1)
+        time.sleep(RELAY_WAIT)
+        self.nodes[0].generate(1)
+        time.sleep(WAIT_FOR_WORK)
+        assert(GN_log_contains(self.options.tmpdir,"Rebuilt compact block "+self.nodes[0].getbestblockhash()))
+
+        # Test challenge seen in the mempool found in a compact block
+        self.nodes[0].sendtoaddress(self.nodes[0].getnewaddress(),1,"","",True,"CHALLENGE")
+        time.sleep(RELAY_WAIT)
+        self.nodes[0].generate(1)
+        time.sleep(WAIT_FOR_WORK)
+        assert(GN_log_contains(self.options.tmpdir,
+            'Challenge found at height: '+str(self.nodes[0].getblockcount())+' (compact block)'))
+        assert(GN_log_contains(self.options.tmpdir,"Rebuilt compact block "+self.nodes[0].getbestblockhash()))
+        assert(not GN_log_contains(self.options.tmpdir,'reconstruction failed'))
+        assert(not GN_log_contains(self.options.tmpdir,'Error handling p2p'))
+
+        stop_guardnode(guardnode)
+
+if __name__ == '__main__':
+    P2PTest().main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""Test challenge signers
+
+    Signatures of each signing backend, with and without a nonce pool, are
+    checked to be strict DER, low S and valid for the signer's public key.
+    A guardnode signing with a nonce pool then responds to challenges sent to
+    a local stand-in coordinator which rejects invalid or high S signatures.
+"""
+import os
+
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import *
+from test_framework.coordinator import FakeCoordinator
+from test_framework.key import CPubKey, SECP256K1_ORDER, SECP256K1_ORDER_HALF
+from guardnode.signer import NoncePool, Secp256k1Signer, coincurve, der_signature, make_signer
+
+# (r, s) of a strict DER encoded signature, or None if not strict DER
+def decode_der(sig):
+    def der_int(data):
+        if len(data) < 2 or data[0] != 0x02 or len(data) < 2 + data[1]:
+            return None, None
+        value = data[2:2 + data[1]]
+        if not value or value[0] & 0x80 or (len(value) > 1 and value[0] == 0 and not value[1] & 0x80):
+            return None, None # negative or not minimally encoded
+        return int.from_bytes(value, "big"), data[2 + data[1]:]
+    if len(sig) < 2 or sig[0] != 0x30 or sig[1] != len(sig) - 2:
+        return None
+    r, rest = der_int(sig[2:])
+    if r is None:
+        return None
+    s, rest = der_int(rest)
+    if s is None or rest:
+        return None
+    return r, s
+
+# whether sig is a strict DER, low S signature of hash valid for pubkey
+def valid_signature(pubkey, hash, sig):
+    decoded = decode_der(sig)
+    return decoded is not None and 0 < decoded[1] <= SECP256K1_ORDER_HALF and CPubKey(pubkey).verify(hash, sig)
+
+# whether a decoded challenge response carries a valid signature
+def valid_response(response):
+    return valid_signature(hex_str_to_bytes(response["pubkey"]), hex_str_to_rev_bytes(response["hash"]),
+        hex_str_to_bytes(response["sig"]))
+
+
+class SignerTest(BitcoinTestFramework):
+
+    def __init__(self):
+        super().__init__()
+        self.setup_clean_chain = True
+        self.num_nodes = 1
+        self.extra_args = [["-txindex=1 -initialfreecoins=50000000000000", "-policycoins=50000000000000",
+    "-permissioncoinsdestination=76a914bc835aff853179fa88f2900f9003bb674e17ed4288ac",
+    "-initialfreecoinsdestination=76a914bc835aff853179fa88f2900f9003bb674e17ed4288ac",
+    "-challengecoinsdestination=76a914bc835aff853179fa88f2900f9003bb674e17ed4288ac",
+    "-debug=1"]]
+
+    def setup_network(self, split=False):
+        self.nodes = start_nodes(self.num_nodes, self.options.tmpdir, self.extra_args)
+        self.is_network_split=False
+
+    def run_test(self):
+        # Test signatures of each backend with and without pooled nonces
+        secret = os.urandom(32)
+        d = int.from_bytes(secret, "big")
+        backends = ["openssl"] + (["secp256k1"] if coincurve is not None else [])
+        pubkeys = set()
+        for backend in backends:
+            for pooled in (False, True):
+                pool = NoncePool(20, backend) if pooled else None
+                if pooled: # filled here rather than by the pool thread
+                    pool.nonces.extend(pool.generate() for i in range(20))
+                signer = make_signer(secret, backend, pool)
+                pubkeys.add(signer.get_pubkey())
+                rs = set()
+                for i in range(20):
+                    hash = os.urandom(32)
+                    sig = signer.sign(hash)
+                    assert(valid_signature(signer.get_pubkey(), hash, sig))
+                    rs.add(decode_der(sig)[0])
+                assert_equal(len(rs), 20)
+                if not pooled:
+                    continue
+                # each pooled nonce is used once
+                assert_equal(len(pool.nonces), 0)
+                # a high S is normalised: sign a hash for which s = n - 1
+                k = 12345
+                r = pool.point_x(k.to_bytes(32, "big")) % SECP256K1_ORDER
+                pool.nonces.append((pow(k, SECP256K1_ORDER - 2, SECP256K1_ORDER), r))
+                hash = ((SECP256K1_ORDER - 1) * k - r * d) % SECP256K1_ORDER
+                hash = hash.to_bytes(32, "big")
+                sig = signer.sign(hash)
+                assert_equal(decode_der(sig), (r, 1))
+                assert(valid_signature(signer.get_pubkey(), hash, sig))
+                # a drained pool falls back to the wrapped signer
+                hash = os.urandom(32)
+                sig = signer.sign(hash)
+                assert(valid_signature(signer.get_pubkey(), hash, sig))
+                if backend == "secp256k1": # deterministic nonces
+                    assert_equal(sig, Secp256k1Signer(secret).sign(hash))
+        assert_equal(len(pubkeys), 1) # backends derive the same public key
+        # and high S or invalid signatures are rejected by the check
+        signer = make_signer(secret, "openssl")
+        hash = os.urandom(32)
+        r, s = decode_der(signer.sign(hash))
+        assert(not valid_signature(signer.get_pubkey(), hash, der_signature(r, SECP256K1_ORDER - s)))
+        assert(not valid_signature(signer.get_pubkey(), os.urandom(32), der_signature(r, s)))
+
+        # Test guardnode responses signed with pooled nonces are accepted
+        self.nodes[0].importprivkey("cTnxkovLhGbp7VRhMhGThYt8WDwviXgaVAD8DjaVa5G5DApwC6tF")
+        self.nodes[0].generate(101)
+        coordinator = FakeCoordinator(verify=valid_response)
+        guardnode = start_guardnode(self.options.tmpdir,0,["--noncepool","4","--challengehost",coordinator.url])
+        time.sleep(WAIT_FOR_WORK)
+        assert(GN_log_contains(self.options.tmpdir,"Signing with precomputed nonces is not constant time"))
+
+        requesttxid = make_request(self.nodes[0])
+        self.nodes[0].generate(1)
+        time.sleep(WAIT_FOR_WORK)
+        self.nodes[0].generate(1)
+        time.sleep(WAIT_FOR_WORK)
+        bid = self.nodes[0].getrequestbids(requesttxid)["bids"][0]
+        self.nodes[0].generate(10) # bring into service period
+
+        challenges = []
+        for i in range(2):
+            challenges.append(self.nodes[0].sendtoaddress(self.nodes[0].getnewaddress(),1,"","",True,"CHALLENGE"))
+            self.nodes[0].generate(1)
+            time.sleep(WAIT_FOR_WORK)
+        assert_equal(coordinator.responses(400), [])
+        responses = coordinator.responses()
+        assert_equal([response["hash"] for response in responses], challenges)
+        assert_equal({response["pubkey"] for response in responses}, {bid["feePubKey"]})
+        assert_equal(len({decode_der(hex_str_to_bytes(response["sig"]))[0] for response in responses}), 2)
+
+        stop_guardnode(guardnode)
+        coordinator.stop()
+
+if __name__ == '__main__':
+    SignerTest().main()
@@ -6,6 +6,7 @@
 
   - HTTP connections persist for the life of the AuthServiceProxy object
     (if server supports HTTP/1.1)
+  - connections are pooled so that a proxy can be shared between threads
   - sends protocol 'version', per JSON-RPC 1.1
   - sends proper, incrementing 'id'
   - sends Basic HTTP authentication headers
@@ -38,10 +39,16 @@ try:
 except ImportError:
     import httplib
 import base64
+import bisect
 import decimal
 import json
 import logging
+import select
 import socket
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 try:
     import urllib.parse as urlparse
 except ImportError:
@@ -51,6 +58,22 @@ USER_AGENT = "AuthServiceProxy/0.1"
 
 HTTP_TIMEOUT = 30
 
+# Idle keep-alive connections older than this (seconds) are not reused
+POOL_MAX_IDLE = 60
+
+# Default RPCCache bound in bytes of (estimated) cached result size
+CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Block hashes within this many blocks of the tip may still be reorged
+CACHE_REORG_DEPTH = 6
+
+# Maximum number of txids remembered as confirmed by RPCCache
+CACHE_MAX_CONFIRMED = 100000
+
+# Upper bounds (seconds) of the RPCStats latency histogram buckets. Requests
+# slower than the last bound are counted in an extra overflow bucket.
+STATS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
 log = logging.getLogger("BitcoinRPC")
 
 class JSONRPCException(Exception):
@@ -63,6 +86,410 @@ class JSONRPCException(Exception):
         self.error = rpc_error
 
 
+class RPCFuture(object):
+    """
+    Result of a call queued on an RPCBatch. The result is available once the
+    batch has been executed; errors are raised as JSONRPCException on result().
+    """
+    def __init__(self, method):
+        self.method = method
+        self._response = None
+
+    def done(self):
+        return self._response is not None
+
+    def set_response(self, response):
+        if response is None:
+            response = {'error': {'code': -343, 'message': 'missing JSON-RPC result'}}
+        self._response = response
+
+    def result(self):
+        if self._response is None:
+            raise RuntimeError('%s called before batch was executed' % self.method)
+        if self._response.get('error') is not None:
+            raise JSONRPCException(self._response['error'])
+        elif 'result' not in self._response:
+            raise JSONRPCException({
+                'code': -343, 'message': 'missing JSON-RPC result'})
+        return self._response['result']
+
+
+class RPCBatch(object):
+    """
+    Queue RPC calls and send them in a single JSON-RPC batch request. Calls
+    return an RPCFuture which is resolved by execute(). Used as a context
+    manager the batch is executed on exit:
+
+        with proxy.batch() as batch:
+            txs = [batch.getrawtransaction(txid) for txid in txids]
+        hexs = [tx.result() for tx in txs]
+    """
+    def __init__(self, proxy):
+        self._proxy = proxy
+        self._calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            # Python internal stuff
+            raise AttributeError
+        def queue(*args, **argsn):
+            if args and argsn:
+                raise ValueError('Cannot handle both named and positional arguments')
+            future = RPCFuture(name)
+            if self._proxy.cache is not None:
+                cached, result = self._proxy.cache.lookup(name, args)
+                if cached:
+                    future.set_response({'result': result, 'error': None})
+                    return future
+            self._calls.append(({'version': '1.1',
+                                 'method': name,
+                                 'params': args or argsn,
+                                 'id': self._proxy._next_id()}, future))
+            return future
+        return queue
+
+    def __len__(self):
+        return len(self._calls)
+
+    def execute(self):
+        if not self._calls:
+            return
+        calls, self._calls = self._calls, []
+        responses = self._proxy._batch([call for call, _ in calls])
+        stats = self._proxy.stats
+        if not isinstance(responses, list):
+            raise JSONRPCException(responses.get('error') or {
+                'code': -342, 'message': 'non-batch response to batch request'})
+        responses = {response.get('id'): response for response in responses}
+        for call, future in calls:
+            future.set_response(responses.get(call['id']))
+            if stats is not None:
+                stats.record_batched(call['method'], future._response.get('error') is not None)
+            if self._proxy.cache is not None and future._response.get('error') is None:
+                self._proxy.cache.store(call['method'], call['params'], future._response.get('result'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        return False
+
+
+class RPCCache(object):
+    """
+    Bounded LRU cache of RPC results that can never change:
+
+    - getblock of serialized blocks by hash
+    - getblockhash of heights at least reorg_depth below the last seen tip
+    - getrawtransaction hex of transactions seen confirmed in a verbose
+      getblock or getrawtransaction result
+
+    Verbose results carry confirmations and nextblockhash, which change with
+    every new block, so they are never cached. The tip is tracked from
+    getblockcount results, and a lower tip than previously seen is treated
+    as a reorg. Hashes returned by getblockhash for heights near the tip are
+    remembered, so that a different hash at the same height is also treated
+    as a reorg. reorg() can also be called directly when a reorg is detected
+    elsewhere.
+    """
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, reorg_depth=CACHE_REORG_DEPTH):
+        self.max_bytes = max_bytes
+        self.reorg_depth = reorg_depth
+        self.tip = None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict() # key -> (result, size)
+        self._confirmed = OrderedDict() # txid -> None, bounded with entries
+        self._recent = {} # height -> block hash, for heights near the tip
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _verbose(params):
+        return len(params) > 1 and bool(params[1])
+
+    @classmethod
+    def _key(cls, method, params):
+        if method not in ('getblock', 'getblockhash', 'getrawtransaction') or \
+            not isinstance(params, (list, tuple)) or not params:
+            return None
+        if method == 'getblock' and (len(params) < 2 or params[1]): # verbose by default
+            return None
+        if method == 'getrawtransaction' and cls._verbose(params):
+            return None
+        return (method,) + tuple(params)
+
+    @staticmethod
+    def _estimate_size(result):
+        if isinstance(result, str):
+            return len(result)
+        return len(json.dumps(result, default=EncodeDecimal))
+
+    def lookup(self, method, params):
+        """Return (True, result) if cached, (False, None) otherwise"""
+        key = self._key(method, params)
+        if key is None:
+            return False, None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, self._entries[key][0]
+            self.misses += 1
+        return False, None
+
+    def store(self, method, params, result):
+        if method == 'getblockcount':
+            self._set_tip(result)
+            return
+        if result is None or method not in ('getblock', 'getblockhash', 'getrawtransaction') or \
+            not isinstance(params, (list, tuple)) or not params:
+            return
+        if method == 'getblockhash':
+            self._observe_hash(params[0], result)
+        with self._lock:
+            # confirmations are learned from verbose results, which are not stored
+            if method == 'getblock' and isinstance(result, dict):
+                if result.get('confirmations', 0) > 0:
+                    for txid in result.get('tx', []):
+                        self._mark_confirmed(txid)
+                return
+            if method == 'getrawtransaction' and self._verbose(params):
+                if result.get('blockhash'):
+                    self._mark_confirmed(params[0])
+                return
+            key = self._key(method, params)
+            if key is None:
+                return
+            if method == 'getblockhash':
+                if self.tip is None or params[0] > self.tip - self.reorg_depth:
+                    return
+            elif method == 'getrawtransaction' and params[0] not in self._confirmed:
+                return
+            if key in self._entries:
+                return
+            size = self._estimate_size(result)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (result, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    # Treat a new hash at a height near the tip as a reorg from that height
+    def _observe_hash(self, height, block_hash):
+        with self._lock:
+            previous = self._recent.get(height)
+            self._recent[height] = block_hash
+            if self.tip is not None:
+                for h in [h for h in self._recent if h <= self.tip - 2 * self.reorg_depth]:
+                    del self._recent[h]
+        if previous is not None and previous != block_hash:
+            self.reorg(height)
+
+    def _mark_confirmed(self, txid):
+        self._confirmed[txid] = None
+        self._confirmed.move_to_end(txid)
+        while len(self._confirmed) > CACHE_MAX_CONFIRMED:
+            self._confirmed.popitem(last=False)
+
+    def _set_tip(self, tip):
+        if self.tip is not None and tip < self.tip:
+            self.reorg(tip + 1)
+        self.tip = tip
+
+    def reorg(self, height):
+        """
+        Invalidate results that may have changed in a reorg from height.
+        Blocks by hash stay valid; transactions may no longer be confirmed
+        so are all dropped.
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] == 'getrawtransaction' or (key[0] == 'getblockhash' and key[1] >= height):
+                    self.size -= self._entries.pop(key)[1]
+            self._confirmed.clear()
+            for h in [h for h in self._recent if h > height]:
+                del self._recent[h]
+            if self.tip is not None:
+                self.tip = min(self.tip, height - 1)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self.size}
+
+
+class RPCStats(object):
+    """
+    Thread-safe per-method RPC counters: calls, errors, request and response
+    bytes and a latency histogram. Each HTTP round trip is timed; a JSON-RPC
+    batch is timed as a single 'batch' request and the calls it carried are
+    counted under their own method as batched calls.
+    """
+    def __init__(self, name=None, buckets=STATS_LATENCY_BUCKETS):
+        self.name = name
+        self.buckets = tuple(buckets)
+        self._methods = {}
+        self._lock = threading.Lock()
+
+    def _method(self, method):
+        if method not in self._methods:
+            self._methods[method] = {'calls': 0, 'batched': 0, 'errors': 0,
+                'seconds': 0.0, 'sent': 0, 'received': 0,
+                'buckets': [0] * (len(self.buckets) + 1)}
+        return self._methods[method]
+
+    def record(self, method, seconds, sent, received, error=False):
+        """Record a request to the server taking seconds to complete"""
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            entry = self._method(method)
+            entry['calls'] += 1
+            entry['errors'] += int(error)
+            entry['seconds'] += seconds
+            entry['sent'] += sent
+            entry['received'] += received
+            entry['buckets'][index] += 1
+
+    def record_batched(self, method, error=False):
+        """Record a call sent as part of a batch request"""
+        with self._lock:
+            entry = self._method(method)
+            entry['batched'] += 1
+            entry['errors'] += int(error)
+
+    def record_error(self, method):
+        """Record an error response to an already recorded request"""
+        with self._lock:
+            self._method(method)['errors'] += 1
+
+    def snapshot(self):
+        """Return a copy of the counters keyed by method"""
+        with self._lock:
+            return {method: dict(entry, buckets=list(entry['buckets']))
+                for method, entry in self._methods.items()}
+
+    def quantile(self, entry, q):
+        """Upper bucket bound (seconds) below which a fraction q of the
+        requests in a snapshot entry completed, or None if unbounded"""
+        target = q * sum(entry['buckets'])
+        count = 0
+        for bound, bucket in zip(self.buckets, entry['buckets']):
+            count += bucket
+            if count >= target:
+                return bound
+        return None
+
+    def summary(self):
+        """Return a list of human readable lines, busiest methods first"""
+        lines = []
+        snapshot = self.snapshot()
+        for method in sorted(snapshot, key=lambda m: -snapshot[m]['seconds']):
+            entry = snapshot[method]
+            line = '%s: calls=%i batched=%i errors=%i sent=%iB received=%iB' % (method,
+                entry['calls'], entry['batched'], entry['errors'], entry['sent'], entry['received'])
+            if entry['calls']:
+                p50 = self.quantile(entry, 0.5)
+                p99 = self.quantile(entry, 0.99)
+                line += ' avg=%.1fms p50<=%s p99<=%s' % (1000 * entry['seconds'] / entry['calls'],
+                    '%gms' % (1000 * p50) if p50 is not None else 'inf',
+                    '%gms' % (1000 * p99) if p99 is not None else 'inf')
+            lines.append(line)
+        return lines
+
+
+class HTTPConnectionPool(object):
+    """
+    Thread-safe pool of keep-alive HTTP connections to a single server.
+
+    A connection is checked out for the duration of each request so threads
+    never share a socket. Nested checkouts by the same thread re-use the
+    connection it already holds. Idle connections are health checked before
+    re-use and connections which fail during a request are discarded.
+    """
+    def __init__(self, url, timeout=HTTP_TIMEOUT, size=1, connection=None, max_idle=POOL_MAX_IDLE):
+        self.scheme = url.scheme
+        self.host = url.hostname
+        if url.port is not None:
+            self.port = url.port
+        else:
+            self.port = 443 if url.scheme == 'https' else 80
+        self.timeout = timeout
+        self.size = size
+        self.max_idle = max_idle
+        self._idle = [] # stack of (connection, last used time)
+        self._lock = threading.Lock()
+        self._available = threading.BoundedSemaphore(size)
+        self._local = threading.local()
+        if connection:
+            self._idle.append((connection, time.time()))
+
+    def _new_connection(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _healthy(self, conn, last_used):
+        if conn.sock is None: # not yet connected, will connect on request
+            return True
+        if time.time() - last_used > self.max_idle:
+            return False
+        # an idle keep-alive socket should have nothing to read - if it is
+        # readable the server has closed it
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def _checkout(self):
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if self._healthy(conn, last_used):
+                    return conn
+                conn.close()
+        return self._new_connection()
+
+    def _checkin(self, conn):
+        with self._lock:
+            self._idle.append((conn, time.time()))
+
+    @contextmanager
+    def connection(self):
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            yield held
+            return
+        if not self._available.acquire(timeout=self.timeout):
+            raise JSONRPCException({
+                'code': -345, 'message': 'no RPC connection available after %f seconds' % self.timeout})
+        conn = self._checkout()
+        self._local.conn = conn
+        try:
+            yield conn
+        except:
+            conn.close()
+            conn = None
+            raise
+        finally:
+            self._local.conn = None
+            if conn is not None:
+                self._checkin(conn)
+            self._available.release()
+
+    def close(self):
+        with self._lock:
+            while self._idle:
+                self._idle.pop()[0].close()
+
+
 def EncodeDecimal(o):
     if isinstance(o, decimal.Decimal):
         return str(o)
@@ -70,17 +497,19 @@ def EncodeDecimal(o):
 
 class AuthServiceProxy(object):
     __id_count = 0
+    __id_lock = threading.Lock()
 
     # ensure_ascii: escape unicode as \uXXXX, passed to json.dumps
-    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None, ensure_ascii=True):
+    # pool_size: maximum number of concurrent connections to the server
+    # cache: optional RPCCache for immutable results
+    # stats: optional RPCStats recording every request made
+    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None, ensure_ascii=True, pool_size=1, pool=None, cache=None, stats=None):
         self.__service_url = service_url
         self._service_name = service_name
+        self.cache = cache
+        self.stats = stats
         self.ensure_ascii = ensure_ascii # can be toggled on the fly by tests
         self.__url = urlparse.urlparse(service_url)
-        if self.__url.port is None:
-            port = 80
-        else:
-            port = self.__url.port
         (user, passwd) = (self.__url.username, self.__url.password)
         try:
             user = user.encode('utf8')
@@ -93,15 +522,11 @@ class AuthServiceProxy(object):
         authpair = user + b':' + passwd
         self.__auth_header = b'Basic ' + base64.b64encode(authpair)
 
-        if connection:
-            # Callables re-use the connection of the original proxy
-            self.__conn = connection
-        elif self.__url.scheme == 'https':
-            self.__conn = httplib.HTTPSConnection(self.__url.hostname, port,
-                                                  timeout=timeout)
+        if pool:
+            # Callables re-use the connection pool of the original proxy
+            self.__pool = pool
         else:
-            self.__conn = httplib.HTTPConnection(self.__url.hostname, port,
-                                                 timeout=timeout)
+            self.__pool = HTTPConnectionPool(self.__url, timeout, pool_size, connection)
 
     def __getattr__(self, name):
         if name.startswith('__') and name.endswith('__'):
@@ -109,7 +534,16 @@ class AuthServiceProxy(object):
             raise AttributeError
         if self._service_name is not None:
             name = "%s.%s" % (self._service_name, name)
-        return AuthServiceProxy(self.__service_url, name, connection=self.__conn)
+        return AuthServiceProxy(self.__service_url, name, pool=self.__pool, cache=self.cache, stats=self.stats)
+
+    def _next_id(self):
+        with AuthServiceProxy.__id_lock:
+            AuthServiceProxy.__id_count += 1
+            return AuthServiceProxy.__id_count
+
+    def batch(self):
+        """Return an RPCBatch which sends its queued calls in one request"""
+        return RPCBatch(self)
 
     def _request(self, method, path, postdata):
         '''
@@ -120,58 +554,79 @@ class AuthServiceProxy(object):
                    'User-Agent': USER_AGENT,
                    'Authorization': self.__auth_header,
                    'Content-type': 'application/json'}
-        try:
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
-        except httplib.BadStatusLine as e:
-            if e.line == "''": # if connection was closed, try again
-                self.__conn.close()
-                self.__conn.request(method, path, postdata, headers)
-                return self._get_response()
-            else:
-                raise
-        except (BrokenPipeError,ConnectionResetError):
-            # Python 3.5+ raises BrokenPipeError instead of BadStatusLine when the connection was reset
-            # ConnectionResetError happens on FreeBSD with Python 3.4
-            self.__conn.close()
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
+        with self.__pool.connection() as conn:
+            try:
+                conn.request(method, path, postdata, headers)
+                return self._get_response(conn)
+            except httplib.BadStatusLine as e:
+                if e.line == "''": # if connection was closed, try again
+                    conn.close()
+                    conn.request(method, path, postdata, headers)
+                    return self._get_response(conn)
+                else:
+                    raise
+            except (BrokenPipeError,ConnectionResetError):
+                # Python 3.5+ raises BrokenPipeError instead of BadStatusLine when the connection was reset
+                # ConnectionResetError happens on FreeBSD with Python 3.4
+                conn.close()
+                conn.request(method, path, postdata, headers)
+                return self._get_response(conn)
 
     def __call__(self, *args, **argsn):
-        AuthServiceProxy.__id_count += 1
+        if self.cache is not None:
+            cached, result = self.cache.lookup(self._service_name, args)
+            if cached:
+                return result
+        id_count = self._next_id()
 
-        log.debug("-%s-> %s %s"%(AuthServiceProxy.__id_count, self._service_name,
+        log.debug("-%s-> %s %s"%(id_count, self._service_name,
                                  json.dumps(args, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
         if args and argsn:
             raise ValueError('Cannot handle both named and positional arguments')
         postdata = json.dumps({'version': '1.1',
                                'method': self._service_name,
                                'params': args or argsn,
-                               'id': AuthServiceProxy.__id_count}, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
-        response = self._request('POST', self.__url.path, postdata.encode('utf-8'))
+                               'id': id_count}, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
+        response = self._post(self._service_name, postdata.encode('utf-8'))
         if response['error'] is not None:
+            if self.stats is not None:
+                self.stats.record_error(self._service_name)
             raise JSONRPCException(response['error'])
         elif 'result' not in response:
             raise JSONRPCException({
                 'code': -343, 'message': 'missing JSON-RPC result'})
         else:
+            if self.cache is not None:
+                self.cache.store(self._service_name, args, response['result'])
             return response['result']
 
     def _batch(self, rpc_call_list):
         postdata = json.dumps(list(rpc_call_list), default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
         log.debug("--> "+postdata)
-        return self._request('POST', self.__url.path, postdata.encode('utf-8'))
+        return self._post('batch', postdata.encode('utf-8'))
+
+    def _post(self, rpc_method, postdata):
+        """POST postdata to the server, recording it in stats as rpc_method"""
+        start = time.perf_counter()
+        response, received = None, 0
+        try:
+            response, received = self._request('POST', self.__url.path, postdata)
+            return response
+        finally:
+            if self.stats is not None:
+                self.stats.record(rpc_method, time.perf_counter() - start,
+                    len(postdata), received, response is None)
 
-    def _get_response(self):
+    def _get_response(self, conn):
         try:
-            http_response = self.__conn.getresponse()
+            http_response = conn.getresponse()
         except socket.timeout as e:
             raise JSONRPCException({
                 'code': -344,
                 'message': '%r RPC took longer than %f seconds. Consider '
                            'using larger timeout for calls that take '
                            'longer to return.' % (self._service_name,
-                                                  self.__conn.timeout)})
+                                                  conn.timeout)})
         if http_response is None:
             raise JSONRPCException({
                 'code': -342, 'message': 'missing HTTP response from server'})
@@ -181,10 +636,11 @@ class AuthServiceProxy(object):
             raise JSONRPCException({
                 'code': -342, 'message': 'non-JSON HTTP response with \'%i %s\' from server' % (http_response.status, http_response.reason)})
 
-        responsedata = http_response.read().decode('utf8')
+        rawdata = http_response.read()
+        responsedata = rawdata.decode('utf8')
         response = json.loads(responsedata, parse_float=decimal.Decimal)
         if "error" in response and response["error"] is None:
             log.debug("<-%s- %s"%(response["id"], json.dumps(response["result"], default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
         else:
             log.debug("<-- "+responsedata)
-        return response
+        return response, len(rawdata)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Coordinator stand-in for guardnode tests. Records the requests made to it and
+replies to challenge responses with queued status codes, 200 once the queue
+is empty. Responses failing an optional check are rejected with 400.
+"""
+import json
+import socket
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class CoordinatorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+            self.server.sockets.append(self.connection)
+
+    def do_HEAD(self):
+        self.server.record("HEAD", self.path, None, 200)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        status = self.server.next_status(body)
+        time.sleep(self.server.delay)
+        self.server.record("POST", self.path, body, status)
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeCoordinator(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    # statuses: status codes to reply to the first challenge responses with
+    # delay: seconds to wait before replying to a challenge response
+    # verify: optional function returning whether a decoded response is valid
+    def __init__(self, statuses=(), delay=0, port=0, verify=None):
+        super().__init__(("127.0.0.1", port), CoordinatorHandler)
+        self.url = "http://127.0.0.1:{}".format(self.server_address[1])
+        self.statuses = deque(statuses)
+        self.delay = delay
+        self.verify = verify
+        self.connections = 0 # TCP connections accepted
+        self.sockets = []
+        self.requests = [] # (method, path, body, status)
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def next_status(self, body):
+        if self.verify is not None:
+            try:
+                valid = self.verify(json.loads(body.decode("utf-8")))
+            except Exception:
+                valid = False
+            if not valid:
+                return 400
+        with self.lock:
+            return self.statuses.popleft() if self.statuses else 200
+
+    def record(self, method, path, body, status):
+        with self.lock:
+            self.requests.append((method, path, body, status))
+
+    def count(self, method):
+        with self.lock:
+            return len([request for request in self.requests if request[0] == method])
+
+    # decoded challenge responses replied to with status
+    def responses(self, status=200):
+        with self.lock:
+            return [json.loads(body.decode("utf-8")) for method, _, body, reply in self.requests
+                if method == "POST" and reply == status]
+
+    # stop listening and close open connections
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            for sock in self.sockets:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
@@ -55,6 +55,13 @@ class AuthServiceProxyWrapper(object):
 
         return return_val
 
+    def batch(self):
+        """
+        Batched calls are not recorded for coverage.
+
+        """
+        return self.auth_service_proxy_instance.batch()
+
     @property
     def url(self):
         return self.auth_service_proxy_instance.url
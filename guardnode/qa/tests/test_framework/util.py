@@ -426,7 +426,8 @@ def start_guardnode(dirname, node, args=[]):
     args = [ entry, \
         "--rpchost", "127.0.0.1:"+str(port), "--rpcuser", rpc_u, "--rpcpass", rpc_p, \
         "--servicerpchost", "127.0.0.1:"+str(port), "--servicerpcuser", rpc_u, "--servicerpcpass", rpc_p, \
-        "--bidlimit", "10", "--serviceblocktime", "1", "--nodelogfile", nodelogfile] \
+        "--bidlimit", "10", "--serviceblocktime", "1", "--clientblocktime", "1", "--maxpollinterval", "0.5", \
+        "--nodelogfile", nodelogfile] \
         + args
     # remove previous log
     if os.path.exists(dirname+'/GN_log'):
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+from binascii import hexlify
+
+# HTTP headers of challenge responses
+RESPONSE_HEADERS = {'content-type': 'application/json', 'Accept-Charset': 'UTF-8'}
+
+# Challenge response body for one bid. The bid txid and fee pubkey are fixed
+# for a whole service period, so the JSON around them is encoded once and a
+# response only splices in the challenge hash and signature.
+class ResponseTemplate():
+    def __init__(self, bid_txid, pubkey):
+        self.key = (bid_txid, pubkey)
+        self.prefix = '{{"txid": "{}", "pubkey": "{}", "hash": "'.format(bid_txid, pubkey).encode("utf-8")
+        self.headers = dict(RESPONSE_HEADERS)
+
+    # response body bytes for challenge_txid (hex) and DER signature sig
+    def build(self, challenge_txid, sig):
+        return b"".join((self.prefix, challenge_txid.encode("ascii"), b'", "sig": "', hexlify(sig), b'"}'))
+
+# signature hex of a response body, for logging
+def response_signature(data):
+    return data[data.rindex(b'"sig": "') + 8:-2].decode("ascii")
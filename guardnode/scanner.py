@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import BLOCKS_BACKFILLED, BLOCKS_UNSCANNED, REORGS
+
+# Maximum number of blocks behind the tip that are backfilled in one go
+SCAN_MAX_BACKFILL = 20
+
+# Number of scanned block hashes remembered for reorg detection
+SCAN_HASH_HISTORY = 100
+
+# Scan every client block for challenges, including blocks that arrived
+# between polls. The last scanned height and hash are tracked so that gaps are
+# backfilled and reorgs rescanned. Blocks are scanned concurrently by a
+# bounded pool of workers.
+class BlockScanner():
+    def __init__(self, ocean, scan, workers=1, max_backfill=SCAN_MAX_BACKFILL):
+        self.logger = logging.getLogger("Scanner")
+        self.ocean = ocean
+        self.scan = scan # scan(height) -> challenge txid or None
+        self.max_backfill = max_backfill
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+        self.reset()
+
+    # forget scanned blocks - the next scan starts from the tip
+    def reset(self):
+        self.hashes = OrderedDict() # height -> hash of scanned blocks
+        self.next_height = None # height to resume from after a deep reorg
+
+    @property
+    def last_height(self):
+        return next(reversed(self.hashes)) if self.hashes else None
+
+    # Scan all blocks after the last scanned one up to tip. Returns list of
+    # (height, challenge txid) for blocks containing a challenge
+    def scan_to(self, tip):
+        last = self.last_height
+        if last is not None and last > tip: # chain is shorter than last seen
+            self.find_fork(tip)
+            last = self.last_height
+        if last is not None:
+            start = last + 1
+        elif self.next_height is not None:
+            start = min(self.next_height, tip)
+        else:
+            start = tip
+        if tip - start + 1 > self.max_backfill:
+            self.logger.warning("{} blocks behind tip. Skipping heights {} to {}".format(
+                tip - start + 1, start, tip - self.max_backfill))
+            BLOCKS_UNSCANNED.inc(tip - self.max_backfill - start + 1)
+            start = tip - self.max_backfill + 1
+        heights = list(range(start, tip + 1))
+
+        # check the last scanned block is still in the chain along with
+        # fetching hashes of the new blocks
+        with self.ocean.batch() as batch:
+            check = batch.getblockhash(last) if last is not None else None
+            hashes = [batch.getblockhash(height) for height in heights]
+        if check is not None and check.result() != self.hashes[last]:
+            self.find_fork(last - 1)
+            return self.scan_to(tip)
+
+        if len(heights) > 1:
+            self.logger.info("Backfilling blocks {} to {}".format(start, tip - 1))
+            BLOCKS_BACKFILLED.inc(len(heights) - 1)
+        # blocks are only recorded as scanned once the whole batch has been,
+        # so a failed scan leaves every block of the batch to be rescanned
+        results = list(self.executor.map(self.scan, heights))
+        self.next_height = None
+        found = []
+        for height, block_hash, challenge_txid in zip(heights, hashes, results):
+            self.hashes[height] = block_hash.result()
+            if challenge_txid is not None:
+                found.append((height, challenge_txid))
+        while len(self.hashes) > SCAN_HASH_HISTORY:
+            self.hashes.popitem(last=False)
+        return found
+
+    # Record a block scanned outside of scan_to, e.g. decoded from p2p, so that
+    # it is not fetched again. Only a block extending the last scanned one is
+    # recorded - anything else is left to scan_to. Returns whether recorded.
+    def add_scanned(self, height, block_hash, prev_hash):
+        last = self.last_height
+        if last is None or last != height - 1 or self.hashes[last] != prev_hash:
+            return False
+        self.hashes[height] = block_hash
+        while len(self.hashes) > SCAN_HASH_HISTORY:
+            self.hashes.popitem(last=False)
+        return True
+
+    # Drop scanned blocks not in the current chain, walking back from height
+    # through remembered hashes to the fork point
+    def find_fork(self, height):
+        heights = [h for h in reversed(self.hashes) if h <= height]
+        fork = heights[-1] if heights else height + 1
+        if heights:
+            with self.ocean.batch() as batch:
+                current = [batch.getblockhash(h) for h in heights]
+            for h, block_hash in zip(heights, current):
+                if block_hash.result() == self.hashes[h]:
+                    fork = h + 1
+                    break
+        self.reorg(fork)
+
+    def reorg(self, height):
+        self.logger.warning("Client chain reorg detected from height {}".format(height))
+        REORGS.inc()
+        for scanned in [h for h in self.hashes if h >= height]:
+            del self.hashes[scanned]
+        if not self.hashes:
+            self.next_height = height
+        if self.ocean.cache is not None:
+            self.ocean.cache.reorg(height)
+
+    def stop(self):
+        self.executor.shutdown(wait=False)
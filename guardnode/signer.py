@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import secrets
+import threading
+from collections import deque
+from .daemon import DaemonThread
+from .qa.tests.test_framework.key import CECKey, SECP256K1_ORDER, SECP256K1_ORDER_HALF
+
+# coincurve (libsecp256k1 bindings) is optional - signing falls back to
+# OpenSSL if it is missing
+try:
+    import coincurve
+except ImportError:
+    coincurve = None
+
+# Challenge signing backends. "auto" uses libsecp256k1 if available
+SIGNERS = ["auto", "secp256k1", "openssl"]
+
+# Signs 32 byte hashes with a secp256k1 private key through OpenSSL's EC_KEY
+# API, normalising signatures to low S
+class OpenSSLSigner():
+    name = "openssl"
+
+    def __init__(self, secret):
+        self.key = CECKey()
+        self.key.set_secretbytes(secret)
+        self.key.set_compressed(True)
+
+    # DER encoded low S signature of hash
+    def sign(self, hash):
+        return self.key.sign(hash)
+
+    # compressed public key
+    def get_pubkey(self):
+        return self.key.get_pubkey()
+
+    # x coordinate of the point secret*G
+    @staticmethod
+    def point_x(secret):
+        key = CECKey()
+        key.set_secretbytes(secret)
+        key.set_compressed(False)
+        return int.from_bytes(key.get_pubkey()[1:33], "big")
+
+# Signs 32 byte hashes with libsecp256k1 via coincurve. Nonces are derived
+# deterministically (RFC6979) and signatures are always DER encoded low S, so
+# they verify exactly as those of OpenSSLSigner.
+class Secp256k1Signer():
+    name = "secp256k1"
+
+    def __init__(self, secret):
+        if coincurve is None:
+            raise ImportError("coincurve is required for libsecp256k1 signing")
+        self.key = coincurve.PrivateKey(secret)
+        self.pubkey = self.key.public_key.format(compressed=True)
+
+    def sign(self, hash):
+        if not isinstance(hash, bytes):
+            raise TypeError('Hash must be bytes instance; got %r' % hash.__class__)
+        if len(hash) != 32:
+            raise ValueError('Hash must be exactly 32 bytes long')
+        return self.key.sign(hash, hasher=None)
+
+    def get_pubkey(self):
+        return self.pubkey
+
+    @staticmethod
+    def point_x(secret):
+        return int.from_bytes(coincurve.PublicKey.from_secret(secret).format(compressed=False)[1:33], "big")
+
+# DER encoding of an ECDSA signature (r, s)
+def der_signature(r, s):
+    def der_int(value):
+        b = value.to_bytes((value.bit_length() + 8) // 8, "big") # leading zero if top bit set
+        return b"\x02" + bytes([len(b)]) + b
+    body = der_int(r) + der_int(s)
+    return b"\x30" + bytes([len(body)]) + body
+
+# Pool of precomputed ECDSA nonces, refilled by a background thread. Nonces
+# are independent of the signing key, so one pool serves key changes. Each
+# entry holds k^-1 and r, the x coordinate of k*G, rather than k itself.
+# Entries are removed from the pool when taken so none is used twice.
+class NoncePool(DaemonThread):
+    def __init__(self, size, backend="auto"):
+        super().__init__()
+        self.size = size
+        self.nonces = deque()
+        self.refill = threading.Event()
+        self.point_x = Secp256k1Signer.point_x if backend != "openssl" and coincurve is not None \
+            else OpenSSLSigner.point_x
+
+    def stop(self):
+        super().stop()
+        self.refill.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            while len(self.nonces) < self.size and not self.stop_event.is_set():
+                self.nonces.append(self.generate())
+            self.refill.wait()
+            self.refill.clear()
+
+    # (k^-1, r) for a fresh random nonce k
+    def generate(self):
+        while True:
+            k = secrets.randbelow(SECP256K1_ORDER - 1) + 1
+            r = self.point_x(k.to_bytes(32, "big")) % SECP256K1_ORDER
+            if r != 0:
+                return (pow(k, SECP256K1_ORDER - 2, SECP256K1_ORDER), r)
+
+    # take a nonce, or None if the pool is drained
+    def take(self):
+        try:
+            nonce = self.nonces.popleft()
+        except IndexError:
+            nonce = None
+        self.refill.set()
+        return nonce
+
+# Signs with nonces from a NoncePool, leaving only s = k^-1(z + rd) mod n to
+# compute per signature. Signatures are DER encoded low S like those of the
+# wrapped signer, which is used if the pool is drained.
+# The private key and nonces are Python ints and s is computed with Python's
+# variable time integer arithmetic, so unlike libsecp256k1 this is not
+# constant time: signing times may leak information on the fee key to an
+# observer on the same host. It is only used if --noncepool is set.
+class PooledSigner():
+    def __init__(self, signer, secret, pool):
+        self.name = signer.name + "+noncepool"
+        self.signer = signer
+        self.secret = int.from_bytes(secret, "big")
+        self.pool = pool
+
+    def sign(self, hash):
+        if not isinstance(hash, bytes):
+            raise TypeError('Hash must be bytes instance; got %r' % hash.__class__)
+        if len(hash) != 32:
+            raise ValueError('Hash must be exactly 32 bytes long')
+        nonce = self.pool.take()
+        if nonce is None:
+            return self.signer.sign(hash)
+        kinv, r = nonce
+        s = kinv * (int.from_bytes(hash, "big") + r * self.secret) % SECP256K1_ORDER
+        del nonce, kinv # drop the only reference to the used nonce
+        if s == 0:
+            return self.signer.sign(hash)
+        if s > SECP256K1_ORDER_HALF:
+            s = SECP256K1_ORDER - s
+        return der_signature(r, s)
+
+    def get_pubkey(self):
+        return self.signer.get_pubkey()
+
+# Return a signer for the 32 byte secret using backend, one of SIGNERS, and
+# nonces from pool if given
+def make_signer(secret, backend="auto", pool=None):
+    if backend == "secp256k1" or (backend == "auto" and coincurve is not None):
+        signer = Secp256k1Signer(secret)
+    else:
+        signer = OpenSSLSigner(secret)
+    if pool is not None:
+        return PooledSigner(signer, secret, pool)
+    return signer
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+import logging
+import threading
+from decimal import Decimal
+from .daemon import DaemonThread
+
+# Auction price of request at service chain height, following the request
+# price decay P(t) = P0 (1 + t) / (1 + t + t^3 / decayConst) over the blocks
+# t since the request was confirmed. Computed in satoshis and rounded down as
+# the node does.
+def auction_price(request, height):
+    t = height - request["confirmedBlockHeight"]
+    if t < 0:
+        return None
+    start = int(Decimal(request["startPrice"]).scaleb(8))
+    price = int(start * (1 + t) / (1 + t + float(t) ** 3 / request["decayConst"]))
+    return Decimal(max(price, 1)).scaleb(-8)
+
+# Stage signed bids for the live request on each new service block, so that
+# a bid is ready to broadcast as soon as the guardnode would make it. Bids
+# are staged at the current auction price and, while auction_price is seen to
+# match the prices reported by the node, at the price of the next block.
+# Nothing is staged while active() is false. fee_pubkey() gives the fee
+# pubkey bids are made with.
+class BidStager(DaemonThread):
+    def __init__(self, ocean, genesis, bidhandler, fee_pubkey, active):
+        super().__init__()
+        self.logger = logging.getLogger("Stager")
+        self.ocean = ocean
+        self.genesis = genesis
+        self.bidhandler = bidhandler
+        self.fee_pubkey = fee_pubkey
+        self.active = active
+        self.event = threading.Event()
+        self.offset = None # blocks between tip and the height prices are reported for, if predictable
+
+    def stop(self):
+        super().stop()
+        self.event.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.event.wait()
+            self.event.clear()
+            if self.stop_event.is_set():
+                break
+            try:
+                self.stage()
+            except Exception as e:
+                self.logger.warning("Could not stage bids: {}".format(e))
+
+    def stage(self):
+        if not self.active():
+            self.bidhandler.clear_staged()
+            return
+        with self.ocean.batch() as batch:
+            requests = batch.getrequests(self.genesis)
+            height = batch.getblockcount()
+        requests = requests.result()
+        if not requests:
+            self.bidhandler.clear_staged()
+            return
+        request = requests[0]
+        height = height.result()
+        prices = {request["auctionPrice"]}
+        if self.check_prices(request, height) and height + 1 < request["startBlockHeight"]:
+            prices.add(auction_price(request, height + 1 + self.offset))
+        self.bidhandler.stage_bids(request, self.fee_pubkey(), prices)
+
+    # Whether the reported auction price of request at height is that given
+    # by auction_price, for the tip or the block after it
+    def check_prices(self, request, height):
+        predictable = self.offset
+        self.offset = None
+        try:
+            for offset in (0, 1):
+                if auction_price(request, height + offset) == request["auctionPrice"]:
+                    self.offset = offset
+                    break
+        except (KeyError, TypeError, ZeroDivisionError):
+            pass
+        if self.offset is None and predictable is not None:
+            self.logger.warning("Auction price {} not as predicted. Staging bids at the current price only".format(
+                request["auctionPrice"]))
+        return self.offset is not None
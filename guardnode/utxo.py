@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+import logging
+import threading
+from bisect import bisect_left, insort
+from decimal import Decimal
+from io import BytesIO
+from .p2p import calc_txid
+from .qa.tests.test_framework.util import bytes_to_hex_str, hex_str_to_bytes
+from .qa.tests.test_framework.mininode import CBlock
+from .qa.tests.test_framework.script import CScript, OP_CHECKLOCKTIMEVERIFY, OP_CHECKMULTISIG
+
+# Maximum number of blocks applied incrementally before reloading the index
+UTXO_MAX_BLOCKS = 10
+
+# Blocks between full reloads, which pick up outputs paid to wallet scripts
+# the tracker has not seen yet
+UTXO_RESYNC_BLOCKS = 100
+
+# scriptPubKey types of bid wallet outputs
+P2PKH = "pubkeyhash"
+LOCKED_MULTISIG = "lockedmultisig"
+NONSTANDARD = "nonstandard"
+
+# Decode a minimally encoded script number
+def decode_script_num(data):
+    if not data:
+        return 0
+    value = int.from_bytes(data, "little")
+    if data[-1] & 0x80:
+        return -(value & ~(0x80 << (8 * (len(data) - 1))))
+    return value
+
+# Return (type, locktime) of a scriptPubKey given as bytes. Locktime is that
+# of the OP_CHECKLOCKTIMEVERIFY of a TX_LOCKED_MULTISIG script, 0 otherwise.
+def classify_script(script):
+    if len(script) == 25 and script[:3] == b"\x76\xa9\x14" and script[23:] == b"\x88\xac":
+        return P2PKH, 0
+    try:
+        ops = list(CScript(script))
+    except Exception:
+        return NONSTANDARD, 0
+    if len(ops) > 2 and ops[1] == OP_CHECKLOCKTIMEVERIFY and ops[-1] == OP_CHECKMULTISIG:
+        locktime = ops[0] if isinstance(ops[0], int) else decode_script_num(ops[0])
+        return LOCKED_MULTISIG, locktime
+    return NONSTANDARD, 0
+
+class Utxo():
+    def __init__(self, txid, vout, amount, script):
+        self.txid = txid
+        self.vout = vout
+        self.amount = amount
+        self.script = script # hex
+        self.type, self.locktime = classify_script(hex_str_to_bytes(script))
+
+    @property
+    def outpoint(self):
+        return (self.txid, self.vout)
+
+# In-process index of the bid wallet's confirmed CBT outputs. Loaded with one
+# listunspent call and kept current from service chain blocks, fetched raw and
+# decoded locally, and from the bid transactions sent by the guardnode.
+# TX_LOCKED_MULTISIG outputs are kept sorted by locktime and other spendable
+# outputs by amount, so coin selection is a bisection rather than a walk of
+# the whole wallet. Outputs paid to scripts not yet seen are picked up by
+# periodic reloads.
+class UtxoTracker():
+    def __init__(self, ocean, asset_label="CBT"):
+        self.logger = logging.getLogger("Utxo")
+        self.ocean = ocean
+        self.asset_label = asset_label
+        self.lock = threading.RLock()
+        self.height = None # last block applied, None until loaded
+        self.asset = None # explicit asset commitment of CBT outputs
+        self.loaded_height = None
+        self.reset()
+
+    def reset(self):
+        self.utxos = {} # (txid, vout) -> Utxo
+        self.locked = [] # sorted (locktime, txid, vout) of TX_LOCKED_MULTISIG outputs
+        self.standard = [] # sorted (amount, txid, vout) of other spendable outputs
+        self.scripts = set() # wallet scriptPubKeys (hex)
+        self.tip = None # hash of block at height
+
+    @property
+    def ready(self):
+        return self.height is not None
+
+    # (re)build the index from the wallet
+    def load(self):
+        with self.lock:
+            self.height = None
+            self.reset()
+            with self.ocean.batch() as batch:
+                unspent = batch.listunspent(1, 9999999, [], True, self.asset_label)
+                height = batch.getblockcount()
+            height = height.result()
+            with self.ocean.batch() as batch:
+                tip = batch.getblockhash(height)
+            for entry in unspent.result():
+                if self.asset is None and "asset" in entry:
+                    self.asset = b"\x01" + hex_str_to_bytes(entry["asset"])[::-1]
+                self.add(Utxo(entry["txid"], entry["vout"], entry["amount"], entry["scriptPubKey"]),
+                    entry["solvable"])
+            self.tip = tip.result()
+            self.height = self.loaded_height = height
+            self.logger.info("Tracking {} wallet outputs at height {}".format(len(self.utxos), height))
+
+    def add(self, utxo, solvable=True):
+        self.utxos[utxo.outpoint] = utxo
+        self.scripts.add(utxo.script)
+        if utxo.type == LOCKED_MULTISIG:
+            insort(self.locked, (utxo.locktime,) + utxo.outpoint)
+        elif solvable:
+            insort(self.standard, (utxo.amount,) + utxo.outpoint)
+
+    def remove(self, outpoint):
+        utxo = self.utxos.pop(outpoint, None)
+        if utxo is None:
+            return
+        for index, key in ((self.locked, (utxo.locktime,) + outpoint), (self.standard, (utxo.amount,) + outpoint)):
+            i = bisect_left(index, key)
+            if i < len(index) and index[i] == key:
+                del index[i]
+
+    # Apply service chain blocks up to height. Reloads on reorgs, large gaps
+    # and every UTXO_RESYNC_BLOCKS blocks.
+    def update(self, height):
+        with self.lock:
+            if self.height is None or height <= self.height or height - self.height > UTXO_MAX_BLOCKS \
+                or height - self.loaded_height >= UTXO_RESYNC_BLOCKS:
+                self.load()
+                return
+            heights = range(self.height + 1, height + 1)
+            with self.ocean.batch() as batch:
+                hashes = [batch.getblockhash(h) for h in heights]
+            with self.ocean.batch() as batch:
+                raw_blocks = [batch.getblock(block_hash.result(), False) for block_hash in hashes]
+            for h, block_hash, raw_block in zip(heights, hashes, raw_blocks):
+                block = CBlock()
+                block.deserialize(BytesIO(hex_str_to_bytes(raw_block.result())))
+                if "%064x" % block.hashPrevBlock != self.tip:
+                    self.logger.warning("Service chain reorg at height {}. Reloading wallet outputs".format(h))
+                    self.load()
+                    return
+                self.apply(block)
+                self.tip = block_hash.result()
+                self.height = h
+
+    # remove outputs spent by, and add wallet outputs created by, block
+    def apply(self, block):
+        for tx in block.vtx:
+            for txin in tx.vin:
+                self.remove(("%064x" % txin.prevout.hash, txin.prevout.n))
+            txid = None
+            for n, txout in enumerate(tx.vout):
+                script = bytes_to_hex_str(txout.scriptPubKey)
+                if script in self.scripts and txout.nAsset.vchCommitment == self.asset \
+                    and txout.nValue.vchCommitment[0] == 1:
+                    txid = txid or bytes_to_hex_str(calc_txid(tx)[::-1])
+                    self.add(Utxo(txid, n, Decimal(txout.nValue.getAmount()).scaleb(-8), script))
+
+    # scriptPubKey hex of an unspent output, or None if not tracked
+    def script(self, txid, vout):
+        with self.lock:
+            utxo = self.utxos.get((txid, vout))
+            return utxo.script if utxo is not None else None
+
+    # Whether all of inputs, as passed to createrawtransaction, are unspent
+    def unspent(self, inputs):
+        with self.lock:
+            return all((input["txid"], input["vout"]) in self.utxos for input in inputs)
+
+    # Record a transaction sent from the wallet: its inputs are spent and its
+    # output scripts are the wallet's. Outputs are added once confirmed.
+    def add_tx(self, tx):
+        self.spend([(txin["txid"], txin["vout"]) for txin in tx["vin"]],
+            [txout["scriptPubKey"]["hex"] for txout in tx["vout"]])
+
+    # As add_tx, given the spent outpoints and output scripts (hex)
+    def spend(self, outpoints, scripts):
+        with self.lock:
+            for outpoint in outpoints:
+                self.remove(outpoint)
+            self.scripts.update(script for script in scripts if script)
+
+    # Select outputs worth at least target: TX_LOCKED_MULTISIG outputs
+    # unlocked at the current height first, then the smallest single output
+    # covering the remainder or failing that the largest outputs. Returns
+    # (inputs, input sum), or None if the wallet can not cover target.
+    def select(self, target):
+        with self.lock:
+            inputs = []
+            total = Decimal(0)
+            for _, txid, vout in self.locked[:bisect_left(self.locked, (self.height + 1,))]:
+                inputs.append({"txid": txid, "vout": vout})
+                total += self.utxos[(txid, vout)].amount
+                if total >= target:
+                    return inputs, total
+            i = bisect_left(self.standard, (target - total,))
+            candidates = self.standard[i:i + 1] or reversed(self.standard)
+            for amount, txid, vout in candidates:
+                inputs.append({"txid": txid, "vout": vout})
+                total += amount
+                if total >= target:
+                    return inputs, total
+            return None
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+import logging
+import threading
+from time import time
+from .daemon import DaemonThread
+from .metrics import BLOCK_DETECTION_LAG, BLOCK_INTERVAL
+
+# Weight of the latest inter-block time in the moving average block time
+CADENCE_EWMA_WEIGHT = 0.2
+
+# Fraction of the expected block time after the last block from which the tip
+# is polled at the minimum interval
+CADENCE_WINDOW_START = 0.8
+
+# Multiple of the expected block time a block may be overdue by before
+# polling backs off to the maximum interval
+CADENCE_OVERDUE_LIMIT = 2
+
+# Model of a chain's block arrivals: an exponentially weighted moving average
+# of the time between block timestamps. Polling is tight from shortly before
+# the next block is expected and backs off otherwise.
+class BlockCadence():
+    def __init__(self, block_time, min_interval, max_interval):
+        self.expected = float(block_time)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.last_block_time = None
+
+    def observe(self, block_time):
+        if self.last_block_time is not None:
+            if block_time <= self.last_block_time:
+                return
+            self.expected += CADENCE_EWMA_WEIGHT * (block_time - self.last_block_time - self.expected)
+        self.last_block_time = block_time
+
+    # seconds to wait before polling the tip again
+    def next_interval(self, now):
+        if self.last_block_time is None:
+            return self.min_interval
+        elapsed = now - self.last_block_time
+        if elapsed > (1 + CADENCE_OVERDUE_LIMIT) * self.expected: # chain stalled
+            return self.max_interval
+        until_window = CADENCE_WINDOW_START * self.expected - elapsed
+        return min(max(until_window, self.min_interval), self.max_interval)
+
+# Watch the tip of one chain and call callback(height) whenever it changes.
+# The tip is polled at intervals given by the chain's BlockCadence, or when
+# the optional notifier (ZMQ or long poll) sets the watcher's event, in which
+# case polling every fallback_interval seconds only guards against missed
+# notifications.
+class TipWatcher(DaemonThread):
+    def __init__(self, name, conn, callback, cadence, fallback_interval=None):
+        super().__init__()
+        self.logger = logging.getLogger("Watcher")
+        self.name = name
+        self.conn = conn
+        self.callback = callback
+        self.cadence = cadence
+        self.fallback_interval = fallback_interval or cadence.max_interval
+        self.height = None
+        self.event = threading.Event()
+        self.notifier = None # set to a notifier thread signalling self.event
+
+    def stop(self):
+        if self.notifier is not None:
+            self.notifier.stop()
+        super().stop()
+        self.event.set()
+
+    def run(self):
+        if self.notifier is not None:
+            self.notifier.start()
+        while not self.stop_event.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                self.logger.error(e)
+                self.error = e
+                return
+            self.event.wait(self.wait_time())
+            self.event.clear()
+
+    def poll(self):
+        height = self.conn.getblockcount()
+        if self.update(height):
+            detected_at = time()
+            self.callback(height)
+            try:
+                header = self.conn.getblockheader(self.conn.getblockhash(height))
+                self.observe_block(header["time"], detected_at)
+            except Exception as e:
+                self.logger.warning("Could not get {} block {} time: {}".format(self.name, height, e))
+
+    # record height, returning True if the tip has changed
+    def update(self, height):
+        if height == self.height:
+            return False
+        self.height = height
+        return True
+
+    # update block cadence and detection lag with the timestamp of a new tip
+    def observe_block(self, block_time, detected_at):
+        if self.cadence.last_block_time is not None:
+            BLOCK_DETECTION_LAG.observe(max(detected_at - block_time, 0), chain=self.name)
+        self.cadence.observe(block_time)
+        BLOCK_INTERVAL.set(self.cadence.expected, chain=self.name)
+
+    # Seconds until the next poll. Falls back to adaptive polling if the
+    # notifier has failed.
+    def wait_time(self):
+        if self.notifier is not None and self.notifier.error:
+            self.logger.error("Block notifications from {} failed. Falling back to polling".format(self.notifier.endpoint))
+            self.notifier = None
+        if self.notifier is not None:
+            return self.fallback_interval
+        return self.cadence.next_interval(time())
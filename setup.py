@@ -12,4 +12,8 @@ setup(name='guardnode',
       scripts=[],
       include_package_data=True,
       data_files=[],
+      extras_require={
+          'secp256k1': ['coincurve'],
+          'zmq': ['pyzmq'],
+      },
 )